@@ -0,0 +1,79 @@
+"""Отзывчивость цикла событий при одновременной записи в очередь.
+
+Сравнивает прямые вызовы db.py на цикле событий с вызовами через Repository.
+Запуск из корня проекта: python benchmarks/bench_event_loop.py [число записей]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytz
+from db import create_connection, add_user_to_queue, insert_queue
+from migrations import run_migrations
+from repository import Repository
+
+async def measure_lag(stop: asyncio.Event, interval: float = 0.001) -> list[float]:
+    """Замеряет задержки пробуждения цикла событий относительно interval."""
+    lags = []
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+    return lags
+
+def report(title: str, elapsed: float, joins: int, lags: list[float]):
+    lags = sorted(lags) or [0.0]
+    p99 = lags[int(len(lags) * 0.99) - 1] if len(lags) > 1 else lags[0]
+    print(f"{title:<12} {joins / elapsed:>9.0f} записей/с  "
+          f"лаг цикла: max {lags[-1] * 1000:7.2f} мс, p99 {p99 * 1000:7.2f} мс, тиков {len(lags)}")
+
+async def bench_sync(path: str, joins: int):
+    conn = create_connection(path)
+    queue_id = insert_queue(conn, "bench", datetime.now(pytz.UTC), 0.0, 0.0, 1)
+
+    async def join(user_id):
+        add_user_to_queue(conn, queue_id, user_id)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(join(user_id) for user_id in range(joins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    report("sqlite3", elapsed, joins, await lag_task)
+    conn.close()
+
+async def bench_repository(path: str, joins: int):
+    repo = Repository(path)
+    await repo.open()
+    queue_id = await repo.insert_queue("bench", datetime.now(pytz.UTC), 0.0, 0.0, 1)
+
+    async def join(user_id):
+        await repo.add_user_to_queue(queue_id, user_id)
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(join(user_id) for user_id in range(joins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    report("Repository", elapsed, joins, await lag_task)
+    repo.close()
+
+def main():
+    joins = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for bench in (bench_sync, bench_repository):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            conn = create_connection(path)
+            run_migrations(conn)
+            conn.close()
+            asyncio.run(bench(path, joins))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Проверка расстояния до очереди: geopy.geodesic против geo.LocalProjection и haversine.
+
+Отдельно — проверка попадания в геозону geo.PolygonFence из 8 и 50 вершин
+и пакетная проверка geo.within_many многих точек против многих очередей.
+
+Печатает время одной проверки и наибольшее отклонение от geodesic на
+расстояниях до 150 м, 2 км и 20 км.
+Запуск из корня проекта: python benchmarks/bench_geo.py [число точек]
+"""
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from geopy.distance import geodesic
+import geo
+
+CENTERS = ((56.0, 92.9), (43.1, 131.9), (69.0, 33.1), (-33.9, 18.4))
+
+def random_points(center, max_distance: float, count: int, rng: random.Random):
+    lat, lon = center
+    points = []
+    for _ in range(count):
+        distance = max_distance * math.sqrt(rng.random())
+        bearing = rng.uniform(0, 2 * math.pi)
+        dlat = distance * math.cos(bearing) / 111_320
+        dlon = distance * math.sin(bearing) / (111_320 * math.cos(math.radians(lat)))
+        points.append((lat + dlat, lon + dlon))
+    return points
+
+def timed(func, points) -> float:
+    started = time.perf_counter()
+    for lat, lon in points:
+        func(lat, lon)
+    return (time.perf_counter() - started) / len(points) * 1e6
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = random.Random(1)
+    center = CENTERS[0]
+    projection = geo.LocalProjection(*center)
+    points = random_points(center, 2000, count, rng)
+
+    print(f"Одна проверка ({count} точек):")
+    print(f"  geodesic           {timed(lambda lat, lon: geodesic((lat, lon), center).meters, points):8.2f} мкс")
+    print(f"  haversine          {timed(lambda lat, lon: geo.haversine(lat, lon, *center), points):8.2f} мкс")
+    print(f"  LocalProjection    {timed(lambda lat, lon: projection.within(lat, lon, 150), points):8.2f} мкс")
+
+    for vertices in (8, 50):
+        corners = [(center[0] + 0.004 * math.sin(2 * math.pi * k / vertices),
+                    center[1] + 0.007 * math.cos(2 * math.pi * k / vertices)) for k in range(vertices)]
+        fence = geo.PolygonFence(corners)
+        print(f"  PolygonFence ({vertices:>2}) {timed(fence.contains, points):8.2f} мкс")
+
+    # 50 очередей со своими радиусами, каждая пятая — с геозоной
+    zones = []
+    for index, (lat, lon) in enumerate([center] + random_points(center, 5000, 49, rng)):
+        fence = geo.PolygonFence([(lat + 0.001 * math.sin(2 * math.pi * k / 8), lon + 0.002 * math.cos(2 * math.pi * k / 8))
+                                  for k in range(8)]) if index % 5 == 0 else None
+        zones.append(((lat, lon), rng.uniform(20, 2000), fence))
+    started = time.perf_counter()
+    geo.within_many(points, zones)
+    elapsed = time.perf_counter() - started
+    print(f"  within_many ({len(zones)} очередей) {elapsed / (count * len(zones)) * 1e6:8.3f} мкс на пару")
+
+    print("Наибольшее отклонение от geodesic:")
+    for max_distance in (150, 2000, 20000):
+        worst_projection = worst_haversine = 0.0
+        for center in CENTERS:
+            projection = geo.LocalProjection(*center)
+            for lat, lon in random_points(center, max_distance, 2000, rng):
+                exact = geodesic((lat, lon), center).meters
+                worst_projection = max(worst_projection, abs(projection.distance(lat, lon) - exact))
+                worst_haversine = max(worst_haversine, abs(geo.haversine(lat, lon, *center) - exact))
+        print(f"  до {max_distance:>5} м: LocalProjection {worst_projection * 100:8.3f} см, haversine {worst_haversine * 100:8.1f} см")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Пропускная способность записи: commit на каждую операцию против групповой фиксации.
+
+Оба варианта используют synchronous=FULL, чтобы каждый commit стоил fsync.
+Запуск из корня проекта: python benchmarks/bench_group_commit.py [число операций]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytz
+from db import create_connection
+from migrations import run_migrations
+from repository import Repository
+from varibles import SQLITE_PRAGMAS
+
+PRAGMAS = dict(SQLITE_PRAGMAS, synchronous="FULL")
+
+async def bench(title: str, path: str, operations: int, window: float, batch_size: int):
+    repo = Repository(path, PRAGMAS, write_batch_window=window, write_batch_size=batch_size)
+    await repo.open()
+    queue_id = await repo.insert_queue("bench", datetime.now(pytz.UTC), 0.0, 0.0, 1)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(repo.add_user_to_queue(queue_id, user_id) for user_id in range(operations)))
+    elapsed = time.perf_counter() - started
+
+    stats = repo.write_stats()
+    print(f"{title:<20} {operations / elapsed:>9.0f} операций/с  "
+          f"commit: {stats['batches']:>5}  операций на commit: {stats['operations'] / stats['batches']:6.1f}")
+    repo.close()
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    variants = (
+        ("commit на операцию", 0, 1),
+        ("групповой commit", 0.005, 200),
+    )
+    for title, window, batch_size in variants:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "bench.db")
+            conn = create_connection(path)
+            run_migrations(conn)
+            conn.close()
+            asyncio.run(bench(title, path, operations, window, batch_size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""Токены приглашений: AES на каждый вызов (старый формат) против crypto.TokenCodec.
+
+Печатает число операций в секунду для кодирования и проверки токенов,
+для проверки — без кэша и с кэшем, а также длину payload для start.
+Запуск из корня проекта: python benchmarks/bench_tokens.py [число операций]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto.Cipher import AES
+from crypto import TokenCodec
+from varibles import JOIN_QUEUE_PAYLOAD
+
+SECRET = b"0123456789abcdef"
+
+def legacy_encode(queue_id: int, creator_id: int) -> str:
+    data = f"{queue_id}:{creator_id}"
+    data += (16 - len(data) % 16) * chr(16 - len(data) % 16)
+    return AES.new(SECRET, AES.MODE_ECB).encrypt(data.encode()).hex()[:32]
+
+def legacy_decode(token: str) -> tuple[int, int]:
+    decrypted = AES.new(SECRET, AES.MODE_ECB).decrypt(bytes.fromhex(token)).decode()
+    queue_id, creator_id = decrypted[:-ord(decrypted[-1])].split(":")
+    return int(queue_id), int(creator_id)
+
+def rate(func, items) -> float:
+    started = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (time.perf_counter() - started)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    pairs = [(1000 + i, 100_000_000 + i * 7919) for i in range(count)]
+
+    legacy_tokens = [legacy_encode(*pair) for pair in pairs]
+    print(f"AES на вызов      кодирование {rate(lambda pair: legacy_encode(*pair), pairs):>10.0f}/с  "
+          f"проверка {rate(legacy_decode, legacy_tokens):>10.0f}/с")
+
+    codec = TokenCodec(SECRET, cache_size=0)
+    tokens = [codec.encode(JOIN_QUEUE_PAYLOAD, *pair) for pair in pairs]
+    print(f"TokenCodec        кодирование {rate(lambda pair: codec.encode(JOIN_QUEUE_PAYLOAD, *pair), pairs):>10.0f}/с  "
+          f"проверка {rate(lambda token: codec.decode(JOIN_QUEUE_PAYLOAD, token), tokens):>10.0f}/с")
+
+    # Популярное приглашение: одни и те же токены проверяются многократно
+    cached = TokenCodec(SECRET, cache_size=1024)
+    hot = tokens[:100] * (count // 100)
+    print(f"TokenCodec + LRU                              "
+          f"проверка {rate(lambda token: cached.decode(JOIN_QUEUE_PAYLOAD, token), hot):>10.0f}/с")
+
+    print(f"Длина payload: старый {len(JOIN_QUEUE_PAYLOAD) + 32}, новый {len(JOIN_QUEUE_PAYLOAD) + len(tokens[-1])} из 64")
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,110 @@
+import asyncio
 import logging
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import CallbackContext, ConversationHandler, JobQueue
+import time
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaDocument
+from telegram.ext import CallbackContext, ConversationHandler
 from datetime import datetime
 import pytz
 from config import ADMIN_ID
-from varibles import BROADCAST_MESSAGE, BROADCAST_RECIPIENTS, BROADCAST_SCHEDULE
+from varibles import BROADCAST_MESSAGE, BROADCAST_RECIPIENTS, BROADCAST_SCHEDULE, BROADCAST_PAGE_SIZE
 from db import *
-from utils import build_menu, build_select_group_menu
+from delivery import LANE_BULK
+from utils import build_menu, build_select_group_menu, convert_time_to_user_timezone
+from callbacks import (pack, CB_CREATE_BROADCAST, CB_MAIN_MENU, CB_BROADCAST_INFO, CB_CANCEL_BROADCAST,
+                       CB_SHOW_BROADCASTS, CB_CONFIRM_CANCEL_BROADCAST, CB_CANCEL_CANCEL_BROADCAST)
 
 logger = logging.getLogger(__name__)
 
+# Рассылки идут в полосе с низшим приоритетом
+BULK = {"lane": LANE_BULK}
+
+# copy_messages принимает не больше 100 сообщений за вызов
+COPY_BATCH_SIZE = 100
+
+# Альбом send_media_group: от 2 до 10 элементов одного вида, подпись до 1024 символов
+ALBUM_SIZE = 10
+CAPTION_LIMIT = 1024
+ALBUM_MEDIA = {"photo": InputMediaPhoto, "document": InputMediaDocument}
+
+# Типы вложений, которые сохраняются для просмотра рассылки, в порядке проверки
+PART_TYPES = ("photo", "document", "video", "animation", "audio", "voice", "video_note", "sticker")
+PART_LABELS = {"photo": "🖼 Фото", "document": "📄 Документ", "video": "🎬 Видео", "animation": "🎞 Анимация",
+               "audio": "🎵 Аудио", "voice": "🎤 Голосовое", "video_note": "📹 Видеосообщение", "sticker": "🏷 Стикер"}
+
+def describe_message(message) -> dict:
+    """Возвращает часть рассылки: ссылку на исходное сообщение, его тип и содержимое (текст или file_id)."""
+    part = {"chat_id": message.chat_id, "message_id": message.message_id, "type": "other", "content": None}
+    if message.text:
+        part["type"], part["content"] = "text", message.text
+        return part
+    for kind in PART_TYPES:
+        attachment = getattr(message, kind, None)
+        if attachment:
+            part["type"] = kind
+            part["content"] = attachment[-1].file_id if kind == "photo" else attachment.file_id
+            break
+    return part
+
+def broadcast_name(kind: str | None, content: str | None) -> str:
+    """Короткое название рассылки по ее первой части."""
+    if kind == "text" and content:
+        name = " ".join(content.split()[:2])
+        return name[:16] + "..." if len(name) > 16 else name
+    if kind == "photo":
+        return "Фото"
+    if kind == "document":
+        return "Файл"
+    return "Рассылка"
+
+def group_send_batches(parts: list[dict]) -> list[dict]:
+    """Разбивает части на пакеты отправки с сохранением порядка.
+
+    Пакет "copy" — подряд идущие части из одного чата с возрастающими
+    message_id (требование copy_messages). Части старых рассылок без ссылки
+    на исходное сообщение отправляются по file_id: подряд идущие фото или
+    документы собираются в альбом "album" до ALBUM_SIZE элементов, текст прямо
+    перед альбомом становится его подписью, если помещается. Остальные части
+    идут по одной как "single".
+    """
+    batches = []
+    for part in parts:
+        last = batches[-1] if batches else None
+        if part['chat_id'] is not None and part['message_id'] is not None:
+            if (last and last['kind'] == "copy" and last['chat_id'] == part['chat_id']
+                    and len(last['message_ids']) < COPY_BATCH_SIZE and last['message_ids'][-1] < part['message_id']):
+                last['message_ids'].append(part['message_id'])
+            else:
+                batches.append({"kind": "copy", "chat_id": part['chat_id'], "message_ids": [part['message_id']]})
+        elif part['type'] in ALBUM_MEDIA:
+            if last and last['kind'] == "album" and last['type'] == part['type'] and len(last['items']) < ALBUM_SIZE:
+                last['items'].append(part['content'])
+            else:
+                batches.append({"kind": "album", "type": part['type'], "items": [part['content']], "caption": None})
+        else:
+            batches.append({"kind": "single", "part": part})
+
+    # Подпись из предшествующего текста и одиночные элементы альбомов
+    result = []
+    for batch in batches:
+        if batch['kind'] == "album":
+            previous = result[-1] if result else None
+            if (previous and previous['kind'] == "single" and previous['part']['type'] == "text"
+                    and len(previous['part']['content'] or "") <= CAPTION_LIMIT):
+                batch['caption'] = result.pop()['part']['content']
+            if len(batch['items']) == 1:
+                batch = {"kind": "single", "part": {"type": batch['type'], "content": batch['items'][0], "caption": batch['caption']}}
+        result.append(batch)
+    return result
+
+def build_album(batch: dict) -> list:
+    """Элементы send_media_group для пакета "album"; подпись у первого элемента."""
+    media_class = ALBUM_MEDIA[batch['type']]
+    return [media_class(file_id, caption=batch['caption'] if index == 0 else None)
+            for index, file_id in enumerate(batch['items'])]
+
 async def show_broadcasts(update: Update, context: CallbackContext) -> None:
     """Показывает список рассылок."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
     query = update.callback_query
 
@@ -30,30 +122,20 @@ async def show_broadcasts(update: Update, context: CallbackContext) -> None:
             return
 
     # Получаем рассылки пользователя
-    broadcasts = get_broadcasts(conn, user_id)
+    broadcasts = await repo.get_broadcasts(user_id)
     if user_id == ADMIN_ID:
-        broadcasts = get_broadcasts(conn)  # Админ видит все рассылки
+        broadcasts = await repo.get_broadcasts()  # Админ видит все рассылки
 
     # Добавляем кнопки "Создать рассылку" и "Назад"
-    buttons = [InlineKeyboardButton("➕ Создать рассылку", callback_data="create_broadcast")]
-    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data="main_menu"))
+    buttons = [InlineKeyboardButton("➕ Создать рассылку", callback_data=pack(CB_CREATE_BROADCAST))]
+    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data=pack(CB_MAIN_MENU)))
 
     if broadcasts:
         # Создаем кнопки для каждой рассылки
         for broadcast in reversed(broadcasts):
-            broadcast_id, message_text, message_photo, message_document, recipients, send_time = broadcast
-            # Формируем название рассылки
-            if message_text:
-                name = " ".join(message_text.split()[:2])
-                if len(name) > 16:
-                    name = name[:16] + "..."
-            elif message_photo:
-                name = "Фото"
-            elif message_document:
-                name = "Файл"
-            else:
-                name = "Рассылка"
-            buttons.insert(0, InlineKeyboardButton(name, callback_data=f"broadcast_info_{broadcast_id}"))
+            broadcast_id, send_ts, first_type, first_content = broadcast
+            name = broadcast_name(first_type, first_content)
+            buttons.insert(0, InlineKeyboardButton(name, callback_data=pack(CB_BROADCAST_INFO, broadcast_id)))
 
         menu = build_menu(buttons, n_cols=1)
         reply_markup = InlineKeyboardMarkup(menu)
@@ -67,55 +149,46 @@ async def show_broadcasts(update: Update, context: CallbackContext) -> None:
     else:
         await context.bot.send_message(chat_id, "📋 Выберите рассылку:", reply_markup=reply_markup)
 
-async def broadcast_info_button(update: Update, context: CallbackContext) -> None:
+async def broadcast_info_button(update: Update, context: CallbackContext, broadcast_id: int) -> None:
     """Обрабатывает нажатие кнопки просмотра информации о рассылке."""
     query = update.callback_query
     await query.answer()
-    conn = context.bot_data['conn']
-
-    broadcast_id = None
-    if broadcast_id is None:
-        if query and (query.data.startswith("broadcast_info_") or query.data.startswith("cancel_cancel_broadcast_")):
-            if query.data.startswith("cancel_cancel_broadcast_"):
-                broadcast_id = int(query.data.split("_")[3])  # Извлекаем broadcast_id из "cancel_cancel_broadcast_{broadcast_id}"
-            else:
-                broadcast_id = int(query.data.split("_")[2])  # Извлекаем broadcast_id из "broadcast_info_{broadcast_id}"
-        else:
-            if query:
-                await query.edit_message_text("❌ Ошибка: ID рассылки не найден.")
-            return
+    repo = context.bot_data['repo']
 
     # Получаем информацию о рассылке
-    broadcast = get_broadcast_by_id(conn, broadcast_id)
+    broadcast = await repo.get_broadcast_by_id(broadcast_id)
     if not broadcast:
         await query.edit_message_text("❌ Ошибка: Рассылка не найдена.")
         return
 
     # Получаем запланированное время
-    cursor = conn.cursor()
-    cursor.execute("SELECT send_time FROM broadcasts WHERE id = ?", (broadcast_id,))
-    send_time_result = cursor.fetchone()
-    send_time = datetime.fromisoformat(send_time_result[0]).strftime("%d.%m.%Y %H:%M") if send_time_result else "Не указано"
-
-    # Формируем текст сообщения
-    message_text = broadcast.get("message_text", "")
-    message_photo = broadcast.get("message_photo", "")
-    message_document = broadcast.get("message_document", "")
+    send_ts = broadcast.get("send_ts")
+    if send_ts is not None:
+        user_timezone_str = await repo.get_user_timezone(update.effective_user.id)
+        send_time = convert_time_to_user_timezone(send_ts, user_timezone_str).strftime("%d.%m.%Y %H:%M")
+    else:
+        send_time = "Не указано"
 
-    # Формируем информацию о рассылке
+    # Формируем информацию о рассылке: части в том порядке, в котором они будут отправлены
     info_text = f"📋 *Информация о рассылке:*\n\n"
-    if message_text:
-        info_text += f"📝 *Сообщение:*\n{message_text}\n\n"
-    if message_photo:
-        info_text += "🖼 *Фото:* Прикреплено\n\n"
-    if message_document:
-        info_text += "📄 *Документ:* Прикреплен\n\n"
+    for part in broadcast["parts"]:
+        if part["type"] == "text":
+            info_text += f"📝 *Сообщение:*\n{part['content']}\n\n"
+        else:
+            info_text += f"{PART_LABELS.get(part['type'], '📎 Вложение')}\n\n"
     info_text += f"⏰ *Запланированное время:* {send_time}"
 
+    progress = await repo.get_broadcast_progress(broadcast_id)
+    if progress:
+        info_text += (
+            f"\n📨 *Доставлено:* {progress.get(DELIVERY_SENT, 0)} из {sum(progress.values())}"
+            f", ошибок: {progress.get(DELIVERY_FAILED, 0)}"
+        )
+
     # Формируем кнопки
     buttons = [
-        InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_broadcast_{broadcast_id}"),
-        InlineKeyboardButton("🔙 Назад", callback_data="show_broadcasts")
+        InlineKeyboardButton("❌ Отменить", callback_data=pack(CB_CANCEL_BROADCAST, broadcast_id)),
+        InlineKeyboardButton("🔙 Назад", callback_data=pack(CB_SHOW_BROADCASTS))
     ]
     reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=1))
 
@@ -141,16 +214,16 @@ async def broadcast_message(update: Update, context: CallbackContext) -> int:
         else:
             # Переходим к выбору получателей
             user_id = update.effective_user.id
-            conn = context.bot_data['conn']
+            repo = context.bot_data['repo']
 
             if user_id == ADMIN_ID:
                 # Админ видит все группы и кнопку "без группы"
-                all_groups = get_all_groups(conn)
+                all_groups = await repo.get_all_groups()
                 reply_markup = build_select_group_menu(all_groups, with_no_group=True)
                 await update.message.reply_text("📋 Выберите группу для рассылки или нажмите 'Без группы':", reply_markup=reply_markup)
             else:
                 # Обычный пользователь видит только группы, в которых он состоит
-                user_groups = get_user_groups(conn, user_id)
+                user_groups = await repo.get_user_groups(user_id)
                 if not user_groups:
                     await update.message.reply_text("❌ Вы не состоите ни в одной группе.")
                     return ConversationHandler.END
@@ -161,41 +234,29 @@ async def broadcast_message(update: Update, context: CallbackContext) -> int:
 
             return BROADCAST_RECIPIENTS
 
-    # Сохраняем текст, фото или файл в порядке получения
-    if update.message.text:
-        context.user_data['broadcast_messages'].append({"type": "text", "content": update.message.text})
-    elif update.message.photo:
-        context.user_data['broadcast_messages'].append({"type": "photo", "content": update.message.photo[-1].file_id})
-    elif update.message.document:
-        context.user_data['broadcast_messages'].append({"type": "document", "content": update.message.document.file_id})
+    # Сохраняем ссылку на сообщение в порядке получения; при отправке оно копируется как есть
+    context.user_data['broadcast_messages'].append(describe_message(update.message))
 
     await update.message.reply_text("✅ Сообщение добавлено. Продолжайте ввод или введите /end для завершения.")
     return BROADCAST_MESSAGE
 
-async def broadcast_choose_group(update: Update, context: CallbackContext) -> int:
-    """Обрабатывает выбор группы для рассылки."""
+async def broadcast_choose_group(update: Update, context: CallbackContext, group_id: int | None = None) -> int:
+    """Обрабатывает выбор группы для рассылки (group_id None — без группы)."""
     query = update.callback_query
     await query.answer()
-    group_id_str = query.data
 
-    if group_id_str == "select_group_none":
+    if group_id is None:
         # Если выбрана "без группы", запрашиваем ID пользователей
         context.user_data['group_id'] = None
         await query.edit_message_text("👥 Введите ID пользователей через пробел:")
         return BROADCAST_RECIPIENTS
-    elif group_id_str.startswith("select_group_"):
-        try:
-            group_id = int(group_id_str.split("_")[2])
-            conn = context.bot_data['conn']
-            group_name = get_group_by_id(conn, group_id)["group_name"]
-            context.user_data['group_id'] = group_id
-            await query.edit_message_text(f"✅ Выбрана группа *{group_name}*")
-        except (ValueError, IndexError):
-            await query.edit_message_text("❌ Ошибка: Неверный формат выбора группы.")
-            return BROADCAST_RECIPIENTS
-    else:
-        await query.edit_message_text("❌ Ошибка: Неподдерживаемый выбор.")
+    repo = context.bot_data['repo']
+    group = await repo.get_group_by_id(group_id)
+    if not group:
+        await query.edit_message_text("❌ Ошибка: группа не найдена.")
         return BROADCAST_RECIPIENTS
+    context.user_data['group_id'] = group_id
+    await query.edit_message_text(f"✅ Выбрана группа *{group['group_name']}*")
 
     # Переходим к выбору времени рассылки
     await query.message.reply_text("⏰ Введите дату и время рассылки в формате ДД.ММ.ГГ ЧЧ:ММ или /now для отправки сразу.")
@@ -204,7 +265,6 @@ async def broadcast_choose_group(update: Update, context: CallbackContext) -> in
 async def broadcast_recipients_input(update: Update, context: CallbackContext) -> int:
     """Обрабатывает ввод ID пользователей для рассылки."""
     user_id = update.effective_user.id
-    conn = context.bot_data['conn']
 
     if user_id == ADMIN_ID:
         # Админ вводит ID пользователей через пробел
@@ -220,15 +280,16 @@ async def broadcast_recipients_input(update: Update, context: CallbackContext) -
 
 async def broadcast_schedule(update: Update, context: CallbackContext) -> int:
     """Обрабатывает время отправки рассылки."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
 
-    if update.message.text.lower() == "/now":
+    send_now = update.message.text.lower() == "/now"
+    if send_now:
         send_time = datetime.now(pytz.UTC)
         send_time_utc = send_time  # Инициализируем send_time_utc
     else:
         try:
-            user_timezone_str = get_user_timezone(conn, user_id)
+            user_timezone_str = await repo.get_user_timezone(user_id)
             user_timezone = pytz.timezone(user_timezone_str)
             send_time = datetime.strptime(update.message.text.strip(), "%d.%m.%y %H:%M")
             send_time_localized = user_timezone.localize(send_time)
@@ -240,156 +301,135 @@ async def broadcast_schedule(update: Update, context: CallbackContext) -> int:
     # Получаем список получателей
     if context.user_data.get('group_id'):
         group_id = context.user_data['group_id']
-        recipients = ",".join(map(str, get_group_users(conn, group_id)))
+        # Недоступные получатели (заблокировали бота и т.п.) исключаются запросом
+        recipients = await repo.get_group_users(group_id, reachable_only=True)
+        skipped = await repo.get_group_unreachable_count(group_id)
+        context.bot_data['reachability'].note_skipped(skipped * len(group_send_batches(context.user_data['broadcast_messages'])))
     else:
-        recipients = context.user_data.get('recipients', '')
+        recipients = parse_user_ids(context.user_data.get('recipients'))
 
     # Сохраняем рассылку в базу данных
-    broadcast_id = insert_broadcast(
-        conn,
-        message_text="\n".join([msg['content'] for msg in context.user_data['broadcast_messages'] if msg['type'] == "text"]),
-        message_photo=next((msg['content'] for msg in context.user_data['broadcast_messages'] if msg['type'] == "photo"), None),
-        message_document=next((msg['content'] for msg in context.user_data['broadcast_messages'] if msg['type'] == "document"), None),
+    broadcast_id = await repo.insert_broadcast(
+        parts=context.user_data['broadcast_messages'],
         recipients=recipients,
-        send_time=send_time,
+        send_time=send_time_utc,
         creator_id=user_id
     )
 
-    if send_time == datetime.now(pytz.UTC):
-        # Отправляем рассылку сразу
-        context.job_queue.run_once(
-            send_broadcast,
-            0,  # Задержка 0 секунд (отправка сразу)
-            data={
-                'broadcast_id': broadcast_id,
-                'messages': context.user_data['broadcast_messages'],  # Передаем список сообщений
-                'recipients': recipients
-            }
-        )
+    # Задача сохраняется в БД: рассылка будет отправлена и после перезапуска бота
+    await context.bot_data['scheduler'].schedule(JOB_BROADCAST, broadcast_id, to_epoch(send_time_utc))
+    if send_now:
         await update.message.reply_text("✅ Рассылка отправлена.")
     else:
-        # Планируем рассылку
-        delay = (send_time_utc - datetime.now(pytz.UTC)).total_seconds()
-        context.job_queue.run_once(
-            send_broadcast,
-            delay,
-            data={
-                'broadcast_id': broadcast_id,
-                'messages': context.user_data['broadcast_messages'],  # Передаем список сообщений
-                'recipients': recipients
-            }
-        )
         await update.message.reply_text(f"✅ Рассылка запланирована на {send_time.strftime('%d.%m.%Y %H:%M')}.")
 
     # Очищаем данные
     context.user_data.clear()
     return ConversationHandler.END
 
-async def send_broadcast(context: CallbackContext) -> None:
-    """Отправляет рассылку."""
-    conn = context.bot_data['conn']
-    data = context.job.data
-
-    broadcast_id = data['broadcast_id']
-    messages = data['messages']
-    recipients = data.get('recipients', '')
-
-    # Проверяем, не была ли рассылка удалена
-    cursor = conn.cursor()
-    cursor.execute("SELECT is_deleted FROM broadcasts WHERE id = ?", (broadcast_id,))
-    result = cursor.fetchone()
-    if result and result[0]:  # Если рассылка помечена как удаленная
-        logger.info(f"Рассылка #{broadcast_id} была удалена и не будет отправлена.")
+async def send_broadcast(context: CallbackContext, broadcast_id: int) -> None:
+    """Отправляет рассылку (обработчик отложенной задачи JOB_BROADCAST)."""
+    repo = context.bot_data['repo']
+    parts = await repo.get_broadcast_parts(broadcast_id)
+    if not parts:
+        logger.error(f"У рассылки #{broadcast_id} нет сообщений для отправки.")
         return
+    batches = group_send_batches(parts)
+
+    delivery = context.bot_data['delivery']
+    reachability = context.bot_data['reachability']
+    bot = context.bot
+
+    def build_sends(user_id):
+        # Исходные сообщения автора копируются пакетами: один вызов на получателя
+        # для рассылки из одного чата, без повторной загрузки файлов
+        sends = []
+        for batch in batches:
+            if batch['kind'] == "copy":
+                sends.append(lambda b=batch: bot.copy_messages(
+                    chat_id=user_id, from_chat_id=b['chat_id'], message_ids=b['message_ids'], rate_limit_args=BULK))
+            elif batch['kind'] == "album":
+                sends.append(lambda b=batch: bot.send_media_group(
+                    chat_id=user_id, media=build_album(b), rate_limit_args=BULK))
+            else:
+                part = batch['part']
+                if part['type'] == "text":
+                    sends.append(lambda m=part: bot.send_message(chat_id=user_id, text=m['content'], rate_limit_args=BULK))
+                elif part['type'] == "photo":
+                    sends.append(lambda m=part: bot.send_photo(
+                        chat_id=user_id, photo=m['content'], caption=m.get('caption'), rate_limit_args=BULK))
+                elif part['type'] == "document":
+                    sends.append(lambda m=part: bot.send_document(
+                        chat_id=user_id, document=m['content'], caption=m.get('caption'), rate_limit_args=BULK))
+        return sends
+
+    async def deliver(user_id):
+        error = await delivery.deliver(user_id, build_sends(user_id))
+        if error:
+            logger.error(f"Ошибка при отправке рассылки пользователю {user_id}: {error}")
+        await repo.record_delivery(broadcast_id, user_id, DELIVERY_FAILED if error else DELIVERY_SENT,
+                                   str(error) if error else None)
+
+    # Получателей читаем страницами из broadcast_deliveries; после перезапуска
+    # в статусе pending остаются только те, кому рассылка еще не отправлена
+    started = time.monotonic()
+    after_user_id = None
+    while True:
+        # Проверяем, не была ли рассылка удалена (в том числе во время отправки)
+        if await repo.is_broadcast_deleted(broadcast_id):
+            logger.info(f"Рассылка #{broadcast_id} была удалена и не будет отправлена.")
+            return
 
-    user_ids = list(map(int, recipients.split(",")))
-
-    # Отправляем сообщения в том же порядке
-    for user_id in user_ids:
-        for message in messages:
-            try:
-                if message['type'] == "text":
-                    await context.bot.send_message(chat_id=user_id, text=message['content'])
-                elif message['type'] == "photo":
-                    await context.bot.send_photo(chat_id=user_id, photo=message['content'])
-                elif message['type'] == "document":
-                    await context.bot.send_document(chat_id=user_id, document=message['content'])
-            except Exception as e:
-                logger.error(f"Ошибка при отправке рассылки пользователю {user_id}: {e}")
+        user_ids = await repo.get_pending_deliveries(broadcast_id, after_user_id, BROADCAST_PAGE_SIZE)
+        if not user_ids:
+            break
+
+        # Недоступных пропускаем и здесь: явный список ID не фильтруется при планировании,
+        # а признак мог появиться уже после него
+        reachable, unreachable = [], []
+        for user_id in user_ids:
+            (unreachable if user_id in reachability else reachable).append(user_id)
+        if unreachable:
+            reachability.note_skipped(len(unreachable) * len(batches))
+            await asyncio.gather(*(repo.record_delivery(broadcast_id, user_id, DELIVERY_FAILED, "unreachable")
+                                   for user_id in unreachable))
+
+        # Получатели страницы обслуживаются параллельно в пределах ограничений DeliveryEngine
+        await asyncio.gather(*(deliver(user_id) for user_id in reachable))
+
+        after_user_id = user_ids[-1]
+        progress = await repo.get_broadcast_progress(broadcast_id)
+        elapsed = time.monotonic() - started
+        sent = progress.get(DELIVERY_SENT, 0)
+        logger.info(f"Рассылка #{broadcast_id}: отправлено {sent}, "
+                    f"ошибок {progress.get(DELIVERY_FAILED, 0)}, осталось {progress.get(DELIVERY_PENDING, 0)}; "
+                    f"{elapsed:.1f} с, {delivery.stats()['rate_per_sec']:.1f} сообщ/с")
 
     # Помечаем рассылку как удаленную
-    mark_broadcast_as_deleted(conn, broadcast_id)
-
-async def load_scheduled_broadcasts(job_queue: JobQueue):
-    """Загружает запланированные рассылки при запуске бота."""
-    conn = job_queue.application.bot_data['conn']
-    broadcasts = get_broadcasts(conn)
-
-    for broadcast in broadcasts:
-        broadcast_id, message_text, message_photo, message_document, recipients, send_time_str = broadcast
-
-        # Проверяем, не была ли рассылка удалена
-        cursor = conn.cursor()
-        cursor.execute("SELECT is_deleted FROM broadcasts WHERE id = ?", (broadcast_id,))
-        result = cursor.fetchone()
-        if result and result[0]:  # Если рассылка помечена как удаленная
-            logger.info(f"Рассылка #{broadcast_id} была удалена и не будет запланирована.")
-            continue
-
-        send_time = datetime.fromisoformat(send_time_str).replace(tzinfo=pytz.UTC)
-
-        # Если время рассылки уже прошло, удаляем её из базы данных
-        if send_time < datetime.now(pytz.UTC):
-            mark_broadcast_as_deleted(conn, broadcast_id)
-            continue
-
-        # Создаем список сообщений в порядке их получения
-        messages = []
-        if message_text:
-            messages.append({"type": "text", "content": message_text})
-        if message_photo:
-            messages.append({"type": "photo", "content": message_photo})
-        if message_document:
-            messages.append({"type": "document", "content": message_document})
-
-        # Вычисляем задержку до времени отправки
-        delay = (send_time - datetime.now(pytz.UTC)).total_seconds()
-
-        # Добавляем задачу в JobQueue
-        job_queue.run_once(
-            send_broadcast,
-            delay,
-            data={
-                'broadcast_id': broadcast_id,
-                'messages': messages,  # Передаем список сообщений
-                'recipients': recipients
-            }
-        )
-        logger.info(f"Рассылка #{broadcast_id} запланирована на {send_time}.")
+    await repo.mark_broadcast_as_deleted(broadcast_id)
 
-async def cancel_broadcast_button(update: Update, context: CallbackContext) -> int:
+async def cancel_broadcast_button(update: Update, context: CallbackContext, broadcast_id: int) -> int:
     """Обрабатывает выбор рассылки для удаления."""
     query = update.callback_query
     await query.answer()
-    broadcast_id = int(query.data.split("_")[2])
 
     # Создаем кнопки подтверждения
     keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data=f"confirm_cancel_broadcast_{broadcast_id}")],
-        [InlineKeyboardButton("❌ Нет", callback_data=f"cancel_cancel_broadcast_{broadcast_id}")]
+        [InlineKeyboardButton("✅ Да", callback_data=pack(CB_CONFIRM_CANCEL_BROADCAST, broadcast_id))],
+        [InlineKeyboardButton("❌ Нет", callback_data=pack(CB_CANCEL_CANCEL_BROADCAST, broadcast_id))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text("Подтвердите отмену рассылки:", reply_markup=reply_markup)
 
-async def confirm_cancel_broadcast(update: Update, context: CallbackContext) -> int:
+async def confirm_cancel_broadcast(update: Update, context: CallbackContext, broadcast_id: int) -> int:
     """Подтверждает отмену рассылки."""
     query = update.callback_query
     await query.answer()
-    broadcast_id = int(query.data.split("_")[3])
 
-    conn = context.bot_data['conn']
-    mark_broadcast_as_deleted(conn, broadcast_id)
+    repo = context.bot_data['repo']
+    await repo.mark_broadcast_as_deleted(broadcast_id)
+    await context.bot_data['scheduler'].cancel(JOB_BROADCAST, broadcast_id)
     await query.edit_message_text("✅ Рассылка успешно удалена.")
 
     context.user_data['chat_id'] = query.message.chat_id
@@ -398,11 +438,10 @@ async def confirm_cancel_broadcast(update: Update, context: CallbackContext) ->
 
     return ConversationHandler.END
 
-async def cancel_cancel_broadcast(update: Update, context: CallbackContext) -> int:
+async def cancel_cancel_broadcast(update: Update, context: CallbackContext, broadcast_id: int) -> int:
     """Отменяет отмену рассылки."""
     query = update.callback_query
     await query.answer()
-    broadcast_id = int(query.data.split("_")[3])
 
     await query.edit_message_text("❌ Отмена рассылки отменена.")
-    await broadcast_info_button(update, context)
\ No newline at end of file
+    await broadcast_info_button(update, context, broadcast_id)
\ No newline at end of file
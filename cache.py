@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+
+# Отличает отсутствие записи в кэше от закэшированного None
+MISSING = object()
+
+class LRUCache:
+    """Ограниченный кэш с вытеснением давно не использованных записей и сроком жизни.
+
+    Рассчитан на использование из одного потока (цикла событий), поэтому без блокировок.
+    Счетчик generation увеличивается при каждой инвалидации: чтение, начатое до
+    записи, передает в put() поколение на момент начала и не вернет в кэш
+    устаревшее значение.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (значение, момент истечения)
+
+    def get(self, key, default=MISSING):
+        """Возвращает значение по ключу или default, если записи нет или она устарела."""
+        item = self._data.get(key)
+        if item is not None:
+            value, expires = item
+            if expires is None or expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def put(self, key, value, generation: int | None = None):
+        """Сохраняет значение, если с момента generation не было инвалидаций."""
+        if self.maxsize <= 0 or (generation is not None and generation != self.generation):
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """Удаляет запись по ключу."""
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Удаляет все записи, счетчики сохраняются."""
+        self.generation += 1
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """Возвращает размер кэша и счетчики попаданий, промахов и вытеснений."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,264 @@
+"""Компактная callback_data inline-кнопок.
+
+Кнопка кодируется как "~" и base64url без выравнивания от байтов:
+    действие (1 байт) | аргументы
+Целые аргументы — varint (zigzag, чтобы проходили и отрицательные id
+чатов), строки — varint длины и UTF-8. Типы аргументов каждого действия
+заданы в ACTIONS, поэтому в самих данных их нет: confirm_delete_queue_123456
+занимает 7 символов вместо 27.
+
+Если аргументы не помещаются в 64 байта, которые Telegram допускает в
+callback_data, они сохраняются в LRU-хранилище на стороне бота, а в
+кнопку попадает действие с флагом STORED и короткий ключ. Ключи начинаются
+со случайного числа, чтобы кнопки, выданные до перезапуска, не совпали с
+новыми; вытесненный или потерянный при перезапуске ключ разбирается как
+неизвестная кнопка.
+
+Старые строки вида confirm_delete_queue_123 (кнопки в уже отправленных
+сообщениях) по-прежнему разбираются по префиксному дереву слов.
+"""
+import base64
+import secrets
+import config
+from cache import LRUCache, MISSING
+from varint import encode_varint, decode_varint, zigzag, unzigzag
+from varibles import JOIN_QUEUE_PAYLOAD, JOIN_GROUP_PAYLOAD, CALLBACK_STORE_SIZE
+
+CALLBACK_MARKER = "~"  # старые строки начинаются с буквы
+CALLBACK_DATA_LIMIT = 64
+STORED = 0x80          # флаг в байте действия: аргументы в хранилище, дальше — ключ
+
+# Коды действий (младшие 7 бит первого байта); менять у существующих нельзя —
+# они записаны в кнопки уже отправленных сообщений
+CB_MAIN_MENU = 1
+CB_BACK_TO_MAIN_MENU = 2
+CB_SHOW_QUEUES = 3
+CB_SHOW_GROUPS = 4
+CB_SHOW_BROADCASTS = 5
+CB_CHANGE_NAME = 6
+CB_SELECT_TIMEZONE = 7
+CB_HELP = 8
+CB_CREATE_QUEUE = 10
+CB_CREATE_GROUP = 11
+CB_CREATE_BROADCAST = 12
+CB_QUEUE_INFO = 20
+CB_JOIN_QUEUE = 21
+CB_SKIP = 22
+CB_CONFIRM_SKIP = 23
+CB_CANCEL_SKIP = 24
+CB_LEAVE_QUEUE = 25
+CB_CONFIRM_LEAVE_QUEUE = 26
+CB_CANCEL_LEAVE_QUEUE = 27
+CB_DELETE_QUEUE = 28
+CB_CONFIRM_DELETE_QUEUE = 29
+CB_CANCEL_DELETE_QUEUE = 30
+CB_INVITE_QUEUE = 31
+CB_GROUP_INFO = 40
+CB_JOIN_GROUP = 41
+CB_LEAVE_GROUP = 42
+CB_CONFIRM_LEAVE_GROUP = 43
+CB_CANCEL_LEAVE_GROUP = 44
+CB_DELETE_GROUP = 45
+CB_CONFIRM_DELETE_GROUP = 46
+CB_CANCEL_DELETE_GROUP = 47
+CB_INVITE_GROUP = 48
+CB_BROADCAST_INFO = 60
+CB_CANCEL_BROADCAST = 61
+CB_CONFIRM_CANCEL_BROADCAST = 62
+CB_CANCEL_CANCEL_BROADCAST = 63
+CB_LOCATION = 80
+CB_LOCATION_CUSTOM = 81
+CB_SELECT_GROUP = 82
+CB_SELECT_GROUP_NONE = 83
+CB_SEND_NOTIFICATION = 84
+CB_SELECT_TZ = 85
+CB_SELECT_LOCATION_TZ = 86
+
+# Действие -> (старый префикс callback_data, типы аргументов)
+ACTIONS = {
+    CB_MAIN_MENU: ("main_menu",),
+    CB_BACK_TO_MAIN_MENU: ("back_to_main_menu",),
+    CB_SHOW_QUEUES: ("show_queues",),
+    CB_SHOW_GROUPS: ("show_groups",),
+    CB_SHOW_BROADCASTS: ("show_broadcasts",),
+    CB_CHANGE_NAME: ("change_name",),
+    CB_SELECT_TIMEZONE: ("select_timezone",),
+    CB_HELP: ("help",),
+    CB_CREATE_QUEUE: ("create_queue",),
+    CB_CREATE_GROUP: ("create_group",),
+    CB_CREATE_BROADCAST: ("create_broadcast",),
+    CB_QUEUE_INFO: ("queue_info", int),
+    CB_JOIN_QUEUE: (JOIN_QUEUE_PAYLOAD.rstrip("_"), int),
+    CB_SKIP: ("skip", int),
+    CB_CONFIRM_SKIP: ("confirm_skip", int),
+    CB_CANCEL_SKIP: ("cancel_skip", int),
+    CB_LEAVE_QUEUE: ("leave_queue", int),
+    CB_CONFIRM_LEAVE_QUEUE: ("confirm_leave_queue", int),
+    CB_CANCEL_LEAVE_QUEUE: ("cancel_leave_queue", int),
+    CB_DELETE_QUEUE: ("delete_queue", int),
+    CB_CONFIRM_DELETE_QUEUE: ("confirm_delete_queue", int),
+    CB_CANCEL_DELETE_QUEUE: ("cancel_delete_queue", int),
+    CB_INVITE_QUEUE: ("invite_queue", int),
+    CB_GROUP_INFO: ("group_info", int),
+    CB_JOIN_GROUP: (JOIN_GROUP_PAYLOAD.rstrip("_"), int),
+    CB_LEAVE_GROUP: ("leave_group", int),
+    CB_CONFIRM_LEAVE_GROUP: ("confirm_leave_group", int),
+    CB_CANCEL_LEAVE_GROUP: ("cancel_leave_group", int),
+    CB_DELETE_GROUP: ("delete_group", int),
+    CB_CONFIRM_DELETE_GROUP: ("confirm_delete_group", int),
+    CB_CANCEL_DELETE_GROUP: ("cancel_delete_group", int),
+    CB_INVITE_GROUP: ("invite_group", int),
+    CB_BROADCAST_INFO: ("broadcast_info", int),
+    CB_CANCEL_BROADCAST: ("cancel_broadcast", int),
+    CB_CONFIRM_CANCEL_BROADCAST: ("confirm_cancel_broadcast", int),
+    CB_CANCEL_CANCEL_BROADCAST: ("cancel_cancel_broadcast", int),
+    CB_LOCATION: ("location", int),
+    CB_LOCATION_CUSTOM: ("location_custom",),
+    CB_SELECT_GROUP: ("select_group", int),
+    CB_SELECT_GROUP_NONE: ("select_group_none",),
+    CB_SEND_NOTIFICATION: ("send_notification", str),
+    CB_SELECT_TZ: ("select_tz", str),
+    CB_SELECT_LOCATION_TZ: ("select_location_tz",),
+}
+
+def _b64(body: bytes) -> str:
+    return CALLBACK_MARKER + base64.urlsafe_b64encode(body).rstrip(b"=").decode()
+
+class _Node:
+    __slots__ = ("children", "actions")
+
+    def __init__(self):
+        self.children = {}  # слово -> _Node
+        self.actions = {}   # число аргументов -> код действия
+
+class CallbackCodec:
+    """Кодирует нажатия кнопок в компактную callback_data и разбирает ее обратно."""
+
+    def __init__(self, actions: dict, store_size: int | None = None):
+        self.actions = actions
+        self._root = _Node()
+        for action, (prefix, *types) in actions.items():
+            if not 0 < action < STORED:
+                raise ValueError(f"Код действия {action} вне диапазона 1..127")
+            node = self._root
+            for word in prefix.split("_"):
+                node = node.children.setdefault(word, _Node())
+            node.actions[len(types)] = action
+        self.store = LRUCache(store_size if store_size is not None else getattr(config, "CALLBACK_STORE_SIZE", CALLBACK_STORE_SIZE))
+        self._next_key = secrets.randbits(32)
+        self._last = (None, None)  # (data, результат) последнего разбора
+        self.stored = 0
+        self.legacy = 0
+        self.invalid = 0
+
+    def pack(self, action: int, *args) -> str:
+        """Возвращает callback_data для действия с аргументами типов из ACTIONS."""
+        _, *types = self.actions[action]
+        if len(args) != len(types):
+            raise ValueError(f"Действию {action} нужно аргументов: {len(types)}, передано {len(args)}")
+        body = bytearray([action])
+        for kind, arg in zip(types, args):
+            if kind is int:
+                encode_varint(zigzag(arg), body)
+            else:
+                raw = str(arg).encode()
+                encode_varint(len(raw), body)
+                body += raw
+        data = _b64(body)
+        if len(data) <= CALLBACK_DATA_LIMIT:
+            return data
+        if self.store.maxsize <= 0:
+            raise ValueError(f"callback_data не помещается в {CALLBACK_DATA_LIMIT} байт, а хранилище отключено")
+        key, self._next_key = self._next_key, self._next_key + 1
+        self.store.put(key, (action, tuple(args)))
+        self.stored += 1
+        body = bytearray([action | STORED])
+        encode_varint(key, body)
+        return _b64(body)
+
+    def unpack(self, data: str | None) -> tuple[int, tuple] | None:
+        """Возвращает (действие, аргументы) или None для неизвестной или поврежденной кнопки.
+
+        Результат последнего разбора запоминается: фильтр обработчика и сам
+        обработчик получают одно и то же нажатие подряд и разбирают его один раз.
+        """
+        last_data, last = self._last
+        if data == last_data:
+            return last
+        if not data:
+            result = None
+        elif data[0] == CALLBACK_MARKER:
+            result = self._unpack_compact(data[1:])
+        else:
+            result = self._unpack_legacy(data)
+            if result is not None:
+                self.legacy += 1
+        if result is None:
+            self.invalid += 1
+        self._last = (data, result)
+        return result
+
+    def _unpack_compact(self, text: str) -> tuple[int, tuple] | None:
+        try:
+            body = base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+            action = body[0]
+            if action & STORED:
+                key, offset = decode_varint(body, 1)
+                stored = self.store.get(key)
+                if stored is MISSING or stored[0] != action & ~STORED or offset != len(body):
+                    return None
+                return stored
+            _, *types = self.actions[action]
+            args, offset = [], 1
+            for kind in types:
+                value, offset = decode_varint(body, offset)
+                if kind is int:
+                    args.append(unzigzag(value))
+                else:
+                    if offset + value > len(body):
+                        return None
+                    args.append(body[offset:offset + value].decode())
+                    offset += value
+            if offset != len(body):
+                return None
+            return action, tuple(args)
+        except (ValueError, IndexError, KeyError):
+            return None
+
+    def _unpack_legacy(self, data: str) -> tuple[int, tuple] | None:
+        # Самый длинный префикс, у которого есть действие с подходящим числом аргументов
+        words = data.split("_")
+        node, found = self._root, None
+        for depth, word in enumerate(words):
+            node = node.children.get(word)
+            if node is None:
+                break
+            action = node.actions.get(len(words) - depth - 1)
+            if action is not None:
+                found = (action, depth + 1)
+        if found is None:
+            return None
+        action, depth = found
+        try:
+            return action, tuple(kind(word) for kind, word in zip(self.actions[action][1:], words[depth:]))
+        except ValueError:
+            return None
+
+    def name(self, action: int) -> str:
+        """Старый префикс действия — читаемое имя для логов."""
+        return self.actions[action][0]
+
+    def stats(self) -> dict:
+        """Размер хранилища длинных аргументов и счетчики разбора."""
+        return {
+            "stored": self.stored,
+            "store_size": len(self.store),
+            "legacy": self.legacy,
+            "invalid": self.invalid,
+        }
+
+callbacks = CallbackCodec(ACTIONS)
+
+def pack(action: int, *args) -> str:
+    """callback_data для кнопки: pack(CB_CONFIRM_DELETE_QUEUE, queue_id)."""
+    return callbacks.pack(action, *args)
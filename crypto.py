@@ -1,23 +1,126 @@
-from Crypto.Cipher import AES
+"""Токены приглашений в deeplink.
+
+Токен — base64url без выравнивания от байтов:
+    версия и флаги (1 байт) | значения varint | [срок действия varint] | подпись
+Подпись — первые TOKEN_TAG_SIZE байт HMAC-SHA256 от назначения (префикса
+payload, например "join_queue_") и всех байтов перед ней, поэтому токен
+очереди нельзя подставить в приглашение в группу. Ключ HMAC выводится из
+SECRET_KEY один раз; на каждый вызов копируется уже проинициализированный
+HMAC. Приглашение в очередь занимает около 35 символов из 64, которые
+Telegram допускает в параметре start.
+
+Старые токены (32 hex-символа AES-ECB) по-прежнему принимаются.
+"""
+import base64
 import hashlib
+import hmac
+import time
+from Crypto.Cipher import AES
+import config
 from config import SECRET_KEY
+from cache import LRUCache, MISSING
+from varint import encode_varint, decode_varint
+from varibles import TOKEN_CACHE_SIZE, TOKEN_TAG_SIZE, INVITE_TOKEN_TTL
+
+TOKEN_VERSION = 1
+FLAG_EXPIRES = 0x01
+START_PARAMETER_LIMIT = 64
+
+class TokenExpired(ValueError):
+    """Подпись верна, но срок действия токена истек."""
+
+class TokenCodec:
+    """Подписанные компактные токены из целых чисел с кэшем проверенных токенов."""
+
+    def __init__(self, secret: bytes | str, tag_size: int | None = None, cache_size: int | None = None):
+        secret = secret.encode() if isinstance(secret, str) else secret
+        self._tag_size = tag_size or getattr(config, "TOKEN_TAG_SIZE", TOKEN_TAG_SIZE)
+        self._mac = hmac.new(hashlib.sha256(b"invite-token:" + secret).digest(), digestmod=hashlib.sha256)
+        self._secret = secret
+        self._legacy_cipher = None
+        self.cache = LRUCache(cache_size if cache_size is not None else getattr(config, "TOKEN_CACHE_SIZE", TOKEN_CACHE_SIZE))
+
+    def _sign(self, purpose: str, body: bytes) -> bytes:
+        mac = self._mac.copy()
+        mac.update(purpose.encode())
+        mac.update(body)
+        return mac.digest()[:self._tag_size]
+
+    def encode(self, purpose: str, *values: int, ttl: int | None = None) -> str:
+        """Кодирует значения в токен; ttl — срок действия в секундах (None — бессрочно)."""
+        body = bytearray([TOKEN_VERSION << 4 | (FLAG_EXPIRES if ttl else 0)])
+        for value in values:
+            encode_varint(value, body)
+        if ttl:
+            encode_varint(int(time.time()) + ttl, body)
+        token = base64.urlsafe_b64encode(bytes(body) + self._sign(purpose, body)).rstrip(b"=").decode()
+        if len(purpose) + len(token) > START_PARAMETER_LIMIT:
+            raise ValueError(f"Токен не помещается в параметр start: {len(purpose) + len(token)} символов")
+        return token
+
+    def decode(self, purpose: str, token: str) -> tuple[int, ...]:
+        """Проверяет токен и возвращает его значения. Ошибки — ValueError (TokenExpired для истекших)."""
+        cached = self.cache.get((purpose, token))
+        if cached is not MISSING:
+            values, expires = cached
+        else:
+            try:
+                values, expires = self._verify(purpose, token)
+            except ValueError:
+                if len(token) != 32:
+                    raise
+                values, expires = self._decode_legacy(token), None
+            self.cache.put((purpose, token), (values, expires))
+        if expires is not None and expires <= time.time():
+            raise TokenExpired("Срок действия токена истек")
+        return values
+
+    def _verify(self, purpose: str, token: str) -> tuple[tuple[int, ...], int | None]:
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except (ValueError, TypeError):
+            raise ValueError("Поврежденный токен")
+        body, tag = raw[:-self._tag_size], raw[-self._tag_size:]
+        if not body or not hmac.compare_digest(tag, self._sign(purpose, body)):
+            raise ValueError("Неверная подпись токена")
+        if body[0] >> 4 != TOKEN_VERSION:
+            raise ValueError(f"Неизвестная версия токена: {body[0] >> 4}")
+        offset, values = 1, []
+        while offset < len(body):
+            value, offset = decode_varint(body, offset)
+            values.append(value)
+        expires = values.pop() if body[0] & FLAG_EXPIRES and values else None
+        return tuple(values), expires
+
+    def _decode_legacy(self, token: str) -> tuple[int, int]:
+        # Формат до версии 1: AES-ECB от "id:creator_id" с PKCS7, 16 байт в hex
+        if self._legacy_cipher is None:
+            self._legacy_cipher = AES.new(self._secret, AES.MODE_ECB)
+        try:
+            decrypted = self._legacy_cipher.decrypt(bytes.fromhex(token)).decode()
+            queue_id, creator_id = decrypted[:-ord(decrypted[-1])].split(":")
+            return int(queue_id), int(creator_id)
+        except (ValueError, UnicodeDecodeError, IndexError):
+            raise ValueError("Поврежденный токен")
 
+    def stats(self) -> dict:
+        return self.cache.stats()
 
-def pad(s):
-    return s + (16 - len(s) % 16) * chr(16 - len(s) % 16)
+invite_tokens = TokenCodec(SECRET_KEY)
 
-def unpad(s):
-    return s[:-ord(s[-1])]
+def encode_invite(purpose: str, target_id: int, creator_id: int, invite_id: int | None = None) -> str:
+    """Токен приглашения для deeplink с префиксом purpose (JOIN_QUEUE_PAYLOAD или JOIN_GROUP_PAYLOAD).
 
-def encrypt_data(queue_id, creator_id):
-    data = f"{queue_id}:{creator_id}"
-    cipher = AES.new(SECRET_KEY, AES.MODE_ECB)
-    encrypted = cipher.encrypt(pad(data).encode())
-    return encrypted.hex()[:32]
+    invite_id — запись в таблице invites, если у приглашения есть лимит использований и срок.
+    """
+    values = (target_id, creator_id) if invite_id is None else (target_id, creator_id, invite_id)
+    return invite_tokens.encode(purpose, *values, ttl=getattr(config, "INVITE_TOKEN_TTL", INVITE_TOKEN_TTL))
 
-def decrypt_data(encrypted_data):
-    encrypted_data = bytes.fromhex(encrypted_data)
-    cipher = AES.new(SECRET_KEY, AES.MODE_ECB)
-    decrypted = unpad(cipher.decrypt(encrypted_data).decode())
-    queue_id, creator_id = decrypted.split(":")
-    return int(queue_id), int(creator_id)
\ No newline at end of file
+def decode_invite(purpose: str, token: str) -> tuple[int, int, int | None]:
+    """Возвращает (target_id, creator_id, invite_id или None) из токена приглашения или бросает ValueError."""
+    values = invite_tokens.decode(purpose, token)
+    if len(values) == 2:
+        return values[0], values[1], None
+    if len(values) == 3:
+        return values
+    raise ValueError("Неверное число значений в токене")
@@ -1,119 +1,127 @@
+import re
 import sqlite3
 import logging
+from dataclasses import dataclass, field
 from datetime import datetime
 from config import DATABASE_NAME, ADMIN_ID
+from varibles import QUEUE_LIFETIME
 import pytz
 
-TABLES_SCHEMA = {
-    'users': [
-        ('user_id', 'INTEGER', True, False),
-        ('name', 'TEXT', False, True),
-        ('state', 'TEXT', False, True),
-        ('time_zone', 'TEXT', False, True)
-    ],
-    'queues': [
-        ('queue_id', 'INTEGER', True, False),
-        ('queue_name', 'TEXT', False, False),
-        ('start_time', 'TEXT', False, True),
-        ('latitude', 'REAL', False, True),
-        ('longitude', 'REAL', False, True),
-        ('creator_id', 'INTEGER', False, True),
-        ('group_id', 'INTEGER', False, True),
-        ('time_without_location', 'TEXT', False, True)
-    ],
-    'queue_users': [
-        ('queue_id', 'INTEGER', False, False),
-        ('user_id', 'INTEGER', False, False),
-        ('join_time', 'TEXT', False, False)
-    ],
-    'groups': [
-        ('group_id', 'INTEGER', True, False),
-        ('group_name', 'TEXT', False, False),
-        ('creator_id', 'INTEGER', False, True)
-    ],
-    'group_users': [
-        ('group_id', 'INTEGER', False, False),
-        ('user_id', 'INTEGER', False, False)
-    ],
-    'broadcasts': [
-        ('id', 'INTEGER', True, False),
-        ('message_text', 'TEXT', False, True),
-        ('message_photo', 'TEXT', False, True),
-        ('message_document', 'TEXT', False, True),
-        ('recipients', 'TEXT', False, True),
-        ('send_time', 'TEXT', False, True),
-        ('creator_id', 'INTEGER', False, True),
-        ('is_deleted', 'BOOLEAN', False, False)
-    ]
-}
-
 logger = logging.getLogger(__name__)
 
-def create_connection():
-    """Создает подключение к базе данных SQLite."""
+# Шаг между соседними позициями в очереди: оставляет место для вставки между ними
+POSITION_GAP = 1024
+
+# Состояния доставки рассылки получателю (broadcast_deliveries.status)
+DELIVERY_PENDING = "pending"
+DELIVERY_SENT = "sent"
+DELIVERY_FAILED = "failed"
+
+# Виды отложенных задач (scheduled_jobs.kind)
+JOB_BROADCAST = "broadcast"
+JOB_DELETE_QUEUE = "delete_queue"
+
+@dataclass
+class QueueSnapshot:
+    """Очередь целиком: данные, участники по порядку и членство смотрящего."""
+    queue_id: int
+    queue_name: str
+    start_ts: int | None
+    latitude: float | None
+    longitude: float | None
+    creator_id: int | None
+    group_id: int | None
+    time_without_location_ts: int | None
+    members: list[tuple[int, str | None]] = field(default_factory=list)  # (user_id, имя)
+    viewer_is_member: bool = False
+
+    @property
+    def start_time(self) -> datetime | None:
+        return from_epoch(self.start_ts)
+
+    @property
+    def time_without_location(self) -> datetime | None:
+        return from_epoch(self.time_without_location_ts)
+
+@dataclass
+class GroupSnapshot:
+    """Группа целиком: данные, участники и членство смотрящего."""
+    group_id: int
+    group_name: str
+    creator_id: int | None
+    members: list[tuple[int, str | None]] = field(default_factory=list)  # (user_id, имя)
+    viewer_is_member: bool = False
+
+@dataclass
+class UserProfile:
+    """Запись пользователя: имя, состояние и часовой пояс."""
+    user_id: int
+    name: str | None
+    state: str | None
+    time_zone: str | None
+
+def parse_user_ids(text: str | None) -> list[int]:
+    """Разбирает список ID пользователей, разделенных пробелами или запятыми, без повторов."""
+    return list(dict.fromkeys(int(part) for part in re.split(r"[\s,]+", text or "") if part.lstrip("-").isdigit()))
+
+def to_epoch(moment: datetime | None) -> int | None:
+    """Переводит datetime в целые секунды UTC для хранения. Время без пояса считается UTC."""
+    if moment is None:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=pytz.UTC)
+    return int(moment.timestamp())
+
+def from_epoch(ts: int | None) -> datetime | None:
+    """Переводит сохраненные секунды UTC в datetime с часовым поясом UTC."""
+    return datetime.fromtimestamp(ts, pytz.UTC) if ts is not None else None
+
+REPORTED_PRAGMAS = ('journal_mode', 'synchronous', 'busy_timeout', 'cache_size', 'mmap_size', 'temp_store', 'foreign_keys', 'query_only')
+
+class BatchingConnection(sqlite3.Connection):
+    """Подключение, у которого commit() откладывается на время групповой транзакции.
+
+    Функции этого модуля сами вызывают conn.commit(); пока deferred = True,
+    этот вызов ничего не делает, и фиксирует изменения тот, кто открыл транзакцию.
+    """
+    deferred = False
+
+    def commit(self):
+        if not self.deferred:
+            super().commit()
+
+def create_connection(database: str = DATABASE_NAME, pragmas: dict | None = None, read_only: bool = False, factory=sqlite3.Connection):
+    """Создает подключение к базе данных SQLite и применяет PRAGMA-настройки."""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
-        logger.info(f"Подключение к базе данных {DATABASE_NAME} выполнено успешно")
+        # Каждое подключение используется только одним потоком Repository,
+        # но закрываться может из другого, поэтому проверку потока отключаем
+        conn = sqlite3.connect(database, check_same_thread=False, factory=factory)
+        conn.execute("PRAGMA foreign_keys = ON")  # Каскадное удаление описано в схеме
+        for name, value in (pragmas or {}).items():
+            if read_only and name == 'journal_mode':
+                continue  # Режим журнала переключает только подключение на запись
+            conn.execute(f"PRAGMA {name} = {value}")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        logger.info(f"Подключение к базе данных {database} выполнено успешно")
     except sqlite3.Error as e:
         logger.error(f"Ошибка при подключении к базе данных: {e}")
     return conn
 
-def create_tables(conn):
-    """Создает таблицы в базе данных на основе схемы TABLES_SCHEMA."""
+def get_pragmas(conn) -> dict:
+    """Возвращает текущие значения основных PRAGMA подключения."""
     try:
         cursor = conn.cursor()
-        
-        for table_name, columns in TABLES_SCHEMA.items():
-            # Формируем SQL для создания таблицы
-            columns_sql = []
-            primary_keys = []
-            
-            for column in columns:
-                name, type_, is_pk, is_nullable = column
-                column_sql = f"{name} {type_}"
-                if is_pk:
-                    if type_ == 'INTEGER':
-                        column_sql += " PRIMARY KEY AUTOINCREMENT"
-                    else:
-                        primary_keys.append(name)
-                if not is_nullable:
-                    column_sql += " NOT NULL"
-                
-                columns_sql.append(column_sql)
-            
-            if primary_keys:
-                columns_sql.append(f"PRIMARY KEY ({', '.join(primary_keys)})")
-            
-            # Создаем таблицу
-            create_sql = f"""
-                CREATE TABLE IF NOT EXISTS {table_name} (
-                    {', '.join(columns_sql)}
-                )
-            """
-            cursor.execute(create_sql)
-            
-            # Создаем индексы для внешних ключей
-            if table_name == 'queue_users':
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_queue_users_queue ON queue_users(queue_id)
-                """)
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_queue_users_user ON queue_users(user_id)
-                """)
-            elif table_name == 'group_users':
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_group_users_group ON group_users(group_id)
-                """)
-                cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_group_users_user ON group_users(user_id)
-                """)
-        
-        conn.commit()
-        logger.info("Таблицы созданы успешно")
+        result = {}
+        for name in REPORTED_PRAGMAS:
+            cursor.execute(f"PRAGMA {name}")
+            row = cursor.fetchone()
+            result[name] = row[0] if row else None
+        return result
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при создании таблиц: {e}")
-        raise
+        logger.error(f"Ошибка при чтении PRAGMA: {e}")
+        return {}
 
 def insert_group(conn, group_name: str, creator_id: int) -> int | None:
     """Добавляет новую группу в базу данных."""
@@ -172,16 +180,10 @@ def get_group_id_by_name(conn, group_name: str) -> int | None:
         return None
 
 def delete_group_db(conn, group_id: int):
-    """Удаляет группу и связанные записи из базы данных."""
+    """Удаляет группу; участники удаляются каскадно, у очередей group_id сбрасывается в NULL."""
     try:
         cursor = conn.cursor()
-        # Удаляем записи из group_users
-        cursor.execute("DELETE FROM group_users WHERE group_id = ?", (group_id,))
-        # Удаляем записи из queues, связанные с этой группой (если нужно)
-        cursor.execute("UPDATE queues SET group_id = NULL WHERE group_id = ?", (group_id,))
-        # Удаляем саму группу
         cursor.execute("DELETE FROM groups WHERE group_id = ?", (group_id,))
-
         conn.commit()
         logger.info(f"Группа {group_id} и связанные данные удалены")
 
@@ -223,16 +225,124 @@ def remove_user_from_group(conn, group_id: int, user_id: int):
     except sqlite3.Error as e:
         logger.error(f"Ошибка при удалении пользователя из группы: {e}")
 
-def get_group_users(conn, group_id: int) -> list[int]:
-    """Получает список ID пользователей в группе."""
+def get_group_users(conn, group_id: int, reachable_only: bool = False) -> list[int]:
+    """Получает список ID пользователей в группе.
+
+    С reachable_only=True пропускает пользователей, отмеченных недоступными (users.unreachable).
+    """
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM group_users WHERE group_id = ?", (group_id,))
+        if reachable_only:
+            cursor.execute("""
+                SELECT group_users.user_id FROM group_users
+                LEFT JOIN users ON users.user_id = group_users.user_id
+                WHERE group_users.group_id = ? AND users.unreachable IS NULL
+            """, (group_id,))
+        else:
+            cursor.execute("SELECT user_id FROM group_users WHERE group_id = ?", (group_id,))
         results = cursor.fetchall()
         return [row[0] for row in results]
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении пользователей группы: {e}")
         return []
+
+def get_group_users_timezones(conn, group_id: int, reachable_only: bool = False) -> list[tuple]:
+    """Возвращает участников группы с часовыми поясами одним запросом: [(user_id, time_zone)]."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT group_users.user_id, users.time_zone FROM group_users
+            LEFT JOIN users ON users.user_id = group_users.user_id
+            WHERE group_users.group_id = ? {"AND users.unreachable IS NULL" if reachable_only else ""}
+        """, (group_id,))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении часовых поясов пользователей группы: {e}")
+        return []
+
+def get_group_unreachable_count(conn, group_id: int) -> int:
+    """Возвращает число участников группы, отмеченных недоступными."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*) FROM group_users
+            JOIN users ON users.user_id = group_users.user_id
+            WHERE group_users.group_id = ? AND users.unreachable IS NOT NULL
+        """, (group_id,))
+        return cursor.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при подсчете недоступных участников группы: {e}")
+        return 0
+
+def get_unreachable_user_ids(conn) -> list[int]:
+    """Возвращает ID пользователей, отмеченных недоступными."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT user_id FROM users WHERE unreachable IS NOT NULL")
+        return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении недоступных пользователей: {e}")
+        return []
+
+def get_unreachable_stats(conn) -> dict:
+    """Возвращает число недоступных пользователей по причинам: {причина: количество}."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT unreachable, COUNT(*) FROM users WHERE unreachable IS NOT NULL GROUP BY unreachable")
+        return dict(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении статистики недоступных пользователей: {e}")
+        return {}
+
+def mark_user_unreachable(conn, user_id: int, reason: str) -> bool:
+    """Отмечает пользователя недоступным для отправки с указанием причины."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE users SET unreachable = ?, unreachable_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE user_id = ?
+        """, (reason, user_id))
+        conn.commit()
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при отметке недоступного пользователя {user_id}: {e}")
+        return False
+
+def clear_user_unreachable(conn, user_id: int):
+    """Снимает с пользователя признак недоступности."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE users SET unreachable = NULL, unreachable_ts = NULL WHERE user_id = ?", (user_id,))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при снятии признака недоступности с пользователя {user_id}: {e}")
+
+def get_group_snapshot(conn, group_id: int, viewer_id: int | None = None) -> GroupSnapshot | None:
+    """Получает группу, ее участников с именами и членство viewer_id одним запросом."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT groups.group_name, groups.creator_id, group_users.user_id, users.name
+            FROM groups
+            LEFT JOIN group_users ON group_users.group_id = groups.group_id
+            LEFT JOIN users ON users.user_id = group_users.user_id
+            WHERE groups.group_id = ?
+        """, (group_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        members = [(row[2], row[3]) for row in rows if row[2] is not None]
+        return GroupSnapshot(
+            group_id=group_id,
+            group_name=rows[0][0],
+            creator_id=rows[0][1],
+            members=members,
+            viewer_is_member=any(user_id == viewer_id for user_id, _ in members),
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении снимка группы: {e}")
+        return None
+
 def get_all_groups(conn) -> list[dict]:
     """Возвращает список всех групп"""
     try:
@@ -249,17 +359,10 @@ def get_queues_by_group(conn, group_id: int | None) -> list[dict]:
     try:
         cursor = conn.cursor()
         if group_id is None:
-            cursor.execute("SELECT queue_id, queue_name, start_time FROM queues WHERE group_id IS NULL")
+            cursor.execute("SELECT queue_id, queue_name, start_ts FROM queues WHERE group_id IS NULL")
         else:
-            cursor.execute("SELECT queue_id, queue_name, start_time FROM queues WHERE group_id = ?", (group_id,))
-
-        results = cursor.fetchall()
-        converted_results = []
-        for row in results:
-            start_time_str = row[2]
-            start_time = datetime.fromisoformat(start_time_str) if start_time_str else None
-            converted_results.append({"queue_id": row[0], "queue_name": row[1], "start_time": start_time})
-        return converted_results
+            cursor.execute("SELECT queue_id, queue_name, start_ts FROM queues WHERE group_id = ?", (group_id,))
+        return [{"queue_id": row[0], "queue_name": row[1], "start_ts": row[2]} for row in cursor.fetchall()]
 
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении очередей для группы: {e}")
@@ -296,6 +399,36 @@ def update_user_state(conn, user_id: int, state: str):
     except sqlite3.Error as e:
         logger.error(f"Ошибка при обновлении состояния пользователя в базе данных: {e}")
 
+def get_user_profile(conn, user_id: int) -> UserProfile | None:
+    """Получает всю запись пользователя одним запросом.
+
+    Ошибку БД пробрасывает: иначе ее результат None попал бы в кэш профилей
+    как «пользователь не найден».
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, state, time_zone FROM users WHERE user_id = ?", (user_id,))
+        result = cursor.fetchone()
+        return UserProfile(user_id, *result) if result else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении профиля пользователя: {e}")
+        raise
+
+def get_user_profiles(conn, user_ids: list[int]) -> list[UserProfile]:
+    """Получает записи нескольких пользователей. Ошибку БД пробрасывает, как get_user_profile."""
+    try:
+        cursor = conn.cursor()
+        profiles = []
+        ids = list(user_ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            cursor.execute(f"SELECT user_id, name, state, time_zone FROM users WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk)
+            profiles.extend(UserProfile(*row) for row in cursor.fetchall())
+        return profiles
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении профилей пользователей: {e}")
+        raise
+
 def get_user_data(conn, user_id: int) -> tuple | None:
     """Получает данные пользователя (имя, состояние) из базы данных."""
     try:
@@ -342,15 +475,8 @@ def get_all_queues(conn) -> list[dict]:
     """Получает список всех очередей из базы данных."""
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT queue_name, queue_id, start_time FROM queues")
-        results = cursor.fetchall()
-
-        converted_results = []
-        for row in results:
-            start_time_str = row[2]
-            start_time = datetime.fromisoformat(start_time_str) if start_time_str else None
-            converted_results.append({"queue_name": row[0], "queue_id": row[1], "start_time": start_time})
-        return converted_results
+        cursor.execute("SELECT queue_name, queue_id, start_ts FROM queues")
+        return [{"queue_name": row[0], "queue_id": row[1], "start_ts": row[2]} for row in cursor.fetchall()]
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении списка очередей из базы данных: {e}")
         return []
@@ -359,45 +485,106 @@ def get_user_created_queues(conn, user_id: int) -> list[dict]:
     """Получает список очередей, созданных пользователем."""
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT queue_name, queue_id, start_time FROM queues WHERE creator_id = ?", (user_id,))
-        results = cursor.fetchall()
-        converted_results = []
-        for row in results:
-            start_time_str = row[2]
-            start_time = datetime.fromisoformat(start_time_str) if start_time_str else None
-            converted_results.append({"queue_name": row[0], "queue_id": row[1], "start_time": start_time})
-        return converted_results
+        cursor.execute("SELECT queue_name, queue_id, start_ts FROM queues WHERE creator_id = ?", (user_id,))
+        return [{"queue_name": row[0], "queue_id": row[1], "start_ts": row[2]} for row in cursor.fetchall()]
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении списка очередей, созданных пользователем: {e}")
         return []
 
-async def get_queue_by_id(conn, queue_id: int) -> dict | None:
+def get_queues_expiring_before(conn, before_ts: int) -> list[dict]:
+    """Возвращает очереди, срок жизни которых (QUEUE_LIFETIME от начала) истекает раньше before_ts."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT queue_id, queue_name, start_ts FROM queues WHERE start_ts < ? ORDER BY start_ts",
+                       (before_ts - QUEUE_LIFETIME,))
+        return [{"queue_id": row[0], "queue_name": row[1], "start_ts": row[2]} for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении истекающих очередей: {e}")
+        return []
+
+def get_queues_with_members(conn, queue_id: int | None = None) -> tuple[list[tuple], list[tuple], list[tuple]]:
+    """Возвращает очереди, их участников и геозоны для построения состояния в памяти.
+
+    Очереди — (queue_id, queue_name, start_ts, latitude, longitude, creator_id,
+    time_without_location_ts, radius), участники — (queue_id, user_id, position)
+    по порядку, вершины геозон — (queue_id, latitude, longitude) по порядку.
+    Если queue_id задан, только для этой очереди.
+    """
+    try:
+        cursor = conn.cursor()
+        where, params = ("WHERE queue_id = ?", (queue_id,)) if queue_id is not None else ("", ())
+        cursor.execute(f"""
+            SELECT queue_id, queue_name, start_ts, latitude, longitude, creator_id, time_without_location_ts, radius
+            FROM queues {where}
+        """, params)
+        queues = cursor.fetchall()
+        cursor.execute(f"SELECT queue_id, user_id, position FROM queue_users {where} ORDER BY queue_id, position", params)
+        members = cursor.fetchall()
+        cursor.execute(f"SELECT queue_id, latitude, longitude FROM queue_geofence {where} ORDER BY queue_id, vertex_no", params)
+        return queues, members, cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при загрузке очередей с участниками: {e}")
+        raise
+
+def get_queue_by_id(conn, queue_id: int) -> dict | None:
     """Получает информацию об очереди по её ID."""
     try:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT queue_name, start_time, latitude, longitude, creator_id, time_without_location 
+            SELECT queue_name, start_ts, latitude, longitude, creator_id, time_without_location_ts, radius
             FROM queues WHERE queue_id = ?
         """, (queue_id,))
         result = cursor.fetchone()
         if result:
-            start_time_str = result[1]
-            start_time = datetime.fromisoformat(start_time_str).replace(tzinfo=pytz.UTC) if start_time_str else None
-            time_without_location_str = result[5]
-            time_without_location = datetime.fromisoformat(time_without_location_str).replace(tzinfo=pytz.UTC) if time_without_location_str else None
             return {
                 "queue_name": result[0],
-                "start_time": start_time,
+                "start_ts": result[1],
                 "latitude": result[2],
                 "longitude": result[3],
                 "creator_id": result[4],
-                "time_without_location": time_without_location
+                "time_without_location_ts": result[5],
+                "radius": result[6]
             }
         return None
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении очереди из базы данных: {e}")
         return None
 
+def get_queue_snapshot(conn, queue_id: int, viewer_id: int | None = None) -> QueueSnapshot | None:
+    """Получает очередь, ее участников с именами по порядку и членство viewer_id одним запросом."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT queues.queue_name, queues.start_ts, queues.latitude, queues.longitude,
+                   queues.creator_id, queues.group_id, queues.time_without_location_ts,
+                   queue_users.user_id, users.name
+            FROM queues
+            LEFT JOIN queue_users ON queue_users.queue_id = queues.queue_id
+            LEFT JOIN users ON users.user_id = queue_users.user_id
+            WHERE queues.queue_id = ?
+            ORDER BY queue_users.position ASC
+        """, (queue_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        first = rows[0]
+        members = [(row[7], row[8]) for row in rows if row[7] is not None]
+        return QueueSnapshot(
+            queue_id=queue_id,
+            queue_name=first[0],
+            start_ts=first[1],
+            latitude=first[2],
+            longitude=first[3],
+            creator_id=first[4],
+            group_id=first[5],
+            time_without_location_ts=first[6],
+            members=members,
+            viewer_is_member=any(user_id == viewer_id for user_id, _ in members),
+        )
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении снимка очереди: {e}")
+        return None
+
 def get_queue_name_by_id(conn, queue_id: int) -> str | None:
     """Получает название очереди по ID."""
     try:
@@ -428,7 +615,7 @@ def get_queue_users_names(conn, queue_id: int) -> list[str]:
             SELECT users.name FROM users
             JOIN queue_users ON users.user_id = queue_users.user_id
             WHERE queue_users.queue_id = ?
-            ORDER BY queue_users.join_time ASC
+            ORDER BY queue_users.position ASC
         """, (queue_id,))
         results = cursor.fetchall()
         return [row[0] for row in results]
@@ -444,7 +631,7 @@ def get_queue_users_ids(conn, queue_id: int) -> list[int]:
             SELECT users.user_id FROM users
             JOIN queue_users ON users.user_id = queue_users.user_id
             WHERE queue_users.queue_id = ?
-            ORDER BY queue_users.join_time ASC
+            ORDER BY queue_users.position ASC
         """, (queue_id,))
         results = cursor.fetchall()
         return [row[0] for row in results]
@@ -493,88 +680,302 @@ def get_user_queues(conn, user_id: int) -> list[dict]:
         return []
 
 def delete_queue(conn, queue_id: int):
-    """Удаляет очередь и связанные записи из базы данных."""
+    """Удаляет очередь; участники удаляются каскадно."""
     try:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM queues WHERE queue_id = ?", (queue_id,))
-        cursor.execute("DELETE FROM queue_users WHERE queue_id = ?", (queue_id,))
         conn.commit()
         logger.info(f"Очередь с ID {queue_id} удалена из базы данных")
     except sqlite3.Error as e:
         logger.error(f"Ошибка при удалении очереди: {e}")
 
-def swap_queue_users(conn, queue_id: int, user1_id: int, user2_id: int):
-    """Меняет местами двух пользователей в очереди."""
+def swap_queue_users(conn, queue_id: int, user1_id: int, user2_id: int) -> bool:
+    """Меняет местами двух пользователей в очереди одним UPDATE. Возвращает True, если оба найдены."""
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT join_time FROM queue_users WHERE queue_id = ? AND user_id = ?", (queue_id, user1_id))
-        time1 = cursor.fetchone()[0]
-        cursor.execute("SELECT join_time FROM queue_users WHERE queue_id = ? AND user_id = ?", (queue_id, user2_id))
-        time2 = cursor.fetchone()[0]
-        cursor.execute("UPDATE queue_users SET join_time = ? WHERE queue_id = ? AND user_id = ?", (time2, queue_id, user1_id))
-        cursor.execute("UPDATE queue_users SET join_time = ? WHERE queue_id = ? AND user_id = ?", (time1, queue_id, user2_id))
+        cursor.execute("""
+            UPDATE queue_users SET position = swap.position
+            FROM (
+                SELECT a.user_id AS user_id, b.position AS position
+                FROM queue_users AS a
+                JOIN queue_users AS b ON b.queue_id = a.queue_id
+                    AND b.user_id = CASE a.user_id WHEN ? THEN ? ELSE ? END
+                WHERE a.queue_id = ? AND a.user_id IN (?, ?)
+            ) AS swap
+            WHERE queue_users.queue_id = ? AND queue_users.user_id = swap.user_id
+        """, (user1_id, user2_id, user1_id, queue_id, user1_id, user2_id, queue_id))
         conn.commit()
         logger.info(f"Пользователи {user1_id} и {user2_id} в очереди {queue_id} поменялись местами")
+        return cursor.rowcount == 2
     except sqlite3.Error as e:
         logger.error(f"Ошибка при перестановке пользователей: {e}")
+        return False
+
+def move_queue_user_to_end(conn, queue_id: int, user_id: int, position: int | None = None) -> bool:
+    """Перемещает пользователя в конец очереди одним UPDATE. Возвращает True, если он найден.
+
+    position — новый ключ порядка, по умолчанию больше последнего на POSITION_GAP.
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE queue_users
+            SET position = COALESCE(?, (SELECT MAX(position) FROM queue_users WHERE queue_id = ?) + ?)
+            WHERE queue_id = ? AND user_id = ?
+        """, (position, queue_id, POSITION_GAP, queue_id, user_id))
+        conn.commit()
+        logger.info(f"Пользователь {user_id} перемещен в конец очереди {queue_id}")
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при перемещении пользователя в конец очереди: {e}")
+        return False
+
+def move_queue_user_before(conn, queue_id: int, user_id: int, before_user_id: int, position: int | None = None) -> bool:
+    """Ставит пользователя в очереди непосредственно перед before_user_id. Возвращает True, если он перемещен.
+
+    По умолчанию новая позиция — середина между before_user_id и его
+    предшественником, один UPDATE по индексу (queue_id, position); очередь
+    перенумеровывается, только если свободной позиции между ними не осталось.
+    Заданная position проверяется только на то, что она свободна.
+    """
+    try:
+        cursor = conn.cursor()
+        if position is not None:
+            cursor.execute("""
+                UPDATE queue_users SET position = ?
+                WHERE queue_id = ? AND user_id = ?
+                  AND NOT EXISTS (SELECT 1 FROM queue_users AS taken
+                                  WHERE taken.queue_id = ? AND taken.position = ? AND taken.user_id != ?)
+            """, (position, queue_id, user_id, queue_id, position, user_id))
+        else:
+            for _ in range(2):
+                cursor.execute("""
+                    UPDATE queue_users SET position = target.position
+                    FROM (
+                        SELECT (before.position + COALESCE(
+                            (SELECT MAX(prev.position) FROM queue_users AS prev
+                             WHERE prev.queue_id = before.queue_id AND prev.position < before.position
+                               AND prev.user_id != ?),
+                            before.position - 2 * ?)) / 2 AS position,
+                            before.position AS upper
+                        FROM queue_users AS before
+                        WHERE before.queue_id = ? AND before.user_id = ?
+                    ) AS target
+                    WHERE queue_users.queue_id = ? AND queue_users.user_id = ? AND target.position < target.upper
+                      AND NOT EXISTS (SELECT 1 FROM queue_users AS taken
+                                      WHERE taken.queue_id = ? AND taken.position = target.position)
+                """, (user_id, POSITION_GAP, queue_id, before_user_id, queue_id, user_id, queue_id))
+                if cursor.rowcount:
+                    break
+                # Между соседями не осталось свободной позиции — перенумеровываем очередь
+                renumber_queue_positions(conn, queue_id)
+        moved = cursor.rowcount == 1
+        conn.commit()
+        if moved:
+            logger.info(f"Пользователь {user_id} поставлен перед {before_user_id} в очереди {queue_id}")
+        return moved
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при перемещении пользователя в очереди: {e}")
+        return False
+
+def renumber_queue_positions(conn, queue_id: int):
+    """Перенумеровывает позиции очереди с равным шагом POSITION_GAP (без commit)."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id FROM queue_users WHERE queue_id = ? ORDER BY position, user_id", (queue_id,))
+    user_ids = [row[0] for row in cursor.fetchall()]
+    cursor.executemany(
+        "UPDATE queue_users SET position = ? WHERE queue_id = ? AND user_id = ?",
+        [((index + 1) * POSITION_GAP, queue_id, user_id) for index, user_id in enumerate(user_ids)]
+    )
+
+def get_queue_user_position(conn, queue_id: int, user_id: int) -> int | None:
+    """Возвращает номер пользователя в очереди (с 1) или None, если его там нет."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT (SELECT COUNT(*) FROM queue_users AS ahead
+                    WHERE ahead.queue_id = me.queue_id AND ahead.position < me.position) + 1
+            FROM queue_users AS me
+            WHERE me.queue_id = ? AND me.user_id = ?
+        """, (queue_id, user_id))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении позиции пользователя в очереди: {e}")
+        return None
 
-def add_user_to_queue(conn, queue_id: int, user_id: int, join_time: str):
-    """Добавляет пользователя в очередь."""
+def get_next_queue_user(conn, queue_id: int, user_id: int) -> int | None:
+    """Возвращает ID пользователя, стоящего в очереди следующим за user_id."""
     try:
         cursor = conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO queue_users (queue_id, user_id, join_time) VALUES (?, ?, ?)", (queue_id, user_id, join_time))
+        cursor.execute("""
+            SELECT user_id FROM queue_users
+            WHERE queue_id = ? AND position > (
+                SELECT position FROM queue_users WHERE queue_id = ? AND user_id = ?
+            )
+            ORDER BY position
+            LIMIT 1
+        """, (queue_id, queue_id, user_id))
+        result = cursor.fetchone()
+        return result[0] if result else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении следующего пользователя в очереди: {e}")
+        return None
+
+def add_user_to_queue(conn, queue_id: int, user_id: int, join_ts: int | None = None, position: int | None = None) -> bool:
+    """Добавляет пользователя в очередь. Возвращает True, если запись добавлена.
+
+    join_ts — время входа в секундах UTC, по умолчанию текущее; position — ключ
+    порядка, по умолчанию в конец очереди.
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR IGNORE INTO queue_users (queue_id, user_id, join_ts, position)
+            SELECT ?, ?, COALESCE(?, CAST(strftime('%s', 'now') AS INTEGER)), COALESCE(?, COALESCE(MAX(position), 0) + ?)
+            FROM queue_users WHERE queue_id = ?
+        """, (queue_id, user_id, join_ts, position, POSITION_GAP, queue_id))
         conn.commit()
         logger.info(f"Пользователь {user_id} добавлен в очередь {queue_id}")
+        return cursor.rowcount == 1
     except sqlite3.Error as e:
         logger.error(f"Ошибка при добавлении пользователя в очередь: {e}")
+        return False
 
-def remove_user_from_queue(conn, queue_id: int, user_id: int):
-    """Удаляет пользователя из очереди."""
+def remove_user_from_queue(conn, queue_id: int, user_id: int) -> bool:
+    """Удаляет пользователя из очереди. Возвращает True, если запись была."""
     try:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM queue_users WHERE queue_id = ? AND user_id = ?", (queue_id, user_id))
         conn.commit()
         logger.info(f"Пользователь {user_id} удален из очереди {queue_id}")
+        return cursor.rowcount == 1
     except sqlite3.Error as e:
         logger.error(f"Ошибка при удалении пользователя из очереди: {e}")
+        return False
         
 def get_broadcasts(conn, user_id: int = None):
-    """Получает список активных рассылок из базы данных."""
+    """Получает список активных рассылок: (id, send_ts, тип и содержимое первой части)."""
     try:
         cursor = conn.cursor()
         if user_id:
             # Для обычного пользователя — только его рассылки
             cursor.execute("""
-                SELECT id, message_text, message_photo, message_document, recipients, send_time 
-                FROM broadcasts 
-                WHERE creator_id = ? AND is_deleted = FALSE
+                SELECT broadcasts.id, broadcasts.send_ts, broadcast_parts.type, broadcast_parts.content
+                FROM broadcasts
+                LEFT JOIN broadcast_parts ON broadcast_parts.broadcast_id = broadcasts.id AND broadcast_parts.part_no = 0
+                WHERE broadcasts.creator_id = ? AND broadcasts.is_deleted = FALSE
             """, (user_id,))
         else:
             # Для админа — все активные рассылки
             cursor.execute("""
-                SELECT id, message_text, message_photo, message_document, recipients, send_time 
-                FROM broadcasts 
-                WHERE is_deleted = FALSE
+                SELECT broadcasts.id, broadcasts.send_ts, broadcast_parts.type, broadcast_parts.content
+                FROM broadcasts
+                LEFT JOIN broadcast_parts ON broadcast_parts.broadcast_id = broadcasts.id AND broadcast_parts.part_no = 0
+                WHERE broadcasts.is_deleted = FALSE
             """)
         return cursor.fetchall()
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении рассылок: {e}")
         return []
     
-def insert_broadcast(conn, message_text: str, message_photo: str, message_document: str, recipients: str, send_time: datetime, creator_id: int):
-    """Вставляет данные о рассылке в базу данных."""
+def insert_broadcast(conn, parts: list[dict], recipients: list[int], send_time: datetime, creator_id: int):
+    """Вставляет рассылку, ее части по порядку и получателей со статусом pending.
+
+    Часть — словарь с ключами chat_id и message_id (исходное сообщение автора,
+    которое копируется получателям), type и content (для просмотра).
+    """
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO broadcasts (message_text, message_photo, message_document, recipients, send_time, creator_id) VALUES (?, ?, ?, ?, ?, ?)",
-            (message_text, message_photo, message_document, recipients, send_time.isoformat(), creator_id)
+        cursor.execute("INSERT INTO broadcasts (send_ts, creator_id) VALUES (?, ?)", (to_epoch(send_time), creator_id))
+        broadcast_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO broadcast_parts (broadcast_id, part_no, chat_id, message_id, type, content) VALUES (?, ?, ?, ?, ?, ?)",
+            ((broadcast_id, part_no, part.get('chat_id'), part.get('message_id'), part['type'], part.get('content'))
+             for part_no, part in enumerate(parts))
+        )
+        cursor.executemany(
+            "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id) VALUES (?, ?)",
+            ((broadcast_id, user_id) for user_id in recipients)
         )
         conn.commit()
-        return cursor.lastrowid
+        return broadcast_id
     except sqlite3.Error as e:
         logger.error(f"Ошибка при добавлении рассылки: {e}")
         return None
 
+def get_pending_deliveries(conn, broadcast_id: int, after_user_id: int | None = None, limit: int = 500) -> list[int]:
+    """Возвращает следующую страницу получателей, которым рассылка еще не отправлена.
+
+    Страницы идут по возрастанию user_id: следующая начинается после
+    последнего ID предыдущей, поэтому память не зависит от числа получателей.
+    """
+    try:
+        cursor = conn.cursor()
+        if after_user_id is None:
+            cursor.execute("""
+                SELECT user_id FROM broadcast_deliveries
+                WHERE broadcast_id = ? AND status = ?
+                ORDER BY user_id LIMIT ?
+            """, (broadcast_id, DELIVERY_PENDING, limit))
+        else:
+            cursor.execute("""
+                SELECT user_id FROM broadcast_deliveries
+                WHERE broadcast_id = ? AND status = ? AND user_id > ?
+                ORDER BY user_id LIMIT ?
+            """, (broadcast_id, DELIVERY_PENDING, after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении получателей рассылки: {e}")
+        return []
+
+def record_delivery(conn, broadcast_id: int, user_id: int, status: str, error: str | None = None):
+    """Сохраняет результат попытки доставки рассылки получателю."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE broadcast_deliveries
+            SET status = ?, attempts = attempts + 1, last_error = ?, updated_ts = CAST(strftime('%s', 'now') AS INTEGER)
+            WHERE broadcast_id = ? AND user_id = ?
+        """, (status, error, broadcast_id, user_id))
+        conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при сохранении состояния доставки: {e}")
+
+def get_broadcast_progress(conn, broadcast_id: int) -> dict[str, int]:
+    """Возвращает число получателей рассылки по состояниям доставки."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT status, COUNT(*) FROM broadcast_deliveries
+            WHERE broadcast_id = ? GROUP BY status
+        """, (broadcast_id,))
+        return dict(cursor.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении прогресса рассылки: {e}")
+        return {}
+
+def expire_broadcasts_before(conn, before_ts: int) -> int:
+    """Помечает удаленными прошедшие рассылки без неотправленных получателей. Возвращает их число.
+
+    Рассылка с получателями в статусе pending была прервана и будет продолжена.
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE broadcasts SET is_deleted = TRUE
+            WHERE is_deleted = FALSE AND (send_ts < ? OR send_ts IS NULL)
+              AND NOT EXISTS (
+                  SELECT 1 FROM broadcast_deliveries
+                  WHERE broadcast_deliveries.broadcast_id = broadcasts.id AND status = ?
+              )
+        """, (before_ts, DELIVERY_PENDING))
+        conn.commit()
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при пометке просроченных рассылок: {e}")
+        return 0
+
 def mark_broadcast_as_deleted(conn, broadcast_id: int):
     """Помечает рассылку как удаленную."""
     try:
@@ -585,40 +986,164 @@ def mark_broadcast_as_deleted(conn, broadcast_id: int):
     except sqlite3.Error as e:
         logger.error(f"Ошибка при пометке рассылки как удаленной: {e}")
 
-def insert_queue(conn, queue_name: str, start_time: datetime, latitude: float, longitude: float, creator_id: int, time_without_location: datetime = None):
-    """Вставляет данные о новой очереди в базу данных."""
+def insert_queue(conn, queue_name: str, start_time: datetime, latitude: float, longitude: float, creator_id: int, group_id: int | None = None, time_without_location: datetime = None, radius: float | None = None, fence: list[tuple[float, float]] | None = None) -> int | None:
+    """Вставляет данные о новой очереди в базу данных.
+
+    radius — свой радиус записи в метрах (None — MAX_DISTANCE), fence —
+    вершины геозоны-многоугольника (широта, долгота) по порядку обхода.
+    """
     try:
         cursor = conn.cursor()
         cursor.execute("""
-            INSERT OR IGNORE INTO queues 
-            (queue_name, start_time, latitude, longitude, creator_id, time_without_location) 
-            VALUES (?, ?, ?, ?, ?, ?)
+            INSERT INTO queues 
+            (queue_name, start_ts, latitude, longitude, creator_id, group_id, time_without_location_ts, radius)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """, (
             queue_name, 
-            start_time.astimezone(pytz.UTC).isoformat(), 
+            to_epoch(start_time),
             latitude, 
             longitude, 
             creator_id,
-            time_without_location.astimezone(pytz.UTC).isoformat() if time_without_location else None
+            group_id,
+            to_epoch(time_without_location),
+            radius
         ))
+        queue_id = cursor.lastrowid
+        if fence:
+            cursor.executemany(
+                "INSERT INTO queue_geofence (queue_id, vertex_no, latitude, longitude) VALUES (?, ?, ?, ?)",
+                [(queue_id, vertex_no, lat, lon) for vertex_no, (lat, lon) in enumerate(fence)]
+            )
         conn.commit()
         logger.info(f"Очередь {queue_name} успешно сохранена в базе данных.")
+        return queue_id
     except sqlite3.Error as e:
         logger.error(f"Ошибка при создании очереди в базе данных: {e}")
+        return None
+
+def is_broadcast_deleted(conn, broadcast_id: int) -> bool:
+    """Проверяет, помечена ли рассылка как удаленная."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT is_deleted FROM broadcasts WHERE id = ?", (broadcast_id,))
+        result = cursor.fetchone()
+        return bool(result and result[0])
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при проверке статуса рассылки: {e}")
+        return False
+
+def get_broadcast_parts(conn, broadcast_id: int) -> list[dict]:
+    """Возвращает части рассылки в том порядке, в котором их отправил автор."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT chat_id, message_id, type, content FROM broadcast_parts
+            WHERE broadcast_id = ? ORDER BY part_no
+        """, (broadcast_id,))
+        return [{"chat_id": row[0], "message_id": row[1], "type": row[2], "content": row[3]} for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении частей рассылки: {e}")
+        return []
 
 def get_broadcast_by_id(conn, broadcast_id: int) -> dict | None:
-    """Получает информацию о рассылке по её ID."""
+    """Получает информацию о рассылке по её ID вместе с частями."""
     try:
         cursor = conn.cursor()
-        cursor.execute("SELECT message_text, message_photo, message_document FROM broadcasts WHERE id = ?", (broadcast_id,))
+        cursor.execute("SELECT send_ts, creator_id FROM broadcasts WHERE id = ?", (broadcast_id,))
         result = cursor.fetchone()
         if result:
-            return {"message_text": result[0], "message_photo": result[1], "message_document": result[2]}
+            return {"send_ts": result[0], "creator_id": result[1], "parts": get_broadcast_parts(conn, broadcast_id)}
         return None
     except sqlite3.Error as e:
         logger.error(f"Ошибка при получении рассылки из базы данных: {e}")
         return None
 
+def get_locations(conn) -> list[dict]:
+    """Возвращает именованные места для выбора при создании очереди."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT location_id, name, latitude, longitude FROM locations ORDER BY location_id")
+        return [{"location_id": row[0], "name": row[1], "latitude": row[2], "longitude": row[3]} for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении списка мест: {e}")
+        return []
+
+def get_location_by_id(conn, location_id: int) -> dict | None:
+    """Возвращает место по ID."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name, latitude, longitude FROM locations WHERE location_id = ?", (location_id,))
+        row = cursor.fetchone()
+        return {"name": row[0], "latitude": row[1], "longitude": row[2]} if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении места: {e}")
+        return None
+
+def insert_location(conn, name: str, latitude: float, longitude: float) -> int | None:
+    """Добавляет именованное место или обновляет координаты места с тем же именем."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO locations (name, latitude, longitude) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET latitude = excluded.latitude, longitude = excluded.longitude
+            RETURNING location_id
+        """, (name, latitude, longitude))
+        location_id = cursor.fetchone()[0]
+        conn.commit()
+        return location_id
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при добавлении места: {e}")
+        return None
+
+def schedule_job(conn, kind: str, target_id: int, due_ts: int) -> int | None:
+    """Создает или переносит отложенную задачу. Возвращает ее ID."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO scheduled_jobs (kind, target_id, due_ts) VALUES (?, ?, ?)
+            ON CONFLICT (kind, target_id) DO UPDATE SET due_ts = excluded.due_ts
+            RETURNING id
+        """, (kind, target_id, due_ts))
+        job_id = cursor.fetchone()[0]
+        conn.commit()
+        return job_id
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при планировании задачи {kind} для {target_id}: {e}")
+        return None
+
+def cancel_job(conn, kind: str, target_id: int) -> int | None:
+    """Удаляет отложенную задачу. Возвращает ID удаленной задачи или None."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM scheduled_jobs WHERE kind = ? AND target_id = ? RETURNING id", (kind, target_id))
+        row = cursor.fetchone()
+        conn.commit()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при отмене задачи {kind} для {target_id}: {e}")
+        return None
+
+def complete_job(conn, job_id: int, due_ts: int) -> bool:
+    """Удаляет выполненную задачу, если ее не перенесли во время выполнения."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM scheduled_jobs WHERE id = ? AND due_ts = ?", (job_id, due_ts))
+        conn.commit()
+        return cursor.rowcount == 1
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при удалении выполненной задачи {job_id}: {e}")
+        return False
+
+def get_due_jobs(conn, before_ts: int) -> list[tuple]:
+    """Возвращает задачи со сроком раньше before_ts, включая просроченные: (id, kind, target_id, due_ts)."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, kind, target_id, due_ts FROM scheduled_jobs WHERE due_ts < ? ORDER BY due_ts", (before_ts,))
+        return cursor.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении отложенных задач: {e}")
+        return []
+
 def update_user_timezone(conn, user_id: int, timezone: str):
     """Обновляет часовой пояс пользователя."""
     cursor = conn.cursor()
@@ -631,10 +1156,10 @@ def update_queue_time_without_location(conn, queue_id: int, time_without_locatio
         cursor = conn.cursor()
         cursor.execute("""
             UPDATE queues 
-            SET time_without_location = ? 
+            SET time_without_location_ts = ?
             WHERE queue_id = ?
         """, (
-            time_without_location.astimezone(pytz.UTC).isoformat() if time_without_location else None,
+            to_epoch(time_without_location),
             queue_id
         ))
         conn.commit()
@@ -642,39 +1167,72 @@ def update_queue_time_without_location(conn, queue_id: int, time_without_locatio
     except sqlite3.Error as e:
         logger.error(f"Ошибка при обновлении времени без проверки геолокации: {e}")
 
-def migrate_database(conn):
-    """Проверяет и добавляет недостающие столбцы на основе схемы TABLES_SCHEMA."""
+def insert_invite(conn, kind: str, target_id: int, creator_id: int, max_uses: int | None, expires_ts: int | None) -> int | None:
+    """Создает приглашение. Возвращает его ID."""
     try:
         cursor = conn.cursor()
-        
-        for table_name, columns in TABLES_SCHEMA.items():
-            # Проверяем существование таблицы
-            cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'")
-            if not cursor.fetchone():
-                logger.warning(f"Таблица {table_name} не существует, будет создана при следующем запуске")
-                continue
-                
-            # Получаем текущие столбцы таблицы
-            cursor.execute(f"PRAGMA table_info({table_name})")
-            existing_columns = {column[1] for column in cursor.fetchall()}
-            
-            # Проверяем каждый ожидаемый столбец
-            for column in columns:
-                name, type_, is_pk, is_nullable = column
-                if name not in existing_columns:
-                    try:
-                        column_def = f"{name} {type_}"
-                        if not is_nullable:
-                            column_def += " NOT NULL"
-                        
-                        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_def}")
-                        logger.info(f"Добавлен столбец {name} в таблицу {table_name}")
-                    except sqlite3.Error as e:
-                        logger.error(f"Ошибка при добавлении столбца {name} в {table_name}: {e}")
-        
+        cursor.execute("""
+            INSERT INTO invites (kind, target_id, creator_id, max_uses, expires_ts, created_ts)
+            VALUES (?, ?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))
+        """, (kind, target_id, creator_id, max_uses, expires_ts))
         conn.commit()
-        logger.info("Миграция базы данных завершена успешно")
-        
+        return cursor.lastrowid
     except sqlite3.Error as e:
-        logger.error(f"Критическая ошибка при миграции базы данных: {e}")
-        raise
\ No newline at end of file
+        logger.error(f"Ошибка при создании приглашения: {e}")
+        return None
+
+def redeem_invite(conn, invite_id: int, kind: str, target_id: int, now_ts: int) -> tuple | None:
+    """Атомарно засчитывает использование приглашения, если лимит и срок позволяют.
+
+    Возвращает (max_uses, expires_ts, uses) после увеличения или None, если
+    приглашения нет, оно другого вида или исчерпано.
+    """
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE invites SET uses = uses + 1
+            WHERE invite_id = ? AND kind = ? AND target_id = ?
+              AND (max_uses IS NULL OR uses < max_uses)
+              AND (expires_ts IS NULL OR expires_ts > ?)
+            RETURNING max_uses, expires_ts, uses
+        """, (invite_id, kind, target_id, now_ts))
+        result = cursor.fetchone()
+        conn.commit()
+        return result
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при использовании приглашения: {e}")
+        return None
+
+def get_invite(conn, invite_id: int) -> dict | None:
+    """Возвращает приглашение по ID."""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT kind, target_id, creator_id, max_uses, uses, expires_ts FROM invites WHERE invite_id = ?
+        """, (invite_id,))
+        result = cursor.fetchone()
+        if result:
+            return {
+                "kind": result[0],
+                "target_id": result[1],
+                "creator_id": result[2],
+                "max_uses": result[3],
+                "uses": result[4],
+                "expires_ts": result[5]
+            }
+        return None
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при получении приглашения: {e}")
+        return None
+
+def add_invite_uses(conn, deltas: list[tuple[int, int]]) -> bool:
+    """Добавляет к счетчикам приглашений накопленные в памяти использования: [(invite_id, число)]."""
+    try:
+        cursor = conn.cursor()
+        cursor.executemany("UPDATE invites SET uses = uses + ? WHERE invite_id = ?",
+                           [(delta, invite_id) for invite_id, delta in deltas])
+        conn.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при записи использований приглашений: {e}")
+        return False
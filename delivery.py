@@ -0,0 +1,349 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from telegram.error import RetryAfter, NetworkError, BadRequest, Forbidden
+from telegram.ext import BaseRateLimiter
+import config
+from varibles import DELIVERY_RATE, DELIVERY_CHAT_INTERVAL, DELIVERY_CONCURRENCY, DELIVERY_MAX_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Полосы исходящих запросов по убыванию приоритета. Полоса передается в
+# методы бота как rate_limit_args={"lane": ...}; без нее запрос интерактивный.
+LANE_INTERACTIVE = 0
+LANE_NOTIFICATION = 1
+LANE_BULK = 2
+LANE_NAMES = {LANE_INTERACTIVE: "interactive", LANE_NOTIFICATION: "notification", LANE_BULK: "bulk"}
+
+# Причины недоступности получателя (users.unreachable). UNREACHABLE_TRANSIENT
+# только для классификации: такие ошибки не исключают получателя из рассылок.
+UNREACHABLE_BLOCKED = "blocked"
+UNREACHABLE_DEACTIVATED = "deactivated"
+UNREACHABLE_CHAT_NOT_FOUND = "chat_not_found"
+UNREACHABLE_TRANSIENT = "transient"
+PERMANENT_REASONS = (UNREACHABLE_BLOCKED, UNREACHABLE_DEACTIVATED, UNREACHABLE_CHAT_NOT_FOUND)
+
+def classify_error(error: Exception) -> str:
+    """Определяет по ошибке отправки, доступен ли получатель."""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        if "deactivated" in message:
+            return UNREACHABLE_DEACTIVATED
+        # "bot was blocked by the user", "bot can't initiate conversation with a user"
+        return UNREACHABLE_BLOCKED
+    if isinstance(error, BadRequest) and "chat not found" in message:
+        return UNREACHABLE_CHAT_NOT_FOUND
+    return UNREACHABLE_TRANSIENT
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    delay = error.retry_after
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate операций в секунду, всплеск до capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ждет, пока появится свободный токен, и забирает его."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов на seconds секунд (после flood wait)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+class LaneStats:
+    """Счетчики одной полосы: глубина очереди и время ожидания токена."""
+
+    def __init__(self):
+        self.depth = 0
+        self.max_depth = 0
+        self.granted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._recent = deque(maxlen=1000)  # последние ожидания для перцентиля
+
+    def record(self, wait: float):
+        self.granted += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        self._recent.append(wait)
+
+    def snapshot(self) -> dict:
+        recent = sorted(self._recent)
+        p95 = recent[min(len(recent) - 1, int(len(recent) * 0.95))] if recent else 0.0
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "granted": self.granted,
+            "wait_avg_ms": self.wait_total / self.granted * 1000 if self.granted else 0.0,
+            "wait_p95_ms": p95 * 1000,
+            "wait_max_ms": self.wait_max * 1000,
+        }
+
+class PriorityRateLimiter(BaseRateLimiter[dict]):
+    """Общий лимит запросов бота с приоритетными полосами.
+
+    Все запросы к Bot API (кроме getUpdates) проходят через один токен-бакет
+    на DELIVERY_RATE запросов в секунду. Освободившийся токен достается
+    запросу из самой приоритетной непустой полосы, поэтому ответы на нажатия
+    не ждут за тысячами сообщений рассылки. На RetryAfter выдача токенов
+    приостанавливается для всех полос и запрос повторяется.
+    """
+
+    def __init__(self, rate: float | None = None, max_retries: int | None = None):
+        self.bucket = TokenBucket(rate or getattr(config, "DELIVERY_RATE", DELIVERY_RATE))
+        self._max_retries = max_retries if max_retries is not None else getattr(config, "DELIVERY_MAX_RETRIES", DELIVERY_MAX_RETRIES)
+        self._waiters = []  # куча (полоса, номер, момент постановки, future)
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self.lanes = {lane: LaneStats() for lane in LANE_NAMES}
+        self.flood_waits = 0
+
+    async def initialize(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for *_, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    def _pop_waiter(self):
+        while self._waiters:
+            item = heapq.heappop(self._waiters)
+            if not item[3].done():
+                return item
+        return None
+
+    async def _dispatch(self):
+        while True:
+            if not any(stats.depth for stats in self.lanes.values()):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            item = self._pop_waiter()
+            if item is None:
+                continue
+            lane, _, enqueued, future = item
+            stats = self.lanes[lane]
+            stats.depth -= 1
+            stats.record(time.monotonic() - enqueued)
+            future.set_result(None)
+
+    async def _acquire(self, lane: int):
+        if self._dispatcher is None:
+            # До initialize() и после shutdown() выдавать токены по полосам некому
+            await self.bucket.acquire()
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._counter), time.monotonic(), future))
+        stats = self.lanes[lane]
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if not future.done() or future.cancelled():
+                stats.depth -= 1
+            raise
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = (rate_limit_args or {}).get("lane", LANE_INTERACTIVE)
+        attempt = 0
+        while True:
+            await self._acquire(lane)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                delay = _retry_after_seconds(e)
+                self.flood_waits += 1
+                self.bucket.pause(delay)
+                attempt += 1
+                if attempt > self._max_retries:
+                    raise
+                logger.warning(f"Превышен лимит Telegram ({LANE_NAMES.get(lane, lane)}, {endpoint}), пауза {delay:.0f} с")
+
+    def stats(self) -> dict:
+        """Возвращает счетчики каждой полосы и число flood wait."""
+        result = {name: self.lanes[lane].snapshot() for lane, name in LANE_NAMES.items()}
+        result["flood_waits"] = self.flood_waits
+        return result
+
+class Reachability:
+    """Получатели, которым бот не может писать (заблокировали бота, удалили аккаунт).
+
+    Признак хранится в users.unreachable и учитывается в запросах получателей
+    групповых рассылок; в памяти держится множество таких ID, чтобы снимать
+    признак при первом же обращении пользователя к боту без запроса к БД.
+    """
+
+    def __init__(self, repo):
+        self._repo = repo
+        self._user_ids = set()
+        self.flagged = {reason: 0 for reason in PERMANENT_REASONS}
+        self.restored = 0
+        self.skipped = 0
+
+    async def load(self) -> int:
+        """Читает из БД отмеченных пользователей. Возвращает их количество."""
+        self._user_ids = set(await self._repo.get_unreachable_user_ids())
+        return len(self._user_ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._user_ids
+
+    async def report_error(self, user_id: int, error: Exception) -> str:
+        """Классифицирует ошибку отправки и отмечает получателя, если он недоступен навсегда."""
+        reason = classify_error(error)
+        if reason in PERMANENT_REASONS and user_id not in self._user_ids:
+            if await self._repo.mark_user_unreachable(user_id, reason):
+                self._user_ids.add(user_id)
+                self.flagged[reason] += 1
+                logger.info(f"Пользователь {user_id} недоступен ({reason}) и исключен из рассылок")
+        return reason
+
+    async def restore(self, user_id: int):
+        """Снимает признак недоступности, если пользователь снова пишет боту."""
+        if user_id in self._user_ids:
+            self._user_ids.discard(user_id)
+            self.restored += 1
+            await self._repo.clear_user_unreachable(user_id)
+
+    def note_skipped(self, count: int):
+        """Учитывает отправки, которых не было из-за исключенных получателей."""
+        self.skipped += count
+
+    def stats(self) -> dict:
+        """Возвращает число недоступных, отмеченных и восстановленных с запуска и сэкономленных отправок."""
+        result = {"unreachable": len(self._user_ids)}
+        result.update({f"flagged_{reason}": count for reason, count in self.flagged.items()})
+        result["restored"] = self.restored
+        result["skipped_sends"] = self.skipped
+        return result
+
+class DeliveryEngine:
+    """Массовая отправка сообщений с учетом ограничений Telegram.
+
+    Общую частоту запросов ограничивает PriorityRateLimiter бота; здесь
+    сообщения в один чат идут не чаще раза в DELIVERY_CHAT_INTERVAL секунд и
+    одновременно обслуживается не больше DELIVERY_CONCURRENCY получателей.
+    Полоса приоритета задается в самих вызовах через rate_limit_args.
+    Flood wait (RetryAfter) повторяет только лимитер; если он так и не
+    прошел, сообщение считается неотправленным. Сетевые ошибки повторяются с
+    экспоненциальной задержкой не больше DELIVERY_MAX_RETRIES раз на
+    сообщение; остальные ошибки возвращаются вызывающему; если получатель
+    недоступен навсегда, он отмечается в Reachability.
+    """
+
+    def __init__(self, chat_interval: float | None = None, concurrency: int | None = None, max_retries: int | None = None,
+                 reachability: Reachability | None = None):
+        self._reachability = reachability
+        self._chat_interval = chat_interval if chat_interval is not None else getattr(config, "DELIVERY_CHAT_INTERVAL", DELIVERY_CHAT_INTERVAL)
+        self._semaphore = asyncio.Semaphore(concurrency or getattr(config, "DELIVERY_CONCURRENCY", DELIVERY_CONCURRENCY))
+        self._max_retries = max_retries if max_retries is not None else getattr(config, "DELIVERY_MAX_RETRIES", DELIVERY_MAX_RETRIES)
+        self._chat_next = {}  # chat_id -> момент, раньше которого в чат не пишем
+        self._recent = deque()  # моменты отправки за последнюю минуту
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.flood_failed = 0  # сообщения, не прошедшие flood wait и после повторов лимитера
+        self.in_flight = 0
+
+    async def _pace_chat(self, chat_id: int):
+        now = time.monotonic()
+        ready = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, ready) + self._chat_interval
+        if ready > now:
+            await asyncio.sleep(ready - now)
+        if len(self._chat_next) > 10000:
+            self._chat_next = {key: value for key, value in self._chat_next.items() if value > now}
+
+    async def _send_one(self, chat_id: int, send):
+        attempt = 0
+        while True:
+            await self._pace_chat(chat_id)
+            try:
+                result = await send()
+            except RetryAfter:
+                # Лимитер уже повторил запрос DELIVERY_MAX_RETRIES раз
+                self.flood_failed += 1
+                raise
+            except (Forbidden, BadRequest):
+                raise
+            except NetworkError:
+                attempt += 1
+                if attempt > self._max_retries:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(2 ** (attempt - 1))
+                continue
+            self.sent += 1
+            now = time.monotonic()
+            self._recent.append(now)
+            while self._recent and self._recent[0] < now - 60:
+                self._recent.popleft()
+            return result
+
+    async def deliver(self, chat_id: int, sends: list) -> Exception | None:
+        """Отправляет в чат сообщения по порядку. sends — функции без аргументов, возвращающие корутину.
+
+        Возвращает None при успехе или ошибку, на которой отправка в этот чат прервалась.
+        """
+        async with self._semaphore:
+            self.in_flight += 1
+            try:
+                for send in sends:
+                    await self._send_one(chat_id, send)
+                return None
+            except Exception as e:
+                self.failed += 1
+                if self._reachability is not None:
+                    await self._reachability.report_error(chat_id, e)
+                return e
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        """Возвращает счетчики отправки и частоту за последнюю минуту (сообщений в секунду)."""
+        now = time.monotonic()
+        recent = sum(1 for moment in self._recent if moment >= now - 60)
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "flood_failed": self.flood_failed,
+            "in_flight": self.in_flight,
+            "rate_per_sec": recent / 60,
+        }
@@ -0,0 +1,272 @@
+"""Расстояния между точками на масштабе кампуса.
+
+Для проверки «пользователь ближе MAX_DISTANCE к очереди» не нужен
+итерационный расчет по эллипсоиду (geopy.geodesic): на расстояниях до
+нескольких километров поверхность вокруг очереди можно считать плоской.
+LocalProjection один раз на очередь вычисляет, сколько метров в градусе
+широты и долготы в ее точке (радиусы кривизны WGS84 и cos(широты)), после
+чего расстояние — это hypot двух разностей.
+
+Погрешность относительно geodesic (см. benchmarks/bench_geo.py): меньше
+2 мм на 150 м и меньше 35 см на 2 км на широтах до 70°; она растет как
+квадрат расстояния, поэтому для десятков километров нужен haversine().
+"""
+import math
+from bisect import bisect_right
+from collections import defaultdict
+
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+_E2 = WGS84_F * (2 - WGS84_F)
+EARTH_MEAN_RADIUS = 6371008.8
+METERS_PER_DEGREE = 111_320.0  # градус широты (и долготы на экваторе), с округлением вниз
+
+def _wrap_longitude(delta: float) -> float:
+    return (delta + 180.0) % 360.0 - 180.0
+
+def _orientation(a: tuple[float, float], b: tuple[float, float], c: tuple[float, float]) -> int:
+    cross = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    return (cross > 0) - (cross < 0)
+
+def _on_segment(a: tuple[float, float], b: tuple[float, float], c: tuple[float, float]) -> bool:
+    # c лежит на прямой ab; проверяем, что и внутри отрезка
+    return min(a[0], b[0]) <= c[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= c[1] <= max(a[1], b[1])
+
+def _segments_intersect(p1, p2, q1, q2) -> bool:
+    o1, o2 = _orientation(p1, p2, q1), _orientation(p1, p2, q2)
+    o3, o4 = _orientation(q1, q2, p1), _orientation(q1, q2, p2)
+    if o1 != o2 and o3 != o4:
+        return True
+    return ((o1 == 0 and _on_segment(p1, p2, q1)) or (o2 == 0 and _on_segment(p1, p2, q2))
+            or (o3 == 0 and _on_segment(q1, q2, p1)) or (o4 == 0 and _on_segment(q1, q2, p2)))
+
+def is_simple_polygon(vertices: list[tuple[float, float]]) -> bool:
+    """Проверяет, что ребра многоугольника пересекаются только в общих вершинах соседей.
+
+    Перебор пар ребер — O(n²), для геозон до MAX_GEOFENCE_VERTICES вершин этого достаточно.
+    """
+    edges = list(zip(vertices, vertices[1:] + vertices[:1]))
+    count = len(edges)
+    for i in range(count):
+        for j in range(i + 2, count):
+            if i == 0 and j == count - 1:
+                continue  # первое и последнее ребра соседние
+            if _segments_intersect(*edges[i], *edges[j]):
+                return False
+    return True
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Расстояние в метрах по сфере среднего радиуса (погрешность до 0,5% на любых расстояниях)."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_MEAN_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+class LocalProjection:
+    """Плоская (equirectangular) проекция окрестности точки с масштабами WGS84 в этой точке."""
+
+    __slots__ = ("latitude", "longitude", "ky", "kx")
+
+    def __init__(self, latitude: float, longitude: float):
+        self.latitude = latitude
+        self.longitude = longitude
+        phi = math.radians(latitude)
+        w = 1 - _E2 * math.sin(phi) ** 2
+        meridian = WGS84_A * (1 - _E2) / w ** 1.5    # радиус кривизны меридиана
+        prime_vertical = WGS84_A / math.sqrt(w)      # радиус кривизны первого вертикала
+        self.ky = math.radians(1) * meridian                       # метров в градусе широты
+        self.kx = math.radians(1) * prime_vertical * math.cos(phi)  # метров в градусе долготы
+
+    def distance(self, latitude: float, longitude: float) -> float:
+        """Расстояние в метрах от центра проекции до точки."""
+        return math.hypot((latitude - self.latitude) * self.ky,
+                          _wrap_longitude(longitude - self.longitude) * self.kx)
+
+    def within(self, latitude: float, longitude: float, radius: float) -> bool:
+        """Проверяет, что точка не дальше radius метров (без извлечения корня)."""
+        dy = (latitude - self.latitude) * self.ky
+        dx = _wrap_longitude(longitude - self.longitude) * self.kx
+        return dx * dx + dy * dy <= radius * radius
+
+class PolygonFence:
+    """Геозона-многоугольник (вершины — пары широта, долгота) с быстрой проверкой попадания.
+
+    При создании считаются ограничивающий прямоугольник и разбиение на
+    горизонтальные полосы между соседними широтами вершин; в каждой полосе
+    ребра, которые ее пересекают, упорядочены слева направо. Проверка точки:
+    отсечение по прямоугольнику, затем бинарный поиск полосы и бинарный поиск
+    числа ребер левее точки — O(log n) без перебора ребер. Многоугольник на
+    масштабе кампуса считается плоским в градусах. Полосы верны только для
+    многоугольника без самопересечений (внутри полосы ребра не должны
+    меняться местами); для остальных, например вершин «бантиком», проверка
+    идет лучом по всем ребрам (правило четности), а simple равен False.
+    """
+
+    __slots__ = ("vertices", "simple", "south", "north", "west", "east", "_bounds", "_slabs")
+
+    def __init__(self, vertices: list[tuple[float, float]]):
+        if len(vertices) < 3:
+            raise ValueError("Для многоугольника нужно хотя бы 3 вершины")
+        self.vertices = [(float(lat), float(lon)) for lat, lon in vertices]
+        lats = [lat for lat, _ in self.vertices]
+        lons = [lon for _, lon in self.vertices]
+        self.south, self.north, self.west, self.east = min(lats), max(lats), min(lons), max(lons)
+        self.simple = is_simple_polygon(self.vertices)
+
+        edges = []
+        for (lat1, lon1), (lat2, lon2) in zip(self.vertices, self.vertices[1:] + self.vertices[:1]):
+            if lat1 == lat2:
+                continue  # горизонтальные ребра не меняют четность пересечений
+            if lat1 > lat2:
+                lat1, lon1, lat2, lon2 = lat2, lon2, lat1, lon1
+            edges.append((lat1, lat2, lon1, (lon2 - lon1) / (lat2 - lat1)))
+
+        self._bounds = sorted(set(lats))
+        self._slabs = []
+        for low, high in zip(self._bounds, self._bounds[1:]):
+            middle = (low + high) / 2
+            crossing = [(lon + slope * (middle - lat1), lat1, lon, slope)
+                        for lat1, lat2, lon, slope in edges if lat1 <= low and lat2 >= high]
+            crossing.sort()
+            self._slabs.append([(lat1, lon, slope) for _, lat1, lon, slope in crossing])
+
+    @property
+    def center(self) -> tuple[float, float]:
+        """Центр ограничивающего прямоугольника (точка очереди на карте и в индексе)."""
+        return (self.south + self.north) / 2, (self.west + self.east) / 2
+
+    def contains(self, latitude: float, longitude: float) -> bool:
+        """Проверяет, лежит ли точка внутри многоугольника."""
+        if not (self.south <= latitude < self.north and self.west <= longitude <= self.east):
+            return False
+        if not self.simple:
+            return self._crossings(latitude, longitude) % 2 == 1
+        slab = self._slabs[bisect_right(self._bounds, latitude) - 1]
+        low, high = 0, len(slab)
+        while low < high:  # число ребер полосы левее точки
+            middle = (low + high) // 2
+            lat1, lon, slope = slab[middle]
+            if lon + slope * (latitude - lat1) <= longitude:
+                low = middle + 1
+            else:
+                high = middle
+        return low % 2 == 1
+
+    def _crossings(self, latitude: float, longitude: float) -> int:
+        # Число ребер, которые пересекает луч из точки на запад
+        count = 0
+        for (lat1, lon1), (lat2, lon2) in zip(self.vertices, self.vertices[1:] + self.vertices[:1]):
+            if (lat1 <= latitude) != (lat2 <= latitude) and lon1 + (lon2 - lon1) * (latitude - lat1) / (lat2 - lat1) <= longitude:
+                count += 1
+        return count
+
+    def radius_from(self, latitude: float, longitude: float) -> float:
+        """Расстояние в метрах от точки до самой дальней вершины."""
+        projection = LocalProjection(latitude, longitude)
+        return max(projection.distance(lat, lon) for lat, lon in self.vertices)
+
+class GridIndex:
+    """Пространственный индекс точек на сетке ячеек размером около cell_meters по широте.
+
+    Ячейка — квадрат в градусах; их целое число укладывается в 360°, поэтому
+    столбцы замыкаются через 180-й меридиан. Поиск соседей перебирает только
+    ячейки, пересекающие квадрат вокруг точки запроса, и считает точное
+    расстояние лишь для попавших в них точек.
+    """
+
+    def __init__(self, cell_meters: float):
+        self._columns = math.ceil(360 / (cell_meters / METERS_PER_DEGREE))
+        self._cell = 360 / self._columns
+        self._cells = defaultdict(set)  # (строка, столбец) -> ключи
+        self._points = {}               # ключ -> (широта, долгота, ячейка)
+
+    def _row(self, latitude: float) -> int:
+        return math.floor(latitude / self._cell)
+
+    def _column(self, longitude: float) -> int:
+        return math.floor((longitude + 180.0) / self._cell)
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def add(self, key, latitude: float, longitude: float):
+        """Добавляет точку или перемещает уже добавленную."""
+        self.remove(key)
+        cell = (self._row(latitude), self._column(longitude) % self._columns)
+        self._points[key] = (latitude, longitude, cell)
+        self._cells[cell].add(key)
+
+    def remove(self, key):
+        point = self._points.pop(key, None)
+        if point is not None:
+            keys = self._cells[point[2]]
+            keys.discard(key)
+            if not keys:
+                del self._cells[point[2]]
+
+    def near(self, latitude: float, longitude: float, radius: float) -> list[tuple[float, object]]:
+        """Возвращает [(расстояние в метрах, ключ)] точек не дальше radius, по возрастанию расстояния."""
+        projection = LocalProjection(latitude, longitude)
+        dlat = radius / projection.ky
+        dlon = radius / max(projection.kx, 1.0)
+        col_min, col_max = self._column(longitude - dlon), self._column(longitude + dlon)
+        if col_max - col_min + 1 >= self._columns:
+            columns = range(self._columns)
+        else:
+            columns = [col % self._columns for col in range(col_min, col_max + 1)]
+        found = []
+        for row in range(self._row(latitude - dlat), self._row(latitude + dlat) + 1):
+            for col in columns:
+                for key in self._cells.get((row, col), ()):
+                    point_lat, point_lon, _ = self._points[key]
+                    distance = projection.distance(point_lat, point_lon)
+                    if distance <= radius:
+                        found.append((distance, key))
+        found.sort(key=lambda item: item[0])
+        return found
+
+def distances_many(points, centers) -> list[list[float]]:
+    """Матрица расстояний в метрах: строки — точки, столбцы — центры.
+
+    points — последовательность пар (широта, долгота), centers — пар или
+    готовых LocalProjection (например, QueueState.projection).
+    """
+    projections = [center if isinstance(center, LocalProjection) else LocalProjection(*center) for center in centers]
+    return [[projection.distance(lat, lon) for projection in projections] for lat, lon in points]
+
+def within_many(points, zones) -> list[list[bool]]:
+    """Матрица «точка попадает в зону записи»: строки — точки, столбцы — зоны.
+
+    zones — тройки (центр, радиус в метрах, геозона или None); центр — пара
+    или LocalProjection. Зона с геозоной проверяется по многоугольнику, без
+    нее — по кругу своего радиуса, как QueueState.covers(). Чистый Python без
+    numpy: для каждой зоны один раз считаются квадрат радиуса и полуширина
+    прямоугольника вокруг центра в градусах, и большинство далеких пар
+    отсекается двумя сравнениями без умножений.
+    """
+    prepared = []
+    for center, radius, fence in zones:
+        if fence is not None:
+            prepared.append((fence,))
+            continue
+        projection = center if isinstance(center, LocalProjection) else LocalProjection(*center)
+        prepared.append((projection.latitude, projection.longitude, projection.ky, projection.kx,
+                         radius / projection.ky, radius / max(projection.kx, 1.0), radius * radius))
+    rows = []
+    for lat, lon in points:
+        row = []
+        for zone in prepared:
+            if len(zone) == 1:
+                row.append(zone[0].contains(lat, lon))
+                continue
+            center_lat, center_lon, ky, kx, dlat, dlon, radius2 = zone
+            dy = lat - center_lat
+            dx = _wrap_longitude(lon - center_lon)
+            if -dlat <= dy <= dlat and -dlon <= dx <= dlon:
+                dy *= ky
+                dx *= kx
+                row.append(dx * dx + dy * dy <= radius2)
+            else:
+                row.append(False)
+        rows.append(row)
+    return rows
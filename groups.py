@@ -6,7 +6,8 @@ from config import ADMIN_ID
 from varibles import GROUP_NAME, JOIN_GROUP_PAYLOAD
 from db import *
 from utils import *
-from crypto import decrypt_data
+from crypto import decode_invite, TokenExpired
+from invites import INVITE_GROUP, REJECTION_MESSAGES
 logger = logging.getLogger(__name__)
 
 async def create_group(update: Update, context: CallbackContext) -> int:
@@ -17,14 +18,14 @@ async def create_group(update: Update, context: CallbackContext) -> int:
 async def create_group_name(update: Update, context: CallbackContext) -> int:
     """Сохраняет название группы и завершает процесс."""
     group_name = update.message.text.strip()
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
 
     if not group_name:
         await update.message.reply_text("⚠️ Название группы не может быть пустым. Попробуйте снова.")
         return GROUP_NAME
 
-    group_id = insert_group(conn, group_name, user_id)  # Сохраняем группу
+    group_id = await repo.insert_group(group_name, user_id)  # Сохраняем группу
     if group_id:
         reply_markup = await create_join_group_button(context, group_id, user_id)
 
@@ -39,7 +40,7 @@ async def create_group_name(update: Update, context: CallbackContext) -> int:
 
 async def handle_group_deeplink(update: Update, context: CallbackContext) -> None:
     """Обрабатывает deeplink для присоединения к группе."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     if update.message:
         message_text = update.message.text
         logger.info(f"Получено сообщение: {message_text}")
@@ -50,11 +51,14 @@ async def handle_group_deeplink(update: Update, context: CallbackContext) -> Non
         payload = message_text.split()[1]
         if payload.startswith(JOIN_GROUP_PAYLOAD):
             try:
-                encrypted_id = payload[11:]
-                group_id, creator_id = decrypt_data(encrypted_id)
+                token = payload[len(JOIN_GROUP_PAYLOAD):]
+                group_id, creator_id, invite_id = decode_invite(JOIN_GROUP_PAYLOAD, token)
                 if not group_id or not creator_id:
                     await update.message.reply_text("❌ Неверный формат ID группы.")
                     return
+            except TokenExpired:
+                await update.message.reply_text("⌛ Срок действия приглашения истек.")
+                return
             except ValueError:
                 await update.message.reply_text("❌ Неверный формат ID группы.")
                 return
@@ -62,7 +66,7 @@ async def handle_group_deeplink(update: Update, context: CallbackContext) -> Non
             user_id = update.effective_user.id
 
             # Получаем информацию о группе
-            group = get_group_by_id(conn, group_id)
+            group = await repo.get_group_by_id(group_id)
             if not group:
                 await update.message.reply_text("❌ Ошибка: Группа не найдена.")
                 return
@@ -71,21 +75,28 @@ async def handle_group_deeplink(update: Update, context: CallbackContext) -> Non
                 await update.message.reply_text("❌ Ошибка: Неверный создатель группы.")
                 return
 
-            if not get_user_data(conn, user_id):
+            if not await repo.get_user_data(user_id):
                 await update.message.reply_text(
                     "✍ Для начала введите ваше *имя* с помощью команды /start.",
                 )
                 return
 
+            # Приглашение с лимитом: использование засчитывается только новым участникам
+            if invite_id is not None and not await repo.is_user_in_group(group_id, user_id):
+                reason = await context.bot_data['invites'].redeem(invite_id, INVITE_GROUP, group_id)
+                if reason:
+                    await update.message.reply_text(REJECTION_MESSAGES[reason])
+                    return
+
             # Добавляем пользователя в группу
-            add_user_to_group(conn, group_id, user_id)
+            await repo.add_user_to_group(group_id, user_id)
             await update.message.reply_text(f"✅ Вы присоединились к группе '{group['group_name']}'")
     elif update.callback_query:
         pass
 
 async def show_groups(update: Update, context: CallbackContext) -> None:
     """Показывает список групп."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
     query = update.callback_query
 
@@ -101,17 +112,17 @@ async def show_groups(update: Update, context: CallbackContext) -> None:
             return
 
     # Получаем группы пользователя
-    user_groups = get_user_groups(conn, user_id)
+    user_groups = await repo.get_user_groups(user_id)
     if user_id == ADMIN_ID:
-        user_groups = get_all_groups(conn)
+        user_groups = await repo.get_all_groups()
 
     # Создаем кнопки
-    buttons=[InlineKeyboardButton("➕ Создать группу", callback_data="create_group")]
-    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data="main_menu"))
+    buttons=[InlineKeyboardButton("➕ Создать группу", callback_data=pack(CB_CREATE_GROUP))]
+    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data=pack(CB_MAIN_MENU)))
 
     if user_groups:
         for group in reversed(user_groups):
-            buttons.insert(0, InlineKeyboardButton(group['group_name'], callback_data=f"group_info_{group['group_id']}"))
+            buttons.insert(0, InlineKeyboardButton(group['group_name'], callback_data=pack(CB_GROUP_INFO, group['group_id'])))
         reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=1))
     else:
         reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=1))
@@ -123,186 +134,154 @@ async def show_groups(update: Update, context: CallbackContext) -> None:
         # Иначе отправляем новое сообщение
         await context.bot.send_message(chat_id, "📋 Выберите группу:", reply_markup=reply_markup)
 
-async def join_group(update: Update, context: CallbackContext) -> None:
+async def join_group(update: Update, context: CallbackContext, group_id: int) -> None:
     """Обрабатывает нажатие на кнопку 'Присоединиться к группе'."""
     query = update.callback_query
     await query.answer()
-    conn = context.bot_data['conn']
-    data_parts = query.data.split("_")
-
-    #Валидация данных
-    if len(data_parts) < 3:
-        await query.message.reply_text("❌ Ошибка: неверный формат данных")
-        return
-    try:
-        group_id = int(data_parts[2])
-    except ValueError:
-         await query.message.reply_text("❌ Ошибка: неверный формат ID группы")
-         return
+    repo = context.bot_data['repo']
 
     user_id = update.effective_user.id
 
-    group_name = get_group_name_by_id(conn, group_id)
+    group_name = await repo.get_group_name_by_id(group_id)
     if not group_name:
         await query.message.reply_text("❌ Ошибка: Группа не найдена.")
         return
 
-    add_user_to_group(conn, group_id, user_id)
+    await repo.add_user_to_group(group_id, user_id)
     await query.message.reply_text(f"✅ Вы присоединились к группе '{group_name}'")
 
-async def leave_group_button(update: Update, context: CallbackContext) -> None:
+async def leave_group_button(update: Update, context: CallbackContext, group_id: int) -> None:
     """Обрабатывает выход пользователя из группы."""
     query = update.callback_query
     await query.answer()
-    group_id = int(query.data.split("_")[2])
 
     # Создаем кнопки подтверждения
     keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data=f"confirm_leave_group_{group_id}")],
-        [InlineKeyboardButton("❌ Нет", callback_data=f"cancel_leave_group_{group_id}")]
+        [InlineKeyboardButton("✅ Да", callback_data=pack(CB_CONFIRM_LEAVE_GROUP, group_id))],
+        [InlineKeyboardButton("❌ Нет", callback_data=pack(CB_CANCEL_LEAVE_GROUP, group_id))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text("Подтвердите выход из группы:", reply_markup=reply_markup)
 
-async def confirm_leave_group(update: Update, context: CallbackContext) -> None:
+async def confirm_leave_group(update: Update, context: CallbackContext, group_id: int) -> None:
     """Подтверждает выход из группы."""
     query = update.callback_query
     await query.answer()
-    group_id = int(query.data.split("_")[3])
 
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
-    group_name = get_group_name_by_id(conn, group_id)
+    group_name = await repo.get_group_name_by_id(group_id)
 
     if not group_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя группы.")
         return
 
-    remove_user_from_group(conn, group_id, user_id)
+    await repo.remove_user_from_group(group_id, user_id)
     await query.edit_message_text(f"✅ Вы вышли из группы: *{group_name}*.")
 
     context.user_data['chat_id'] = query.message.chat_id
     context.user_data['edit_message'] = False
     await show_groups(update, context)
 
-async def cancel_leave_group(update: Update, context: CallbackContext) -> None:
+async def cancel_leave_group(update: Update, context: CallbackContext, group_id: int) -> None:
     """Отменяет выход из группы."""
     query = update.callback_query
     await query.answer()
-    group_id = int(query.data.split("_")[3])
 
-    conn = context.bot_data['conn']
-    group_name = get_group_name_by_id(conn, group_id)
+    repo = context.bot_data['repo']
+    group_name = await repo.get_group_name_by_id(group_id)
 
     if not group_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя группы.")
         return
 
     await query.edit_message_text(f"❌ Выход из группы *{group_name}* отменен.")
-    await group_info_button(update, context)
+    await group_info_button(update, context, group_id)
 
 
-async def delete_group_button(update: Update, context: CallbackContext) -> None:
+async def delete_group_button(update: Update, context: CallbackContext, group_id: int) -> None:
     """Обрабатывает нажатие кнопки удаления группы."""
     query = update.callback_query
     await query.answer()
-    group_id = int(query.data.split("_")[2])
 
     # Создаем кнопки подтверждения
     keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data=f"confirm_delete_group_{group_id}")],
-        [InlineKeyboardButton("❌ Нет", callback_data=f"cancel_delete_group_{group_id}")]
+        [InlineKeyboardButton("✅ Да", callback_data=pack(CB_CONFIRM_DELETE_GROUP, group_id))],
+        [InlineKeyboardButton("❌ Нет", callback_data=pack(CB_CANCEL_DELETE_GROUP, group_id))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text("Подтвердите удаление группы:", reply_markup=reply_markup)
 
-async def confirm_delete_group(update: Update, context: CallbackContext) -> None:
+async def confirm_delete_group(update: Update, context: CallbackContext, group_id: int) -> None:
     """Подтверждает удаление группы."""
     query = update.callback_query
     await query.answer()
-    group_id = int(query.data.split("_")[3])
 
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
-    group_name = get_group_name_by_id(conn, group_id)
+    group_name = await repo.get_group_name_by_id(group_id)
 
     if not group_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя группы.")
         return
 
-    delete_group_db(conn, group_id)
+    await repo.delete_group_db(group_id)
     await query.edit_message_text(f"✅ Группа *{group_name}* успешно удалена.")
 
     context.user_data['chat_id'] = query.message.chat_id
     context.user_data['edit_message'] = False
     await show_groups(update, context)
 
-async def cancel_delete_group(update: Update, context: CallbackContext) -> None:
+async def cancel_delete_group(update: Update, context: CallbackContext, group_id: int) -> None:
     """Отменяет удаление группы."""
     query = update.callback_query
     await query.answer()
-    group_id = int(query.data.split("_")[3])
 
-    conn = context.bot_data['conn']
-    group_name = get_group_name_by_id(conn, group_id)
+    repo = context.bot_data['repo']
+    group_name = await repo.get_group_name_by_id(group_id)
 
     if not group_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя группы.")
         return
 
     await query.edit_message_text(f"❌ Удаление группы *{group_name}* отменено.")
-    await group_info_button(update, context)
+    await group_info_button(update, context, group_id)
 
-async def group_info_button(update: Update, context: CallbackContext) -> None:
+async def group_info_button(update: Update, context: CallbackContext, group_id: int) -> None:
     """Обрабатывает нажатие кнопки просмотра информации о группе."""
     query = update.callback_query
     await query.answer()  # query.answer() нужен, если мы вызываем edit_message_text
-    conn = context.bot_data['conn']
-
-    group_id = None
-    if group_id is None:
-        if query and (query.data.startswith("group_info_") or query.data.startswith("cancel_delete_group_") 
-                      or query.data.startswith("cancel_leave_group_")):
-            if query.data.startswith("cancel_delete_group_") or query.data.startswith("cancel_leave_group_"):
-                group_id = int(query.data.split("_")[3])
-            else:
-                group_id = int(query.data.split("_")[2])
-        else:
-            if query:
-                await query.edit_message_text("❌ Ошибка: ID группы не найден.")
-            return
+    repo = context.bot_data['repo']
 
     user_id = update.effective_user.id
-    group = get_group_by_id(conn, group_id)
+    group = await repo.get_group_snapshot(group_id, user_id)
     if not group:
         await query.edit_message_text("❌ Ошибка: Группа не найдена.")
         return
 
-    # Получаем список участников группы
-    users_list = get_group_users(conn, group_id)
-    users_text = "\n".join([f"{i+1}. {get_user_name(conn, user_id)}" for i, user_id in enumerate(users_list)]) if users_list else "🔍 В группе пока нет участников."
+    users_text = format_members(group.members) if group.members else "🔍 В группе пока нет участников."
 
     # Формируем кнопки
     buttons = []
-    if is_user_in_group(conn, group_id, user_id):
-        buttons.append(InlineKeyboardButton("🚪 Покинуть группу", callback_data=f"leave_group_{group_id}"))
+    if group.viewer_is_member:
+        buttons.append(InlineKeyboardButton("🚪 Покинуть группу", callback_data=pack(CB_LEAVE_GROUP, group_id)))
     else:
-        buttons.append(InlineKeyboardButton("➕ Присоединиться", callback_data=f"{JOIN_GROUP_PAYLOAD}{group_id}"))
+        buttons.append(InlineKeyboardButton("➕ Присоединиться", callback_data=pack(CB_JOIN_GROUP, group_id)))
 
-    if group['creator_id'] == user_id or user_id == ADMIN_ID:
+    if group.creator_id == user_id or user_id == ADMIN_ID:
         buttons.extend([
-            InlineKeyboardButton("❌ Удалить группу", callback_data=f"delete_group_{group_id}"),
-            InlineKeyboardButton("🔗 Пригласить", callback_data=f"invite_group_{group_id}")
+            InlineKeyboardButton("❌ Удалить группу", callback_data=pack(CB_DELETE_GROUP, group_id)),
+            InlineKeyboardButton("🔗 Пригласить", callback_data=pack(CB_INVITE_GROUP, group_id))
         ])
 
-    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data="show_groups"))
+    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data=pack(CB_SHOW_GROUPS)))
     
     reply_markup = InlineKeyboardMarkup(build_menu(buttons, n_cols=2))
 
     await query.edit_message_text(
-        f"📋 Информация о группе {group['group_name']}:\n\n"
+        f"📋 Информация о группе {group.group_name}:\n\n"
         f"👥 Участники:\n{users_text}",
         reply_markup=reply_markup
     )
\ No newline at end of file
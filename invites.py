@@ -0,0 +1,137 @@
+import logging
+import time
+from telegram.ext import CallbackContext
+import config
+from varibles import INVITE_MAX_USES, INVITE_LIFETIME, INVITE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Вид приглашения (invites.kind)
+INVITE_QUEUE = "queue"
+INVITE_GROUP = "group"
+
+# Причины отказа в redeem()
+INVITE_UNKNOWN = "unknown"
+INVITE_EXPIRED = "expired"
+INVITE_EXHAUSTED = "exhausted"
+REJECTION_MESSAGES = {
+    INVITE_UNKNOWN: "❌ Приглашение недействительно.",
+    INVITE_EXPIRED: "⌛ Срок действия приглашения истек.",
+    INVITE_EXHAUSTED: "🚫 Приглашение уже использовано максимальное число раз.",
+}
+
+class _Invite:
+    __slots__ = ("kind", "target_id", "max_uses", "expires_ts", "uses", "pending", "last_used")
+
+    def __init__(self, kind: str, target_id: int, max_uses: int | None, expires_ts: int | None, uses: int):
+        self.kind = kind
+        self.target_id = target_id
+        self.max_uses = max_uses
+        self.expires_ts = expires_ts
+        self.uses = uses     # включая еще не записанные в БД
+        self.pending = 0     # использований, ожидающих записи
+        self.last_used = time.monotonic()
+
+class InviteLedger:
+    """Учет использований приглашений с лимитом и сроком действия (таблица invites).
+
+    Первое использование ссылки — один атомарный UPDATE ... RETURNING по
+    первичному ключу: он увеличивает счетчик, только если лимит и срок еще
+    позволяют, и возвращает ограничения ссылки. Дальше ссылка считается
+    горячей: ее использования проверяются и считаются в памяти (проверка и
+    увеличение идут без await между ними, поэтому гонки в цикле событий нет),
+    а накопленные приращения раз в INVITE_FLUSH_INTERVAL секунд одной
+    пакетной записью добавляются к invites.uses. Ссылки без использований с
+    прошлой записи из памяти убираются. При аварийной остановке теряются
+    только приращения последнего интервала.
+    """
+
+    def __init__(self, repo, flush_interval: float | None = None):
+        self._repo = repo
+        self.flush_interval = flush_interval or getattr(config, "INVITE_FLUSH_INTERVAL", INVITE_FLUSH_INTERVAL)
+        self._hot: dict[int, _Invite] = {}
+        self.redeemed = 0
+        self.rejected = 0
+        self.flushes = 0
+
+    async def create(self, kind: str, target_id: int, creator_id: int,
+                     max_uses: int | None = None, lifetime: int | None = None) -> tuple | None:
+        """Создает приглашение с лимитом и сроком (по умолчанию из настроек).
+
+        Возвращает (invite_id, max_uses, expires_ts) или None при ошибке.
+        """
+        max_uses = max_uses or getattr(config, "INVITE_MAX_USES", INVITE_MAX_USES)
+        lifetime = lifetime or getattr(config, "INVITE_LIFETIME", INVITE_LIFETIME)
+        expires_ts = int(time.time()) + lifetime if lifetime else None
+        invite_id = await self._repo.insert_invite(kind, target_id, creator_id, max_uses, expires_ts)
+        if invite_id is None:
+            return None
+        return invite_id, max_uses, expires_ts
+
+    async def redeem(self, invite_id: int, kind: str, target_id: int) -> str | None:
+        """Засчитывает использование. Возвращает None или причину отказа (INVITE_*)."""
+        now = time.time()
+        invite = self._hot.get(invite_id)
+        if invite is None:
+            row = await self._repo.redeem_invite(invite_id, kind, target_id, int(now))
+            if row is None:
+                self.rejected += 1
+                return await self._rejection(invite_id, kind, target_id)
+            invite = self._hot.get(invite_id)
+            if invite is None:
+                self._hot[invite_id] = _Invite(kind, target_id, *row)
+            else:
+                invite.uses += 1  # ссылку загрузил параллельный запрос; это использование уже в БД
+            self.redeemed += 1
+            return None
+
+        if invite.kind != kind or invite.target_id != target_id:
+            reason = INVITE_UNKNOWN
+        elif invite.expires_ts is not None and invite.expires_ts <= now:
+            reason = INVITE_EXPIRED
+        elif invite.max_uses is not None and invite.uses >= invite.max_uses:
+            reason = INVITE_EXHAUSTED
+        else:
+            invite.uses += 1
+            invite.pending += 1
+            invite.last_used = time.monotonic()
+            self.redeemed += 1
+            return None
+        self.rejected += 1
+        return reason
+
+    async def _rejection(self, invite_id: int, kind: str, target_id: int) -> str:
+        invite = await self._repo.get_invite(invite_id)
+        if invite is None or invite['kind'] != kind or invite['target_id'] != target_id:
+            return INVITE_UNKNOWN
+        if invite['expires_ts'] is not None and invite['expires_ts'] <= time.time():
+            return INVITE_EXPIRED
+        return INVITE_EXHAUSTED
+
+    async def flush(self, context: CallbackContext | None = None):
+        """Записывает накопленные использования одним пакетом и выгружает остывшие ссылки."""
+        deltas = [(invite_id, invite.pending) for invite_id, invite in self._hot.items() if invite.pending > 0]
+        if deltas:
+            for invite_id, _ in deltas:
+                self._hot[invite_id].pending = 0
+            if not await self._repo.add_invite_uses(deltas):
+                for invite_id, delta in deltas:  # повторим на следующем цикле
+                    invite = self._hot.get(invite_id)
+                    if invite is not None:
+                        invite.pending += delta
+                return
+            self.flushes += 1
+        cold_before = time.monotonic() - self.flush_interval
+        for invite_id in [invite_id for invite_id, invite in self._hot.items()
+                          if invite.pending == 0 and invite.last_used < cold_before]:
+            del self._hot[invite_id]
+
+    def stats(self) -> dict:
+        """Возвращает число горячих ссылок, ожидающих записи использований и счетчики с запуска."""
+        return {
+            "hot": len(self._hot),
+            "pending": sum(invite.pending for invite in self._hot.values()),
+            "redeemed": self.redeemed,
+            "rejected": self.rejected,
+            "flushes": self.flushes,
+        }
@@ -1,7 +1,8 @@
 import logging
-from telegram.ext import ApplicationBuilder, Defaults
+from telegram.ext import ApplicationBuilder, Defaults, TypeHandler
 from telegram import  LinkPreviewOptions, Update
 import asyncio
+import time
 from broadcasts import *
 from main_menu import *
 from queues import *
@@ -12,19 +13,63 @@ from telegram.ext import (
 )
 from config import *
 from varibles import *
-from db import create_connection, create_tables
+from migrations import run_migrations
+from repository import Repository
+from queue_engine import QueueEngine
+from delivery import DeliveryEngine, PriorityRateLimiter, Reachability
+from scheduler import Scheduler
+from timezones import timezone_lookup
+from crypto import invite_tokens
+from invites import InviteLedger
+from router import CallbackRouter
+from callbacks import *
 
 # Настройка логирования
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def format_stats(stats: dict) -> str:
+    return ", ".join(f"{name}={value:.3f}" if isinstance(value, float) else f"{name}={value}" for name, value in stats.items())
+
+async def log_runtime_stats(context: CallbackContext) -> None:
+    """Пишет в лог счетчики кэша профилей и исходящих сообщений по полосам."""
+    logger.info("Кэш профилей: " + format_stats(context.bot_data['repo'].cache_stats()))
+    logger.info("Кэш часовых поясов: " + format_stats(timezone_lookup.stats()))
+    logger.info("Кэш токенов приглашений: " + format_stats(invite_tokens.stats()))
+    outbound = context.bot.rate_limiter.stats()
+    flood_waits = outbound.pop("flood_waits")
+    for lane, stats in outbound.items():
+        logger.info(f"Исходящие ({lane}): " + format_stats(stats))
+    logger.info(f"Flood wait от Telegram: {flood_waits}")
+    logger.info("Массовая отправка: " + format_stats(context.bot_data['delivery'].stats()))
+    logger.info("Недоступные получатели: " + format_stats(context.bot_data['reachability'].stats()))
+    logger.info("Отложенные задачи: " + format_stats(context.bot_data['scheduler'].stats()))
+    logger.info("Приглашения: " + format_stats(context.bot_data['invites'].stats()))
+    logger.info("callback_data: " + format_stats(context.bot_data['router'].codec.stats()))
+    for route, stats in context.bot_data['router'].stats().items():
+        logger.info(f"Кнопка {route}: " + format_stats(stats))
+
+async def flush_invites_on_stop(application) -> None:
+    """Записывает накопленные использования приглашений перед остановкой."""
+    await application.bot_data['invites'].flush()
+
 def main():
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    conn = create_connection()
-    if conn:
-        create_tables(conn)
-        migrate_database(conn)
+    repo = Repository()
+    queue_engine = QueueEngine(repo)
+    reachability = Reachability(repo)
+    if loop.run_until_complete(repo.open()):
+        loop.run_until_complete(repo.run_exclusive(run_migrations))
+        for role, pragmas in loop.run_until_complete(repo.pragma_report()).items():
+            logger.info(f"SQLite ({role}): " + ", ".join(f"{name}={value}" for name, value in pragmas.items()))
+        loop.run_until_complete(queue_engine.load())
+        logger.info(f"Недоступных получателей: {loop.run_until_complete(reachability.load())}")
+        # Рассылки, время которых уже прошло, помечаем удаленными; прерванные
+        # (с неотправленными получателями) продолжит планировщик
+        expired = loop.run_until_complete(repo.expire_broadcasts_before(int(time.time())))
+        if expired:
+            logger.info(f"Просроченных рассылок помечено удаленными: {expired}")
 
     job_queue = JobQueue()
     builder = ApplicationBuilder().token(TOKEN)
@@ -35,16 +80,34 @@ def main():
     )
     builder.defaults(defaults)
     builder.job_queue(job_queue)
+    builder.rate_limiter(PriorityRateLimiter())
+    builder.post_init(set_commands)
+    builder.post_stop(flush_invites_on_stop)
 
 
     application = builder.build()
-    application.bot_data['conn'] = conn
-    loop.run_until_complete(set_commands(application))
+    application.bot_data['repo'] = repo
+    application.bot_data['queues'] = queue_engine
+    application.bot_data['reachability'] = reachability
+    application.bot_data['delivery'] = DeliveryEngine(reachability=reachability)
+    scheduler = Scheduler(repo)
+    scheduler.register(JOB_BROADCAST, send_broadcast)
+    scheduler.register(JOB_DELETE_QUEUE, delete_queue_job)
+    application.bot_data['scheduler'] = scheduler
+    invites = InviteLedger(repo)
+    application.bot_data['invites'] = invites
+    if TZ_WARMUP:
+        loop.run_until_complete(timezone_lookup.warm_up())
 
-    loop.run_until_complete(load_scheduled_broadcasts(job_queue))
+    scheduler.start(job_queue)
+    job_queue.run_repeating(invites.flush, interval=invites.flush_interval, first=invites.flush_interval)
+    job_queue.run_repeating(log_runtime_stats, interval=STATS_LOG_INTERVAL, first=STATS_LOG_INTERVAL)
+
+    # Нажатия кнопок разбираются один раз (см. callbacks.py); кнопки диалогов проверяются router.pattern()
+    router = CallbackRouter(fallback=unknown)
 
     create_queue_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(create_queue, pattern="^create_queue$")],
+        entry_points=[CallbackQueryHandler(create_queue, pattern=router.pattern(CB_CREATE_QUEUE))],
         states={
             QUEUE_NAME: [
                 CommandHandler("cancel", cancel),
@@ -65,16 +128,17 @@ def main():
             ],
             CHOOSE_LOCATION: [
                 CommandHandler("cancel", cancel),
-                CallbackQueryHandler(create_queue_location, pattern="^location_(mathfac|custom)$"),
+                CallbackQueryHandler(router.bind(create_queue_location), pattern=router.pattern(CB_LOCATION, CB_LOCATION_CUSTOM)),
                 MessageHandler(filters.LOCATION, create_queue_location_custom),
+                CommandHandler("done", create_queue_location_done),
             ],
             CHOOSE_GROUP: [
                 CommandHandler("cancel", cancel),
-                CallbackQueryHandler(create_queue_choose_group, pattern="^select_group_.*")
+                CallbackQueryHandler(router.bind(create_queue_choose_group), pattern=router.pattern(CB_SELECT_GROUP, CB_SELECT_GROUP_NONE))
             ],
             SEND_NOTIFICATION: [
                 CommandHandler("cancel", cancel),
-                CallbackQueryHandler(send_notification_choice, pattern="^send_notification_(yes|no)$")
+                CallbackQueryHandler(router.bind(send_notification_choice), pattern=router.pattern(CB_SEND_NOTIFICATION))
             ]
         },
         fallbacks=[CommandHandler("cancel", cancel)],
@@ -82,7 +146,7 @@ def main():
     application.add_handler(create_queue_handler)
 
     change_name_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(change_name_start, pattern="^change_name$")],
+        entry_points=[CallbackQueryHandler(change_name_start, pattern=router.pattern(CB_CHANGE_NAME))],
         states={
             CHANGE_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, change_name)
@@ -93,7 +157,7 @@ def main():
     application.add_handler(change_name_handler)
 
     create_group_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(create_group, pattern="^create_group$")],
+        entry_points=[CallbackQueryHandler(create_group, pattern=router.pattern(CB_CREATE_GROUP))],
         states={
             GROUP_NAME: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, create_group_name)
@@ -105,15 +169,16 @@ def main():
 
     # ConversationHandler для рассылки
     broadcast_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(create_broadcast, pattern="^create_broadcast$")],
+        entry_points=[CallbackQueryHandler(create_broadcast, pattern=router.pattern(CB_CREATE_BROADCAST))],
         states={
             BROADCAST_MESSAGE: [
                 CommandHandler("cancel", cancel),
-                MessageHandler(filters.TEXT | filters.PHOTO | filters.Document.ALL, broadcast_message)
+                CommandHandler("end", broadcast_message),
+                MessageHandler(~filters.COMMAND, broadcast_message)
             ],
             BROADCAST_RECIPIENTS: [
                 CommandHandler("cancel", cancel),
-                CallbackQueryHandler(broadcast_choose_group, pattern="^select_group_"),
+                CallbackQueryHandler(router.bind(broadcast_choose_group), pattern=router.pattern(CB_SELECT_GROUP, CB_SELECT_GROUP_NONE)),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, broadcast_recipients_input),
             ],
             BROADCAST_SCHEDULE: [
@@ -125,6 +190,9 @@ def main():
     )
     application.add_handler(broadcast_handler)
 
+    # Любое обращение пользователя снимает с него признак недоступности
+    application.add_handler(TypeHandler(Update, restore_reachability), group=-1)
+
     application.add_handler(CommandHandler("start", handle_deeplink, filters.Regex(JOIN_QUEUE_PAYLOAD)))
     application.add_handler(CommandHandler("start", handle_group_deeplink, filters.Regex(JOIN_GROUP_PAYLOAD)))
 
@@ -142,9 +210,9 @@ def main():
 
     # ConversationHandler для выбора часового пояса
     timezone_conv_handler = ConversationHandler(
-        entry_points=[CallbackQueryHandler(select_timezone_start, pattern="^select_timezone$")],
+        entry_points=[CallbackQueryHandler(select_timezone_start, pattern=router.pattern(CB_SELECT_TIMEZONE))],
         states={
-            SELECT_TIMEZONE: [CallbackQueryHandler(select_timezone)],
+            SELECT_TIMEZONE: [CallbackQueryHandler(router.bind(select_timezone), pattern=router.pattern(CB_SELECT_TZ, CB_SELECT_LOCATION_TZ))],
             # SELECT_TIMEZONE_BY_LOCATION: [CallbackQueryHandler(select_timezone_by_location, pattern="^select_location_tz$")],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
@@ -156,48 +224,52 @@ def main():
 
     application.add_handler(CommandHandler("cancel", cancel))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("unreachable", unreachable_report))
+    application.add_handler(CommandHandler("nearby", nearby_command))
+    application.add_handler(CommandHandler("add_location", add_location_command))
 
     # Обработчики сообщений
     application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_web_app_data))
 
     
-    # Обработчики нажатий кнопок
-    application.add_handler(CallbackQueryHandler(main_menu_buttons, pattern="^(show_queues|show_groups|show_broadcasts|change_name|select_timezone|help|main_menu)$"))
-    application.add_handler(CallbackQueryHandler(queue_info_button, pattern="^queue_info_"))
-    application.add_handler(CallbackQueryHandler(group_info_button, pattern="^group_info_"))
-    application.add_handler(CallbackQueryHandler(broadcast_info_button, pattern="^broadcast_info_"))
-    application.add_handler(CallbackQueryHandler(skip_button, pattern="^skip_"))
-    application.add_handler(CallbackQueryHandler(leave_button, pattern="^leave_queue_"))
-    application.add_handler(CallbackQueryHandler(delete_queue_button, pattern="^delete_queue_"))
-    application.add_handler(CallbackQueryHandler(leave_group_button, pattern="^leave_group_"))
-    application.add_handler(CallbackQueryHandler(delete_group_button, pattern="^delete_group_"))
-    application.add_handler(CallbackQueryHandler(cancel_broadcast_button, pattern="^cancel_broadcast_"))
-    application.add_handler(CallbackQueryHandler(handle_join_queue, pattern="^join_queue_"))
-    application.add_handler(CallbackQueryHandler(join_group, pattern="^join_group_"))
-    application.add_handler(CallbackQueryHandler(back_to_main_menu, pattern="^back_to_main_menu$"))
-
-    # Обработчики для подтверждения действий
-    application.add_handler(CallbackQueryHandler(generate_queue_invite_button, pattern="^invite_queue_"))
-    application.add_handler(CallbackQueryHandler(generate_group_invite_button, pattern="^invite_group_"))
-    application.add_handler(CallbackQueryHandler(confirm_leave_queue, pattern="^confirm_leave_queue_"))
-    application.add_handler(CallbackQueryHandler(cancel_leave_queue, pattern="^cancel_leave_queue_"))
-    application.add_handler(CallbackQueryHandler(confirm_skip, pattern="^confirm_skip_"))
-    application.add_handler(CallbackQueryHandler(cancel_skip, pattern="^cancel_skip_"))
-    application.add_handler(CallbackQueryHandler(confirm_delete_queue, pattern="^confirm_delete_queue_"))
-    application.add_handler(CallbackQueryHandler(cancel_delete_queue, pattern="^cancel_delete_queue_"))
-    application.add_handler(CallbackQueryHandler(confirm_delete_group, pattern="^confirm_delete_group_"))
-    application.add_handler(CallbackQueryHandler(cancel_delete_group, pattern="^cancel_delete_group_"))
-    application.add_handler(CallbackQueryHandler(confirm_leave_group, pattern="^confirm_leave_group_"))
-    application.add_handler(CallbackQueryHandler(cancel_leave_group, pattern="^cancel_leave_group_"))
-    application.add_handler(CallbackQueryHandler(confirm_cancel_broadcast, pattern="^confirm_cancel_broadcast_"))
-    application.add_handler(CallbackQueryHandler(cancel_cancel_broadcast, pattern="^cancel_cancel_broadcast_"))
-
-    application.add_handler(CallbackQueryHandler(unknown)) #Важно!
+    # Обработчики нажатий кнопок вне диалогов: один обработчик, действие кнопки — ключ словаря (см. router.py)
+    for action in (CB_SHOW_QUEUES, CB_SHOW_GROUPS, CB_SHOW_BROADCASTS, CB_CHANGE_NAME, CB_HELP, CB_MAIN_MENU):
+        router.add(action, main_menu_buttons, action)
+    router.add(CB_BACK_TO_MAIN_MENU, back_to_main_menu)
+    router.add(CB_QUEUE_INFO, queue_info_button)
+    router.add(CB_GROUP_INFO, group_info_button)
+    router.add(CB_BROADCAST_INFO, broadcast_info_button)
+    router.add(CB_SKIP, skip_button)
+    router.add(CB_LEAVE_QUEUE, leave_button)
+    router.add(CB_DELETE_QUEUE, delete_queue_button)
+    router.add(CB_LEAVE_GROUP, leave_group_button)
+    router.add(CB_DELETE_GROUP, delete_group_button)
+    router.add(CB_CANCEL_BROADCAST, cancel_broadcast_button)
+    router.add(CB_JOIN_QUEUE, handle_join_queue)
+    router.add(CB_JOIN_GROUP, join_group)
+
+    # Подтверждения действий
+    router.add(CB_INVITE_QUEUE, generate_queue_invite_button)
+    router.add(CB_INVITE_GROUP, generate_group_invite_button)
+    router.add(CB_CONFIRM_LEAVE_QUEUE, confirm_leave_queue)
+    router.add(CB_CANCEL_LEAVE_QUEUE, cancel_leave_queue)
+    router.add(CB_CONFIRM_SKIP, confirm_skip)
+    router.add(CB_CANCEL_SKIP, cancel_skip)
+    router.add(CB_CONFIRM_DELETE_QUEUE, confirm_delete_queue)
+    router.add(CB_CANCEL_DELETE_QUEUE, cancel_delete_queue)
+    router.add(CB_CONFIRM_DELETE_GROUP, confirm_delete_group)
+    router.add(CB_CANCEL_DELETE_GROUP, cancel_delete_group)
+    router.add(CB_CONFIRM_LEAVE_GROUP, confirm_leave_group)
+    router.add(CB_CANCEL_LEAVE_GROUP, cancel_leave_group)
+    router.add(CB_CONFIRM_CANCEL_BROADCAST, confirm_cancel_broadcast)
+    router.add(CB_CANCEL_CANCEL_BROADCAST, cancel_cancel_broadcast)
+    application.bot_data['router'] = router
+    application.add_handler(router.handler()) #Важно: последним, неизвестные нажатия уходят в unknown
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
-    if conn:
-        conn.close()
-        logger.info("Соединение с базой данных закрыто")
+    logger.info(f"Кэш профилей при остановке: {repo.cache_stats()}")
+    timezone_lookup.close()
+    repo.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -2,9 +2,8 @@ import json
 import logging
 from telegram import Update, BotCommand, ReplyKeyboardRemove
 from telegram.ext import CallbackContext, ConversationHandler
-from config import ADMIN_USER_ID
+from config import ADMIN_USER_ID, ADMIN_ID
 from varibles import *
-from db import get_user_data, set_user_name, update_user_name, update_user_state
 from utils import *
 from groups import *
 from broadcasts import *
@@ -15,10 +14,10 @@ logger = logging.getLogger(__name__)
 async def start(update: Update, context: CallbackContext) -> int:
     """Обработка команды /start."""
     user_id = update.effective_user.id
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     query = update.callback_query
 
-    result = get_user_data(conn, user_id)
+    result = await repo.get_user_data(user_id)
     if result:
         reply_markup = build_main_menu()
         if context.user_data.get('edit_message') and query:
@@ -48,13 +47,13 @@ async def set_name(update: Update, context: CallbackContext) -> int:
     """Обработчик ввода имени пользователя."""
     user_id = update.effective_user.id
     user_name = update.message.text
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
 
     # Сохраняем имя пользователя
-    set_user_name(conn, user_id, user_name, time_zone=None)
+    await repo.set_user_name(user_id, user_name, time_zone=None)
 
     # Отправляем кнопку "Выбрать часовой пояс"
-    keyboard = [[InlineKeyboardButton("Выбрать часовой пояс", callback_data="select_timezone")]]
+    keyboard = [[InlineKeyboardButton("Выбрать часовой пояс", callback_data=pack(CB_SELECT_TIMEZONE))]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(f"Спасибо, {user_name}! Теперь выберите ваш часовой пояс:", reply_markup=reply_markup)
 
@@ -70,17 +69,16 @@ async def select_timezone_start(update: Update, context: CallbackContext) -> int
 
     return SELECT_TIMEZONE
 
-async def select_timezone(update: Update, context: CallbackContext) -> int:
-    """Обработчик выбора часового пояса."""
+async def select_timezone(update: Update, context: CallbackContext, timezone_code: str | None = None) -> int:
+    """Обработчик выбора часового пояса (timezone_code None — определить по геолокации)."""
     query = update.callback_query
 
-    if query.data.startswith("select_tz_"):
-        timezone_code = query.data.split("_", 2)[2]
-        conn = context.bot_data['conn']
+    if timezone_code is not None:
+        repo = context.bot_data['repo']
         user_id = update.effective_user.id
 
         # Обновляем часовой пояс пользователя в базе данных
-        update_user_timezone(conn, user_id, timezone_code)
+        await repo.update_user_timezone(user_id, timezone_code)
 
         # Находим русское название для выбранного часового пояса
         timezone_name = next((name for name, code in RUSSIAN_TIMEZONES.items() if code == timezone_code), timezone_code)
@@ -90,7 +88,7 @@ async def select_timezone(update: Update, context: CallbackContext) -> int:
         await query.message.reply_text("Главное меню", reply_markup=reply_markup)
         return ConversationHandler.END
 
-    elif query.data == "select_location_tz":
+    else:
         # Запрашиваем геолокацию через Web App
         reply_markup = build_web_app_location_button(rec_source="get_tz")
         await query.edit_message_text("Определение часового пояса по геолокации",)
@@ -107,16 +105,16 @@ async def select_timezone_by_location(update: Update, context: CallbackContext)
         if not lat or not lon:
             await update.message.reply_text("❌ Ошибка: не удалось получить координаты.", reply_markup=ReplyKeyboardRemove())
             return
-        timezone = get_timezone_by_location(lat, lon)
+        timezone = await get_timezone_by_location(lat, lon)
         if not timezone:
             await update.message.reply_text("❌ Не удалось определить часовой пояс по вашей геолокации.", reply_markup=ReplyKeyboardRemove())
             return
 
-        conn = context.bot_data['conn']
+        repo = context.bot_data['repo']
         user_id = update.effective_user.id
 
         # Обновляем часовой пояс пользователя в базе данных
-        update_user_timezone(conn, user_id, timezone)
+        await repo.update_user_timezone(user_id, timezone)
 
         # Находим русское название для определенного часового пояса
         timezone_name = next((name for name, code in RUSSIAN_TIMEZONES.items() if code == timezone), timezone)
@@ -141,11 +139,11 @@ async def change_name(update: Update, context: CallbackContext) -> int:
     user = update.message.from_user
     user_id = user.id
     new_name = update.message.text
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
 
-    update_user_name(conn, user_id, new_name)
+    await repo.update_user_name(user_id, new_name)
     await update.message.reply_text(f"✅ Ваше имя изменено на *{new_name}*.")
-    update_user_state(conn, user_id, "name_entered")
+    await repo.update_user_state(user_id, "name_entered")
 
     reply_markup = build_main_menu()
     await update.message.reply_text("Главное меню", reply_markup=reply_markup)
@@ -161,15 +159,39 @@ async def help_command(update: Update, context: CallbackContext) -> None:
     """Выводит список доступных команд."""
     help_text = (
         "/start - Начать\n"
+        "/nearby - Очереди рядом\n"
         "/cancel - Отменить\n"
         f"По всем вопросам — {ADMIN_USER_ID}\n"
     )
     await update.effective_message.reply_text(help_text, parse_mode=None)
 
+async def restore_reachability(update: Update, context: CallbackContext) -> None:
+    """Снимает признак недоступности с пользователя, который снова пишет боту."""
+    if update.effective_user:
+        await context.bot_data['reachability'].restore(update.effective_user.id)
+
+async def unreachable_report(update: Update, context: CallbackContext) -> None:
+    """Отчет администратору о недоступных получателях."""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    repo = context.bot_data['repo']
+    by_reason = await repo.get_unreachable_stats()
+    stats = context.bot_data['reachability'].stats()
+    reasons = {"blocked": "заблокировали бота", "deactivated": "аккаунт удален", "chat_not_found": "чат не найден"}
+    lines = [f"🚫 *Недоступные получатели:* {sum(by_reason.values())}"]
+    lines += [f"• {reasons.get(reason, reason)}: {count}" for reason, count in by_reason.items()]
+    lines.append(
+        f"\nС момента запуска отмечено: {sum(count for name, count in stats.items() if name.startswith('flagged_'))}, "
+        f"вернулись: {stats['restored']}\n"
+        f"📉 Пропущено отправок: *{stats['skipped_sends']}*"
+    )
+    await update.message.reply_text("\n".join(lines))
+
 async def set_commands(app):
     """Устанавливает меню команд."""
     commands = [
         BotCommand("start", "Начать"),
+        BotCommand("nearby", "Очереди рядом"),
         BotCommand("cancel", "Отмена"),
         BotCommand("help", "Помощь"),
     ]
@@ -196,27 +218,25 @@ async def back_to_main_menu(update: Update, context: CallbackContext) -> None:
     reply_markup = build_main_menu()
     await query.edit_message_text("Главное меню", reply_markup=reply_markup)
 
-async def main_menu_buttons(update: Update, context: CallbackContext) -> None:
-    """Обработчик кнопок главного меню."""
+async def main_menu_buttons(update: Update, context: CallbackContext, action: int) -> None:
+    """Обработчик кнопок главного меню; action — код кнопки (CB_*)."""
     query = update.callback_query
     await query.answer()
 
-    if query.data == "show_queues":
+    if action == CB_SHOW_QUEUES:
         context.user_data['edit_message'] = True
         await show_queues(update, context)
-    elif query.data == "show_groups":
+    elif action == CB_SHOW_GROUPS:
         context.user_data['edit_message'] = True
         await show_groups(update, context)
-    elif query.data == "show_broadcasts":
+    elif action == CB_SHOW_BROADCASTS:
         context.user_data['edit_message'] = True
         await show_broadcasts(update, context)
-    elif query.data == "change_name":
+    elif action == CB_CHANGE_NAME:
         await change_name_start(update, context)
-    elif query.data == "select_timezone":
-        await select_timezone(update, context)
-    elif query.data == "help":
+    elif action == CB_HELP:
         await help_command(update, context)
-    elif query.data == "main_menu":
+    elif action == CB_MAIN_MENU:
         context.user_data['edit_message'] = True
         await start(update, context)
 
@@ -227,6 +247,8 @@ async def handle_web_app_data(update: Update, context: CallbackContext) -> None:
         rec_source = data.get("rec_source")
         if rec_source == "get_location":
             await get_web_app_loc(update, context)
+        elif rec_source == "nearby":
+            await show_nearby_queues(update, context)
         else:
             await select_timezone_by_location(update, context)
     except Exception as e:
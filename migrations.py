@@ -0,0 +1,608 @@
+"""Версионированные миграции схемы базы данных.
+
+Текущая версия схемы хранится в PRAGMA user_version. Каждая миграция из
+MIGRATIONS выполняется один раз в своей транзакции, по возрастанию версии.
+Изменения схемы добавляются только новыми миграциями в конец списка.
+
+Запуск вручную: python migrations.py [--database PATH] [--dry-run]
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+import pytz
+from config import DATABASE_NAME, MF_COORDINATES
+from db import create_connection, parse_user_ids, POSITION_GAP, JOB_BROADCAST, JOB_DELETE_QUEUE
+from varibles import QUEUE_LIFETIME
+
+logger = logging.getLogger(__name__)
+
+# Версия 1: исходная схема, которую раньше создавали create_tables() и
+# migrate_database(). Не изменять — новые столбцы и таблицы описываются
+# следующими миграциями.
+TABLES_SCHEMA = {
+    'users': [
+        ('user_id', 'INTEGER', True, False),
+        ('name', 'TEXT', False, True),
+        ('state', 'TEXT', False, True),
+        ('time_zone', 'TEXT', False, True)
+    ],
+    'queues': [
+        ('queue_id', 'INTEGER', True, False),
+        ('queue_name', 'TEXT', False, False),
+        ('start_time', 'TEXT', False, True),
+        ('latitude', 'REAL', False, True),
+        ('longitude', 'REAL', False, True),
+        ('creator_id', 'INTEGER', False, True),
+        ('group_id', 'INTEGER', False, True),
+        ('time_without_location', 'TEXT', False, True)
+    ],
+    'queue_users': [
+        ('queue_id', 'INTEGER', False, False),
+        ('user_id', 'INTEGER', False, False),
+        ('join_time', 'TEXT', False, False),
+        ('position', 'INTEGER', False, True)
+    ],
+    'groups': [
+        ('group_id', 'INTEGER', True, False),
+        ('group_name', 'TEXT', False, False),
+        ('creator_id', 'INTEGER', False, True)
+    ],
+    'group_users': [
+        ('group_id', 'INTEGER', False, False),
+        ('user_id', 'INTEGER', False, False)
+    ],
+    'broadcasts': [
+        ('id', 'INTEGER', True, False),
+        ('message_text', 'TEXT', False, True),
+        ('message_photo', 'TEXT', False, True),
+        ('message_document', 'TEXT', False, True),
+        ('recipients', 'TEXT', False, True),
+        ('send_time', 'TEXT', False, True),
+        ('creator_id', 'INTEGER', False, True),
+        ('is_deleted', 'BOOLEAN', False, False)
+    ]
+}
+
+
+def create_tables(conn):
+    """Создает таблицы в базе данных на основе схемы TABLES_SCHEMA."""
+    try:
+        cursor = conn.cursor()
+        
+        for table_name, columns in TABLES_SCHEMA.items():
+            # Формируем SQL для создания таблицы
+            columns_sql = []
+            primary_keys = []
+            
+            for column in columns:
+                name, type_, is_pk, is_nullable = column
+                column_sql = f"{name} {type_}"
+                if is_pk:
+                    if type_ == 'INTEGER':
+                        column_sql += " PRIMARY KEY AUTOINCREMENT"
+                    else:
+                        primary_keys.append(name)
+                if not is_nullable:
+                    column_sql += " NOT NULL"
+                
+                columns_sql.append(column_sql)
+            
+            if primary_keys:
+                columns_sql.append(f"PRIMARY KEY ({', '.join(primary_keys)})")
+            
+            # Создаем таблицу
+            create_sql = f"""
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    {', '.join(columns_sql)}
+                )
+            """
+            cursor.execute(create_sql)
+            
+            # Создаем индексы для внешних ключей
+            if table_name == 'queue_users':
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_queue_users_queue ON queue_users(queue_id)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_queue_users_user ON queue_users(user_id)
+                """)
+            elif table_name == 'group_users':
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_group_users_group ON group_users(group_id)
+                """)
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_group_users_user ON group_users(user_id)
+                """)
+        
+        logger.info("Таблицы созданы успешно")
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка при создании таблиц: {e}")
+        raise
+
+def migrate_database(conn):
+    """Проверяет и добавляет недостающие столбцы на основе схемы TABLES_SCHEMA."""
+    try:
+        cursor = conn.cursor()
+        
+        for table_name, columns in TABLES_SCHEMA.items():
+            # Проверяем существование таблицы
+            cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table_name}'")
+            if not cursor.fetchone():
+                logger.warning(f"Таблица {table_name} не существует, будет создана при следующем запуске")
+                continue
+                
+            # Получаем текущие столбцы таблицы
+            cursor.execute(f"PRAGMA table_info({table_name})")
+            existing_columns = {column[1] for column in cursor.fetchall()}
+            
+            # Проверяем каждый ожидаемый столбец
+            for column in columns:
+                name, type_, is_pk, is_nullable = column
+                if name not in existing_columns:
+                    try:
+                        column_def = f"{name} {type_}"
+                        if not is_nullable:
+                            column_def += " NOT NULL"
+                        
+                        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_def}")
+                        logger.info(f"Добавлен столбец {name} в таблицу {table_name}")
+                    except sqlite3.Error as e:
+                        logger.error(f"Ошибка при добавлении столбца {name} в {table_name}: {e}")
+        
+        ensure_queue_positions(conn)
+        logger.info("Миграция базы данных завершена успешно")
+        
+    except sqlite3.Error as e:
+        logger.error(f"Критическая ошибка при миграции базы данных: {e}")
+        raise
+
+def ensure_queue_positions(conn):
+    """Создает индекс (queue_id, position) и заполняет позиции для старых записей.
+
+    Раньше порядок определялся по join_time в часовом поясе участника, поэтому
+    для заполнения время приводится к UTC перед сортировкой.
+    """
+    cursor = conn.cursor()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_queue_users_position ON queue_users(queue_id, position)")
+    cursor.execute("SELECT DISTINCT queue_id FROM queue_users WHERE position IS NULL")
+    queue_ids = [row[0] for row in cursor.fetchall()]
+
+    for queue_id in queue_ids:
+        cursor.execute("SELECT rowid, user_id, join_time FROM queue_users WHERE queue_id = ?", (queue_id,))
+        rows = cursor.fetchall()
+        def sort_key(row):
+            try:
+                joined = datetime.fromisoformat(row[2])
+                joined = joined.replace(tzinfo=pytz.UTC) if joined.tzinfo is None else joined.astimezone(pytz.UTC)
+            except (TypeError, ValueError):
+                joined = datetime.max.replace(tzinfo=pytz.UTC)
+            return joined, row[0]
+        rows.sort(key=sort_key)
+        cursor.executemany(
+            "UPDATE queue_users SET position = ? WHERE rowid = ?",
+            [((index + 1) * POSITION_GAP, row[0]) for index, row in enumerate(rows)]
+        )
+        logger.info(f"Заполнены позиции участников очереди {queue_id}")
+
+def _baseline(conn):
+    """Создает исходную схему и дополняет старые базы недостающими столбцами.
+
+    create_tables() и migrate_database() не фиксируют изменения сами: все
+    выполняется в транзакции миграции и откатывается целиком при ошибке.
+    """
+    create_tables(conn)
+    migrate_database(conn)
+
+def _rebuild_table(conn, table: str, create_sql: str, select_sql: str, indexes: tuple = ()):
+    """Пересоздает таблицу по новой схеме, сохраняя данные и счетчик AUTOINCREMENT."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+    row = cursor.fetchone()
+    old_seq = row[0] if row else 0
+
+    cursor.execute(create_sql.format(table=f"{table}_new"))
+    cursor.execute(f"INSERT OR IGNORE INTO {table}_new {select_sql}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    if old_seq:
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,))
+        row = cursor.fetchone()
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = ?", (table,))
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, max(old_seq, row[0] if row else 0)))
+
+    for index_sql in indexes:
+        cursor.execute(index_sql)
+    logger.info(f"Таблица {table} пересоздана")
+
+def _keys_and_cascades(conn):
+    """Первичные ключи связующих таблиц, внешние ключи с каскадным удалением, покрывающие индексы."""
+    _rebuild_table(conn, "queues", """
+        CREATE TABLE {table} (
+            queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            queue_name TEXT NOT NULL,
+            start_time TEXT,
+            latitude REAL,
+            longitude REAL,
+            creator_id INTEGER,
+            group_id INTEGER REFERENCES groups(group_id) ON DELETE SET NULL,
+            time_without_location TEXT
+        )
+    """, """
+        SELECT queue_id, queue_name, start_time, latitude, longitude, creator_id,
+               CASE WHEN group_id IN (SELECT group_id FROM groups) THEN group_id END,
+               time_without_location
+        FROM queues
+    """, (
+        "CREATE INDEX idx_queues_group ON queues(group_id)",
+        "CREATE INDEX idx_queues_creator ON queues(creator_id)",
+    ))
+    _rebuild_table(conn, "queue_users", """
+        CREATE TABLE {table} (
+            queue_id INTEGER NOT NULL REFERENCES queues(queue_id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            join_time TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (queue_id, user_id)
+        ) WITHOUT ROWID
+    """, """
+        SELECT queue_id, user_id, join_time, COALESCE(position, 0) FROM queue_users
+        WHERE queue_id IN (SELECT queue_id FROM queues)
+        ORDER BY queue_id, position
+    """, (
+        "CREATE INDEX idx_queue_users_position ON queue_users(queue_id, position, user_id)",
+        "CREATE INDEX idx_queue_users_user ON queue_users(user_id, queue_id)",
+    ))
+    _rebuild_table(conn, "group_users", """
+        CREATE TABLE {table} (
+            group_id INTEGER NOT NULL REFERENCES groups(group_id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (group_id, user_id)
+        ) WITHOUT ROWID
+    """, """
+        SELECT group_id, user_id FROM group_users
+        WHERE group_id IN (SELECT group_id FROM groups)
+    """, (
+        "CREATE INDEX idx_group_users_user ON group_users(user_id, group_id)",
+    ))
+
+def _iso_to_epoch(value) -> int | None:
+    """Переводит сохраненную строку ISO в секунды UTC. Строки без смещения считаются временем UTC."""
+    if value is None:
+        return None
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=pytz.UTC)
+    return int(moment.timestamp())
+
+def _epoch_timestamps(conn):
+    """Время хранится целым числом секунд UTC вместо строк ISO в разных форматах."""
+    conn.create_function("iso_to_epoch", 1, _iso_to_epoch, deterministic=True)
+    _rebuild_table(conn, "queues", """
+        CREATE TABLE {table} (
+            queue_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            queue_name TEXT NOT NULL,
+            start_ts INTEGER,
+            latitude REAL,
+            longitude REAL,
+            creator_id INTEGER,
+            group_id INTEGER REFERENCES groups(group_id) ON DELETE SET NULL,
+            time_without_location_ts INTEGER
+        )
+    """, """
+        SELECT queue_id, queue_name, iso_to_epoch(start_time), latitude, longitude, creator_id,
+               group_id, iso_to_epoch(time_without_location)
+        FROM queues
+    """, (
+        "CREATE INDEX idx_queues_group ON queues(group_id)",
+        "CREATE INDEX idx_queues_creator ON queues(creator_id)",
+        "CREATE INDEX idx_queues_start ON queues(start_ts)",
+    ))
+    _rebuild_table(conn, "queue_users", """
+        CREATE TABLE {table} (
+            queue_id INTEGER NOT NULL REFERENCES queues(queue_id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            join_ts INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            PRIMARY KEY (queue_id, user_id)
+        ) WITHOUT ROWID
+    """, """
+        SELECT queue_id, user_id, COALESCE(iso_to_epoch(join_time), 0), position FROM queue_users
+        ORDER BY queue_id, position
+    """, (
+        "CREATE INDEX idx_queue_users_position ON queue_users(queue_id, position, user_id)",
+        "CREATE INDEX idx_queue_users_user ON queue_users(user_id, queue_id)",
+    ))
+    _rebuild_table(conn, "broadcasts", """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_text TEXT,
+            message_photo TEXT,
+            message_document TEXT,
+            recipients TEXT,
+            send_ts INTEGER,
+            creator_id INTEGER,
+            is_deleted INTEGER NOT NULL DEFAULT 0
+        )
+    """, """
+        SELECT id, message_text, message_photo, message_document, recipients,
+               iso_to_epoch(send_time), creator_id, COALESCE(is_deleted, 0)
+        FROM broadcasts
+    """, (
+        "CREATE INDEX idx_broadcasts_send ON broadcasts(is_deleted, send_ts)",
+    ))
+
+def _broadcast_deliveries(conn):
+    """Получатели рассылок в таблице broadcast_deliveries с состоянием доставки вместо строки recipients."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated_ts INTEGER,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("""
+        CREATE INDEX idx_broadcast_deliveries_pending ON broadcast_deliveries(broadcast_id, user_id)
+        WHERE status = 'pending'
+    """)
+
+    # Переносим получателей только еще не отправленных рассылок: прошедшие
+    # раньше помечались удаленными при запуске и не отправлялись
+    cursor.execute("SELECT id, recipients FROM broadcasts WHERE is_deleted = 0 AND send_ts >= ?", (int(time.time()),))
+    for broadcast_id, recipients in cursor.fetchall():
+        cursor.executemany(
+            "INSERT OR IGNORE INTO broadcast_deliveries (broadcast_id, user_id) VALUES (?, ?)",
+            ((broadcast_id, user_id) for user_id in parse_user_ids(recipients))
+        )
+
+    _rebuild_table(conn, "broadcasts", """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_text TEXT,
+            message_photo TEXT,
+            message_document TEXT,
+            send_ts INTEGER,
+            creator_id INTEGER,
+            is_deleted INTEGER NOT NULL DEFAULT 0
+        )
+    """, """
+        SELECT id, message_text, message_photo, message_document, send_ts, creator_id, is_deleted
+        FROM broadcasts
+    """, (
+        "CREATE INDEX idx_broadcasts_send ON broadcasts(is_deleted, send_ts)",
+    ))
+
+def _broadcast_parts(conn):
+    """Части рассылки отдельными строками в исходном порядке со ссылкой на сообщение автора."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE broadcast_parts (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            part_no INTEGER NOT NULL,
+            chat_id INTEGER,
+            message_id INTEGER,
+            type TEXT NOT NULL,
+            content TEXT,
+            PRIMARY KEY (broadcast_id, part_no)
+        ) WITHOUT ROWID
+    """)
+    # У старых рассылок нет ссылок на исходные сообщения: переносим
+    # содержимое в том порядке, в котором его отправлял send_broadcast
+    cursor.execute("SELECT id, message_text, message_photo, message_document FROM broadcasts")
+    rows = []
+    for broadcast_id, text, photo, document in cursor.fetchall():
+        parts = [(kind, content) for kind, content in (("text", text), ("photo", photo), ("document", document)) if content]
+        rows.extend((broadcast_id, part_no, kind, content) for part_no, (kind, content) in enumerate(parts))
+    cursor.executemany("INSERT INTO broadcast_parts (broadcast_id, part_no, type, content) VALUES (?, ?, ?, ?)", rows)
+
+    _rebuild_table(conn, "broadcasts", """
+        CREATE TABLE {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            send_ts INTEGER,
+            creator_id INTEGER,
+            is_deleted INTEGER NOT NULL DEFAULT 0
+        )
+    """, """
+        SELECT id, send_ts, creator_id, is_deleted FROM broadcasts
+    """, (
+        "CREATE INDEX idx_broadcasts_send ON broadcasts(is_deleted, send_ts)",
+    ))
+
+def _scheduled_jobs(conn):
+    """Отложенные задачи (рассылки и удаление очередей) в таблице с индексом по сроку."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE scheduled_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            due_ts INTEGER NOT NULL,
+            UNIQUE (kind, target_id)
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_scheduled_jobs_due ON scheduled_jobs(due_ts)")
+    # Раньше эти задачи жили только в JobQueue: восстанавливаем их по данным.
+    # Задачи нужны рассылкам, время которых еще не наступило, и прерванным (с
+    # получателями pending); остальные прошедшие main() пометит удаленными
+    # (expire_broadcasts_before), и их задачи сработали бы впустую.
+    now = int(time.time())
+    cursor.execute("""
+        INSERT INTO scheduled_jobs (kind, target_id, due_ts)
+        SELECT ?, id, COALESCE(send_ts, 0) FROM broadcasts
+        WHERE is_deleted = 0 AND (send_ts >= ? OR EXISTS (
+            SELECT 1 FROM broadcast_deliveries
+            WHERE broadcast_deliveries.broadcast_id = broadcasts.id AND status = 'pending'
+        ))
+    """, (JOB_BROADCAST, now))
+    # Очереди, срок которых уже вышел, удаляем здесь без уведомлений: иначе планировщик
+    # удалил бы их все разом при первом запуске и разослал сообщение о каждой.
+    # Внешние ключи на время миграций выключены, поэтому участников удаляем явно.
+    expired_before = now - QUEUE_LIFETIME
+    cursor.execute("""
+        DELETE FROM queue_users WHERE queue_id IN (SELECT queue_id FROM queues WHERE start_ts <= ?)
+    """, (expired_before,))
+    cursor.execute("DELETE FROM queues WHERE start_ts <= ?", (expired_before,))
+    if cursor.rowcount:
+        logger.info(f"Удалено очередей с истекшим сроком: {cursor.rowcount}")
+    cursor.execute("""
+        INSERT INTO scheduled_jobs (kind, target_id, due_ts)
+        SELECT ?, queue_id, start_ts + ? FROM queues WHERE start_ts IS NOT NULL
+    """, (JOB_DELETE_QUEUE, QUEUE_LIFETIME))
+
+def _unreachable_users(conn):
+    """Признак недоступности пользователя для отправки (заблокировал бота, удален и т.п.)."""
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE users ADD COLUMN unreachable TEXT")
+    cursor.execute("ALTER TABLE users ADD COLUMN unreachable_ts INTEGER")
+    cursor.execute("CREATE INDEX idx_users_unreachable ON users(unreachable) WHERE unreachable IS NOT NULL")
+
+def _locations(conn):
+    """Справочник именованных мест для создания очередей; первое место — МатФак из config."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE locations (
+            location_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL
+        )
+    """)
+    cursor.execute("INSERT INTO locations (name, latitude, longitude) VALUES (?, ?, ?)",
+                   ("🏛 МатФак", MF_COORDINATES[0], MF_COORDINATES[1]))
+
+def _queue_geofence(conn):
+    """Свой радиус очереди (NULL — MAX_DISTANCE) и вершины геозоны-многоугольника."""
+    cursor = conn.cursor()
+    cursor.execute("ALTER TABLE queues ADD COLUMN radius REAL")
+    cursor.execute("""
+        CREATE TABLE queue_geofence (
+            queue_id INTEGER NOT NULL REFERENCES queues(queue_id) ON DELETE CASCADE,
+            vertex_no INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            PRIMARY KEY (queue_id, vertex_no)
+        ) WITHOUT ROWID
+    """)
+
+def _invites(conn):
+    """Приглашения с лимитом использований и сроком действия."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE invites (
+            invite_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            target_id INTEGER NOT NULL,
+            creator_id INTEGER NOT NULL,
+            max_uses INTEGER,
+            uses INTEGER NOT NULL DEFAULT 0,
+            expires_ts INTEGER,
+            created_ts INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("CREATE INDEX idx_invites_target ON invites(kind, target_id)")
+
+# (версия, описание, функция миграции)
+MIGRATIONS = [
+    (1, "Исходная схема", _baseline),
+    (2, "Первичные и внешние ключи связующих таблиц", _keys_and_cascades),
+    (3, "Время в секундах UTC с индексами", _epoch_timestamps),
+    (4, "Получатели рассылок и состояние доставки", _broadcast_deliveries),
+    (5, "Части рассылок со ссылками на исходные сообщения", _broadcast_parts),
+    (6, "Отложенные задачи с индексом по сроку", _scheduled_jobs),
+    (7, "Недоступные получатели", _unreachable_users),
+    (8, "Справочник мест", _locations),
+    (9, "Радиус и геозона очереди", _queue_geofence),
+    (10, "Приглашения с лимитом и сроком", _invites),
+]
+
+def get_schema_version(conn) -> int:
+    """Возвращает текущую версию схемы из PRAGMA user_version."""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(conn, target: int | None = None) -> list[tuple]:
+    """Применяет недостающие миграции. Возвращает [(версия, описание, секунды)]."""
+    applied = []
+    current = get_schema_version(conn)
+    # Пересборка таблиц требует отключенных внешних ключей; включать/выключать
+    # их можно только вне транзакции
+    conn.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for version, description, migration in MIGRATIONS:
+            if version <= current or (target is not None and version > target):
+                continue
+            started = time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                migration(conn)
+                violations = conn.execute("PRAGMA foreign_key_check").fetchall()
+                if violations:
+                    raise sqlite3.IntegrityError(f"Нарушены внешние ключи: {violations[:5]}")
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.commit()
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                logger.error(f"Ошибка при применении миграции {version} ({description}): {e}")
+                raise
+            elapsed = time.perf_counter() - started
+            applied.append((version, description, elapsed))
+            logger.info(f"Применена миграция {version}: {description} ({elapsed:.3f} с)")
+    finally:
+        conn.execute("PRAGMA foreign_keys = ON")
+    return applied
+
+def dry_run(database: str) -> list[tuple]:
+    """Применяет миграции к копии базы и возвращает время каждой из них."""
+    with tempfile.TemporaryDirectory() as tmp:
+        copy_path = os.path.join(tmp, os.path.basename(database))
+        source = sqlite3.connect(database)
+        target = sqlite3.connect(copy_path)
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+
+        conn = create_connection(copy_path)
+        try:
+            return run_migrations(conn)
+        finally:
+            conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    parser.add_argument("--database", default=DATABASE_NAME, help="путь к файлу базы данных")
+    parser.add_argument("--dry-run", action="store_true", help="выполнить миграции на копии и показать время")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        applied = dry_run(args.database)
+    else:
+        conn = create_connection(args.database)
+        try:
+            applied = run_migrations(conn)
+        finally:
+            conn.close()
+
+    if not applied:
+        print("Схема уже актуальна.")
+    for version, description, elapsed in applied:
+        print(f"{version:>4}  {elapsed:8.3f} с  {description}")
+    if args.dry_run and applied:
+        print(f"Итого: {sum(item[2] for item in applied):.3f} с (на копии, база не изменена)")
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    main()
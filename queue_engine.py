@@ -0,0 +1,373 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from datetime import datetime
+from db import POSITION_GAP, from_epoch
+from geo import LocalProjection, GridIndex, PolygonFence
+from varibles import QUEUE_INDEX_CELL, MAX_DISTANCE
+
+logger = logging.getLogger(__name__)
+
+class QueueState:
+    """Очередь в памяти: данные очереди и участники в порядке позиций.
+
+    positions дает проверку членства за O(1), отсортированный список
+    order пар (позиция, user_id) — номер в очереди бинарным поиском за O(log n).
+    Место записи — круг radius метров (по умолчанию MAX_DISTANCE) вокруг точки
+    очереди или геозона-многоугольник fence, если она задана.
+    Изменения применяются под lock до записи в БД; pending — число записей,
+    которые еще не зафиксированы, stale — одна из них не удалась.
+    """
+
+    def __init__(self, queue_id: int, queue_name: str, start_ts: int | None, latitude: float | None,
+                 longitude: float | None, creator_id: int | None, time_without_location_ts: int | None,
+                 radius: float | None = None):
+        self.queue_id = queue_id
+        self.queue_name = queue_name
+        self.start_ts = start_ts
+        self.latitude = latitude
+        self.longitude = longitude
+        self.creator_id = creator_id
+        self.time_without_location_ts = time_without_location_ts
+        # Масштабы для проверки расстояния считаются один раз на очередь
+        self.projection = LocalProjection(latitude, longitude) if latitude is not None and longitude is not None else None
+        self.radius = radius or MAX_DISTANCE
+        self.fence = None
+        self.lock = asyncio.Lock()
+        self.pending = 0
+        self.stale = False
+        self.settled = asyncio.Event()  # установлен, когда pending == 0
+        self.settled.set()
+        self._positions = {}  # user_id -> position
+        self._order = []      # [(position, user_id)] по возрастанию
+
+    @property
+    def start_time(self) -> datetime | None:
+        return from_epoch(self.start_ts)
+
+    @property
+    def time_without_location(self) -> datetime | None:
+        return from_epoch(self.time_without_location_ts)
+
+    @property
+    def reach(self) -> float:
+        """Наибольшее расстояние от точки очереди, с которого можно записаться."""
+        if self.fence is not None and self.projection is not None:
+            return self.fence.radius_from(self.latitude, self.longitude)
+        return self.radius
+
+    def covers(self, latitude: float, longitude: float) -> bool:
+        """Проверяет, можно ли записаться в очередь из этой точки."""
+        if self.fence is not None:
+            return self.fence.contains(latitude, longitude)
+        return self.projection is not None and self.projection.within(latitude, longitude, self.radius)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._positions
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def members(self) -> list[int]:
+        """Возвращает ID участников по порядку."""
+        return [user_id for _, user_id in self._order]
+
+    def position(self, user_id: int) -> int | None:
+        """Возвращает номер участника в очереди, начиная с 1."""
+        position = self._positions.get(user_id)
+        if position is None:
+            return None
+        return bisect_left(self._order, (position, user_id)) + 1
+
+    def next_after(self, user_id: int) -> int | None:
+        """Возвращает ID участника, стоящего следующим за user_id."""
+        index = self.position(user_id)
+        if index is None or index >= len(self._order):
+            return None
+        return self._order[index][1]
+
+    def next_position(self) -> int:
+        """Позиция для нового участника в конце очереди."""
+        return (self._order[-1][0] if self._order else 0) + POSITION_GAP
+
+    def _add(self, user_id: int, position: int):
+        self._positions[user_id] = position
+        index = bisect_left(self._order, (position, user_id))
+        self._order.insert(index, (position, user_id))
+
+    def _remove(self, user_id: int):
+        position = self._positions.pop(user_id)
+        del self._order[bisect_left(self._order, (position, user_id))]
+
+    def _move(self, user_id: int, position: int):
+        self._remove(user_id)
+        self._add(user_id, position)
+
+    def _renumber(self):
+        # Тот же порядок и шаг, что у renumber_queue_positions в БД
+        self._order = [((index + 1) * POSITION_GAP, user_id) for index, (_, user_id) in enumerate(self._order)]
+        self._positions = {user_id: position for position, user_id in self._order}
+
+    def position_before(self, user_id: int, before_user_id: int) -> int | None:
+        """Свободная позиция между before_user_id и его предшественником (не считая user_id) или None."""
+        upper = self._positions[before_user_id]
+        index = bisect_left(self._order, (upper, before_user_id))
+        if index and self._order[index - 1][1] == user_id:
+            index -= 1
+        lower = self._order[index - 1][0] if index else upper - 2 * POSITION_GAP
+        if upper - lower < 2:
+            return None
+        return (upper + lower) // 2
+
+    def _swap(self, user1_id: int, user2_id: int):
+        position1, position2 = self._positions[user1_id], self._positions[user2_id]
+        # Пары остаются на своих местах в order, меняются только user_id
+        index1 = bisect_left(self._order, (position1, user1_id))
+        index2 = bisect_left(self._order, (position2, user2_id))
+        self._order[index1] = (position1, user2_id)
+        self._order[index2] = (position2, user1_id)
+        self._positions[user1_id], self._positions[user2_id] = position2, position1
+
+class QueueEngine:
+    """Состояние очередей в памяти со сквозной записью в SQLite.
+
+    Чтение (членство, номер, следующий участник) не обращается к БД. Изменение
+    под asyncio.Lock очереди проверяется и сразу применяется в памяти (позиция
+    резервируется), а запись через Repository ожидается уже без lock: так
+    записи в одну очередь при всплеске (вся аудитория записывается разом)
+    попадают в общие транзакции группового коммита. Записи уходят в писатель
+    в том же порядке, в каком применены в памяти. Если запись не удалась,
+    изменение в памяти откатывается, а когда незавершенных записей очереди не
+    остается, она перечитывается из БД.
+    Очереди с координатами дополнительно лежат в сеточном индексе для поиска
+    очередей рядом с пользователем.
+    """
+
+    def __init__(self, repo, index_cell: float = QUEUE_INDEX_CELL):
+        self._repo = repo
+        self._queues: dict[int, QueueState] = {}
+        self._loading: dict[int, asyncio.Future] = {}  # очереди, которые читаются из БД прямо сейчас
+        self._index_cell = index_cell
+        self._spatial = GridIndex(index_cell)
+        self._reach = MAX_DISTANCE  # наибольший reach среди очередей в индексе (только растет до перезагрузки)
+
+    def _index(self, state: QueueState):
+        if state.projection is not None:
+            self._spatial.add(state.queue_id, state.latitude, state.longitude)
+            self._reach = max(self._reach, state.reach)
+        else:
+            self._spatial.remove(state.queue_id)
+
+    @staticmethod
+    def _build(queues: list[tuple], members: list[tuple], vertices: list[tuple]) -> dict[int, QueueState]:
+        states = {row[0]: QueueState(*row) for row in queues}
+        for queue_id, user_id, position in members:
+            state = states.get(queue_id)
+            if state is not None:
+                state._positions[user_id] = position
+                state._order.append((position, user_id))
+        fences = {}
+        for queue_id, latitude, longitude in vertices:
+            fences.setdefault(queue_id, []).append((latitude, longitude))
+        for queue_id, fence in fences.items():
+            state = states.get(queue_id)
+            if state is not None and len(fence) >= 3:
+                state.fence = PolygonFence(fence)
+        for state in states.values():
+            state._order.sort()
+        return states
+
+    async def load(self) -> int:
+        """Строит состояние всех очередей из БД. Возвращает их количество."""
+        queues, members, vertices = await self._repo.get_queues_with_members()
+        self._queues = self._build(queues, members, vertices)
+        self._spatial = GridIndex(self._index_cell)
+        self._reach = MAX_DISTANCE
+        for state in self._queues.values():
+            self._index(state)
+        logger.info(f"Загружено очередей в память: {len(self._queues)}, участников: {len(members)}")
+        return len(self._queues)
+
+    async def _reload(self, queue_id: int) -> QueueState | None:
+        queues, members, vertices = await self._repo.get_queues_with_members(queue_id)
+        state = self._build(queues, members, vertices).get(queue_id)
+        old = self._queues.get(queue_id)
+        if state is None:
+            self.forget(queue_id)
+            return None
+        if old is not None:
+            state.lock = old.lock  # Ожидающие операции держат ссылку на старый lock
+        self._queues[queue_id] = state
+        self._index(state)
+        return state
+
+    async def get(self, queue_id: int) -> QueueState | None:
+        """Возвращает состояние очереди; очередь, которой еще нет в памяти, читается из БД.
+
+        Одновременные обращения к еще не загруженной очереди ждут одного
+        чтения: иначе каждое заменило бы состояние, в котором другие уже
+        зарезервировали позиции.
+        """
+        state = self._queues.get(queue_id)
+        if state is not None:
+            return state
+        loading = self._loading.get(queue_id)
+        if loading is None:
+            loading = self._loading[queue_id] = asyncio.ensure_future(self._reload(queue_id))
+            loading.add_done_callback(lambda _: self._loading.pop(queue_id, None))
+        return await asyncio.shield(loading)
+
+    def forget(self, queue_id: int):
+        """Убирает очередь из памяти (после удаления из БД)."""
+        self._queues.pop(queue_id, None)
+        self._spatial.remove(queue_id)
+
+    def nearby(self, latitude: float, longitude: float, radius: float | None = None) -> list[tuple[float, QueueState]]:
+        """Возвращает [(расстояние в метрах, очередь)], ближайшие первыми.
+
+        С radius — очереди, чья точка не дальше radius; без него — очереди,
+        в которые можно записаться из этой точки (с учетом их радиуса и геозоны).
+        """
+        if radius is not None:
+            return [(distance, self._queues[queue_id]) for distance, queue_id in self._spatial.near(latitude, longitude, radius)
+                    if queue_id in self._queues]
+        return [(distance, self._queues[queue_id]) for distance, queue_id in self._spatial.near(latitude, longitude, self._reach)
+                if queue_id in self._queues and self._queues[queue_id].covers(latitude, longitude)]
+
+    async def refresh(self, queue_id: int) -> QueueState | None:
+        """Перечитывает очередь из БД после изменения ее данных в обход движка."""
+        state = self._queues.get(queue_id)
+        if state is None:
+            return await self.get(queue_id)
+        async with state.lock:
+            # Незафиксированные изменения еще не видны в БД — перечитывать после них
+            await state.settled.wait()
+            return await self._reload(queue_id)
+
+    async def _commit(self, state: QueueState, write, undo) -> bool:
+        """Ждет записи вне lock; при ошибке откатывает изменение в памяти и перечитывает очередь."""
+        state.pending += 1
+        state.settled.clear()
+        try:
+            written = await write
+        finally:
+            state.pending -= 1
+            if state.pending == 0:
+                state.settled.set()
+        if not written:
+            undo()
+            state.stale = True
+        if state.stale and state.pending == 0 and self._queues.get(state.queue_id) is state:
+            state.stale = False
+            async with state.lock:
+                await self._reload(state.queue_id)
+        return bool(written)
+
+    async def join(self, queue_id: int, user_id: int) -> bool:
+        """Добавляет участника в конец очереди. Возвращает False, если он уже в ней или очереди нет."""
+        state = await self.get(queue_id)
+        if state is None:
+            return False
+        async with state.lock:
+            state = self._queues.get(queue_id)
+            if state is None or user_id in state:
+                return False
+            position = state.next_position()
+            state._add(user_id, position)
+
+        def undo():
+            if state._positions.get(user_id) == position:
+                state._remove(user_id)
+        return await self._commit(state, self._repo.add_user_to_queue(queue_id, user_id, position=position), undo)
+
+    async def leave(self, queue_id: int, user_id: int) -> bool:
+        """Удаляет участника из очереди. Возвращает False, если его там не было."""
+        state = await self.get(queue_id)
+        if state is None:
+            return False
+        async with state.lock:
+            state = self._queues.get(queue_id)
+            if state is None or user_id not in state:
+                return False
+            position = state._positions[user_id]
+            state._remove(user_id)
+
+        def undo():
+            if user_id not in state:
+                state._add(user_id, position)
+        return await self._commit(state, self._repo.remove_user_from_queue(queue_id, user_id), undo)
+
+    async def skip(self, queue_id: int, user_id: int) -> int | None:
+        """Меняет участника местами со следующим. Возвращает ID следующего или None."""
+        state = await self.get(queue_id)
+        if state is None:
+            return None
+        async with state.lock:
+            state = self._queues.get(queue_id)
+            next_user_id = state.next_after(user_id) if state is not None else None
+            if next_user_id is None:
+                return None
+            state._swap(user_id, next_user_id)
+            swapped = (state._positions[user_id], state._positions[next_user_id])
+
+        def undo():
+            if (state._positions.get(user_id), state._positions.get(next_user_id)) == swapped:
+                state._swap(user_id, next_user_id)
+        if await self._commit(state, self._repo.swap_queue_users(queue_id, user_id, next_user_id), undo):
+            return next_user_id
+        return None
+
+    async def move_to_end(self, queue_id: int, user_id: int) -> bool:
+        """Перемещает участника в конец очереди. Возвращает False, если его там нет."""
+        state = await self.get(queue_id)
+        if state is None:
+            return False
+        async with state.lock:
+            state = self._queues.get(queue_id)
+            if state is None or user_id not in state:
+                return False
+            old = state._positions[user_id]
+            if state._order[-1][1] == user_id:
+                return True
+            position = state.next_position()
+            state._move(user_id, position)
+
+        def undo():
+            if state._positions.get(user_id) == position:
+                state._move(user_id, old)
+        return await self._commit(state, self._repo.move_queue_user_to_end(queue_id, user_id, position=position), undo)
+
+    async def move_before(self, queue_id: int, user_id: int, before_user_id: int) -> bool:
+        """Ставит участника непосредственно перед before_user_id. Возвращает False, если кого-то из них нет в очереди."""
+        state = await self.get(queue_id)
+        if state is None:
+            return False
+        async with state.lock:
+            state = self._queues.get(queue_id)
+            if state is None or user_id not in state or before_user_id not in state or user_id == before_user_id:
+                return False
+            old = state._positions[user_id]
+            position = written = state.position_before(user_id, before_user_id)
+            if position is None:
+                # Свободных позиций между соседями нет: move_queue_user_before
+                # перенумерует очередь в БД, здесь — так же, а после записи
+                # очередь перечитывается
+                state._renumber()
+                position = state.position_before(user_id, before_user_id)
+                state.stale = True
+            state._move(user_id, position)
+
+        def undo():
+            if state._positions.get(user_id) == position:
+                state._move(user_id, old)
+        return await self._commit(state, self._repo.move_queue_user_before(queue_id, user_id, before_user_id, position=written), undo)
+
+    async def delete(self, queue_id: int):
+        """Удаляет очередь из БД и из памяти."""
+        state = self._queues.get(queue_id)
+        if state is None:
+            await self._repo.delete_queue(queue_id)
+            return
+        async with state.lock:
+            await self._repo.delete_queue(queue_id)
+            self.forget(queue_id)
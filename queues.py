@@ -1,15 +1,20 @@
+import asyncio
 import json
+import time
 import pytz
 import logging
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, LinkPreviewOptions, ReplyKeyboardRemove
 from telegram.ext import CallbackContext, ConversationHandler
-from datetime import datetime, timedelta
-from config import MF_COORDINATES, ADMIN_ID
+from datetime import datetime
+from config import ADMIN_ID
 from varibles import *
 from db import *
 from utils import *
 from main_menu import *
-from crypto import decrypt_data
+from crypto import decode_invite, TokenExpired
+from delivery import LANE_NOTIFICATION
+from geo import PolygonFence
+from invites import INVITE_QUEUE, INVITE_GROUP
 logger = logging.getLogger(__name__)
 
 async def create_queue(update: Update, context: CallbackContext) -> int:
@@ -33,7 +38,8 @@ async def create_queue_name(update: Update, context: CallbackContext) -> int:
 async def create_queue_date(update: Update, context: CallbackContext) -> int:
     """Обработчик получения даты очереди."""
     user_input = update.message.text.strip()
-    user_timezone_str = get_user_timezone(conn = context.bot_data['conn'], user_id = update.effective_user.id)
+    repo = context.bot_data['repo']
+    user_timezone_str = await repo.get_user_timezone(update.effective_user.id)
 
     if user_input == "/today":
         today = datetime.now(pytz.timezone(user_timezone_str)).strftime("%d.%m.%y")
@@ -62,7 +68,8 @@ async def create_queue_date(update: Update, context: CallbackContext) -> int:
 async def create_queue_time(update: Update, context: CallbackContext) -> int:
     """Обработчик получения времени очереди."""
     user_input = update.message.text.strip()
-    user_timezone_str = get_user_timezone(conn = context.bot_data['conn'], user_id = update.effective_user.id)
+    repo = context.bot_data['repo']
+    user_timezone_str = await repo.get_user_timezone(update.effective_user.id)
 
     if user_input == "/now":
         now_time = datetime.now(pytz.timezone(user_timezone_str)).strftime("%H:%M")
@@ -95,7 +102,7 @@ async def set_time_without_location(update: Update, context: CallbackContext) ->
         await update.message.reply_text(
             "✅ Проверка геолокации будет требоваться всегда.\n\n"
             "🌍 Теперь выберите местоположение очереди:",
-            reply_markup=build_location_menu(),
+            reply_markup=build_location_menu(await context.bot_data['repo'].get_locations()),
         )
         return CHOOSE_LOCATION
     
@@ -110,65 +117,119 @@ async def set_time_without_location(update: Update, context: CallbackContext) ->
     await update.message.reply_text(
         f"✅ После {user_input} проверка геолокации не потребуется.\n\n"
         "🌍 Теперь выберите местоположение очереди:",
-        reply_markup=build_location_menu(),
+        reply_markup=build_location_menu(await context.bot_data['repo'].get_locations()),
     )
     return CHOOSE_LOCATION
 
-async def create_queue_location(update: Update, context: CallbackContext) -> int:
-    """Обработчик выбора местоположения очереди."""
+async def create_queue_location(update: Update, context: CallbackContext, location_id: int | None = None) -> int:
+    """Обработчик выбора местоположения очереди: место из справочника или своя геолокация (location_id None)."""
     query = update.callback_query
     await query.answer()
 
-    if query.data == "location_mathfac":
-        context.user_data['latitude'] = MF_COORDINATES[0]
-        context.user_data['longitude'] = MF_COORDINATES[1]
-        conn = context.bot_data['conn']
-        user_id = update.effective_user.id
-        user_groups = get_user_groups(conn, user_id)
-        reply_markup = build_select_group_menu(user_groups)
-        await query.message.edit_text("📋 Выберите группу для очереди (или 'Без группы'):", reply_markup=reply_markup)
-        return CHOOSE_GROUP
-
-    elif query.data == "location_custom":
+    context.user_data['fence_points'] = []
+    context.user_data['radius'] = None
+    context.user_data['fence'] = None
+    if location_id is None:
         await query.message.edit_text(
-            "📍 *Пожалуйста, отправьте вашу геолокацию* для создания очереди:")
+            "📍 *Пожалуйста, отправьте вашу геолокацию* для создания очереди.\n\n"
+            f"Чтобы записываться можно было с целой территории, отправьте по очереди ее углы "
+            f"(от 3 до {MAX_GEOFENCE_VERTICES} точек) и затем /done.\n"
+            f"Для одной точки /done _радиус_ задает свой радиус записи в метрах (по умолчанию {MAX_DISTANCE}).")
         return CHOOSE_LOCATION
 
+    repo = context.bot_data['repo']
+    location = await repo.get_location_by_id(location_id)
+    if not location:
+        await query.message.edit_text("❌ Ошибка: место не найдено. Отправьте геолокацию.")
+        return CHOOSE_LOCATION
+    context.user_data['latitude'] = location['latitude']
+    context.user_data['longitude'] = location['longitude']
+    user_id = update.effective_user.id
+    user_groups = await repo.get_user_groups(user_id)
+    reply_markup = build_select_group_menu(user_groups)
+    await query.message.edit_text("📋 Выберите группу для очереди (или 'Без группы'):", reply_markup=reply_markup)
+    return CHOOSE_GROUP
+
 async def create_queue_location_custom(update: Update, context: CallbackContext) -> int:
-    """Обработчик получения кастомной геолокации."""
+    """Обработчик получения кастомной геолокации: точки копятся до /done."""
     location = update.message.location
-    context.user_data['latitude'] = location.latitude
-    context.user_data['longitude'] = location.longitude
-    conn = context.bot_data['conn']
+    points = context.user_data.setdefault('fence_points', [])
+    if len(points) >= MAX_GEOFENCE_VERTICES:
+        await update.message.reply_text(f"⚠️ Не больше {MAX_GEOFENCE_VERTICES} точек. Введите /done.")
+        return CHOOSE_LOCATION
+    points.append((location.latitude, location.longitude))
+    await update.message.reply_text(
+        f"✅ Точка {len(points)} принята. Отправьте следующую или введите /done, чтобы продолжить."
+    )
+    return CHOOSE_LOCATION
+
+async def create_queue_location_done(update: Update, context: CallbackContext) -> int:
+    """Обработчик /done [радиус]: одна точка — круг, от трех — геозона-многоугольник."""
+    points = context.user_data.get('fence_points') or []
+    args = update.message.text.split()[1:]
+    if not points:
+        await update.message.reply_text("📍 Сначала отправьте геолокацию очереди.")
+        return CHOOSE_LOCATION
+    if len(points) == 2:
+        await update.message.reply_text("⚠️ Для территории нужно хотя бы 3 точки. Отправьте еще одну.")
+        return CHOOSE_LOCATION
+
+    radius = None
+    if args:
+        try:
+            radius = float(args[0])
+        except ValueError:
+            radius = None
+        if len(points) > 1 or radius is None or not MIN_QUEUE_RADIUS <= radius <= MAX_QUEUE_RADIUS:
+            await update.message.reply_text(
+                f"⚠️ Радиус задается только для одной точки, от {MIN_QUEUE_RADIUS} до {MAX_QUEUE_RADIUS} м."
+            )
+            return CHOOSE_LOCATION
+
+    if len(points) == 1:
+        context.user_data['latitude'], context.user_data['longitude'] = points[0]
+        context.user_data['radius'] = radius
+        context.user_data['fence'] = None
+    else:
+        fence = PolygonFence(points)
+        if not fence.simple:
+            context.user_data['fence_points'] = []
+            await update.message.reply_text(
+                "⚠️ Границы территории пересекают сами себя. Отправьте углы заново по порядку обхода "
+                "(по или против часовой стрелки) и затем /done."
+            )
+            return CHOOSE_LOCATION
+        latitude, longitude = fence.center
+        if fence.radius_from(latitude, longitude) > MAX_QUEUE_RADIUS:
+            await update.message.reply_text(f"⚠️ Территория больше {MAX_QUEUE_RADIUS} м от центра. Начните заново: /cancel")
+            return CHOOSE_LOCATION
+        context.user_data['latitude'], context.user_data['longitude'] = latitude, longitude
+        context.user_data['radius'] = None
+        context.user_data['fence'] = points
+
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
-    user_groups = get_user_groups(conn, user_id)
+    user_groups = await repo.get_user_groups(user_id)
     reply_markup = build_select_group_menu(user_groups)
     await update.message.reply_text("📋 Выберите группу для очереди (или 'Без группы'):", reply_markup=reply_markup)
     return CHOOSE_GROUP
 
-async def create_queue_choose_group(update: Update, context: CallbackContext) -> int:
-    """Обрабатывает выбор группы для очереди."""
+async def create_queue_choose_group(update: Update, context: CallbackContext, group_id: int | None = None) -> int:
+    """Обрабатывает выбор группы для очереди (group_id None — без группы)."""
     query = update.callback_query
     await query.answer()
-    group_id_str = query.data
 
-    if group_id_str == "select_group_none":
+    if group_id is None:
         context.user_data['group_id'] = None
         await query.edit_message_text("✅ Очередь будет без группы")
-
-    elif group_id_str.startswith("select_group_"):
-        try:
-            group_id = int(group_id_str.split("_")[2])
-            conn = context.bot_data['conn']
-            group_name = get_group_by_id(conn, group_id)["group_name"]
-            context.user_data['group_id'] = group_id
-            await query.edit_message_text(f"✅ Выбрана группа *{group_name}*")
-        except (ValueError, IndexError):
-            await query.edit_message_text("❌ Ошибка: Неверный формат выбора группы.")
-            return CHOOSE_GROUP
     else:
-        await query.edit_message_text("❌ Ошибка: Неподдерживаемый выбор.")
-        return CHOOSE_GROUP
+        repo = context.bot_data['repo']
+        group = await repo.get_group_by_id(group_id)
+        if not group:
+            await query.edit_message_text("❌ Ошибка: группа не найдена.")
+            return CHOOSE_GROUP
+        context.user_data['group_id'] = group_id
+        await query.edit_message_text(f"✅ Выбрана группа *{group['group_name']}*")
     return await create_queue_final(update, context)
 
 async def create_queue_final(update: Update, context: CallbackContext) -> int:
@@ -180,8 +241,10 @@ async def create_queue_final(update: Update, context: CallbackContext) -> int:
     longitude = context.user_data['longitude']
     group_id = context.user_data.get('group_id')
     time_without_location = context.user_data.get('time_without_location')
-    conn = context.bot_data['conn']
-    user_timezone_str = get_user_timezone(conn = context.bot_data['conn'], user_id = update.effective_user.id)
+    radius = context.user_data.get('radius')
+    fence = context.user_data.get('fence')
+    repo = context.bot_data['repo']
+    user_timezone_str = await repo.get_user_timezone(update.effective_user.id)
 
     try:
         # Конвертируем время из часового пояса пользователя в UTC
@@ -209,14 +272,11 @@ async def create_queue_final(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     # Вставляем очередь в БД (с group_id или NULL)
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO queues (queue_name, start_time, latitude, longitude, creator_id, group_id, time_without_location)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (name, start_time_utc.isoformat(), latitude, longitude, update.effective_user.id, group_id, 
-          time_without_location_utc.isoformat() if time_without_location_utc else None))
-    conn.commit()
-    queue_id = cursor.lastrowid
+    queue_id = await repo.insert_queue(name, start_time_utc, latitude, longitude, update.effective_user.id,
+                                       group_id, time_without_location_utc, radius, fence)
+    if queue_id:
+        # Сразу в движок и пространственный индекс, чтобы очередь была видна в /nearby
+        await context.bot_data['queues'].refresh(queue_id)
 
     location_message = await update.effective_message.reply_location(
         latitude=latitude,
@@ -228,8 +288,8 @@ async def create_queue_final(update: Update, context: CallbackContext) -> int:
 
     if group_id:
         keyboard = [
-            [InlineKeyboardButton("✅ Да", callback_data="send_notification_yes")],
-            [InlineKeyboardButton("❌ Нет", callback_data="send_notification_no")]
+            [InlineKeyboardButton("✅ Да", callback_data=pack(CB_SEND_NOTIFICATION, "yes"))],
+            [InlineKeyboardButton("❌ Нет", callback_data=pack(CB_SEND_NOTIFICATION, "no"))]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -243,13 +303,12 @@ async def create_queue_final(update: Update, context: CallbackContext) -> int:
         await finish_queue_creation(update, context)
         return ConversationHandler.END
 
-async def send_notification_choice(update: Update, context: CallbackContext) -> int:
-    """Обрабатывает выбор отправки уведомления."""
+async def send_notification_choice(update: Update, context: CallbackContext, choice: str) -> int:
+    """Обрабатывает выбор отправки уведомления (choice — "yes" или "no")."""
     query = update.callback_query
     await query.answer()
-    choice = query.data
 
-    if choice == "send_notification_yes":
+    if choice == "yes":
         await query.edit_message_text("🔔 Участники группы получат уведомление.")
         await send_group_notification(update, context)
     else:
@@ -260,7 +319,7 @@ async def send_notification_choice(update: Update, context: CallbackContext) ->
 
 async def send_group_notification(update: Update, context: CallbackContext) -> None:
     """Отправка уведомления участникам группы с локацией."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     group_id = context.user_data.get('group_id')
     queue_id = context.user_data.get('queue_id')
     queue_creator_id = update.effective_user.id
@@ -272,76 +331,100 @@ async def send_group_notification(update: Update, context: CallbackContext) -> N
         logger.error("Не удалось отправить уведомление: нет group_id или queue_id")
         return
 
-    users = get_group_users(conn, group_id)
-    if not users:
+    # Участники с часовыми поясами одним запросом; недоступные получатели
+    # (заблокировали бота и т.п.) исключаются в нем же
+    members = await repo.get_group_users_timezones(group_id, reachable_only=True)
+    skipped = await repo.get_group_unreachable_count(group_id)
+    context.bot_data['reachability'].note_skipped(skipped * 2)  # локация и сообщение
+    recipients_by_zone = {}
+    for user_id, time_zone in members:
+        if user_id != queue_creator_id:
+            recipients_by_zone.setdefault(time_zone, []).append(user_id)
+    if not recipients_by_zone:
         logger.info(f"Нет пользователей в группе {group_id} для уведомлений")
         return
 
     reply_markup = await create_join_queue_button(context, queue_id, queue_creator_id)
 
     # Получаем данные очереди из БД
-    queue = await get_queue_by_id(conn, queue_id)
+    queue = await repo.get_queue_by_id(queue_id)
     if not queue:
         logger.error(f"Очередь с id {queue_id} не найдена при отправке уведомлений.")
         return
 
-    start_time = queue['start_time']
-    time_without_location = queue.get('time_without_location')
+    start_time = from_epoch(queue['start_ts'])
+    time_without_location = from_epoch(queue['time_without_location_ts'])
+    delivery = context.bot_data['delivery']
+    bot = context.bot
+    lane = {"lane": LANE_NOTIFICATION}
 
-    for user_id in users:
-        if user_id != queue_creator_id:
-            try:
-                # Получаем часовой пояс получателя
-                user_timezone_str = get_user_timezone(conn, user_id)
-                user_timezone = pytz.timezone(user_timezone_str)
-
-                # Конвертируем времена в часовой пояс получателя
-                start_time_user = start_time.astimezone(user_timezone)
-                
-                # Формируем текст сообщения
-                message_text = (
-                    f"✅ Создана новая очередь *{queue_name}*! 🕒\n"
-                    f"📆 Дата: *{start_time_user.strftime('%d.%m.%y')}*\n"
-                    f"⏰ Время: *{start_time_user.strftime('%H:%M')}*\n"
-                )
-
-                # Добавляем информацию о времени без локации, если оно указано
-                if time_without_location:
-                    time_without_location_user = time_without_location.astimezone(user_timezone)
-                    message_text += (
-                        f"🕓 Без локации после: *{time_without_location_user.strftime('%H:%M')}*\n\n"
-                    )
-                else:
-                    message_text += "\n"
-
-                message_text += (
-                    f"📍 *Локация:* (смотрите выше)\n\n"
-                    f"➡ *Нажмите кнопку, чтобы присоединиться!*"
-                )
-
-                # Отправляем локацию
-                await context.bot.send_location(
-                    chat_id=user_id,
-                    latitude=latitude,
-                    longitude=longitude
-                )
-
-                # Отправляем текстовое сообщение с кнопкой
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=message_text,
-                    reply_markup=reply_markup,
-                    link_preview_options=LinkPreviewOptions(is_disabled=True)
-                )
-                logger.info(f"Уведомление о создании {queue_id} отправлено {user_id}")
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление {user_id} об {queue_id}: {e}")
+    def render(time_zone):
+        # Текст зависит только от часового пояса получателя: формируется один раз на пояс
+        try:
+            user_timezone = pytz.timezone(time_zone)
+        except pytz.UnknownTimeZoneError:
+            user_timezone = pytz.UTC
+
+        # Конвертируем времена в часовой пояс получателя
+        start_time_user = start_time.astimezone(user_timezone)
+
+        # Формируем текст сообщения
+        message_text = (
+            f"✅ Создана новая очередь *{queue_name}*! 🕒\n"
+            f"📆 Дата: *{start_time_user.strftime('%d.%m.%y')}*\n"
+            f"⏰ Время: *{start_time_user.strftime('%H:%M')}*\n"
+        )
+
+        # Добавляем информацию о времени без локации, если оно указано
+        if time_without_location:
+            time_without_location_user = time_without_location.astimezone(user_timezone)
+            message_text += (
+                f"🕓 Без локации после: *{time_without_location_user.strftime('%H:%M')}*\n\n"
+            )
+        else:
+            message_text += "\n"
+
+        message_text += (
+            f"📍 *Локация:* (смотрите выше)\n\n"
+            f"➡ *Нажмите кнопку, чтобы присоединиться!*"
+        )
+        return message_text
+
+    async def notify(user_id, message_text):
+        # Сначала локация, затем текстовое сообщение с кнопкой
+        error = await delivery.deliver(user_id, [
+            lambda: bot.send_location(chat_id=user_id, latitude=latitude, longitude=longitude, rate_limit_args=lane),
+            lambda: bot.send_message(
+                chat_id=user_id,
+                text=message_text,
+                reply_markup=reply_markup,
+                link_preview_options=LinkPreviewOptions(is_disabled=True),
+                rate_limit_args=lane
+            ),
+        ])
+        if error:
+            logger.error(f"Не удалось отправить уведомление {user_id} об {queue_id}: {error}")
+        return error is None
+
+    async def notify_all():
+        started = time.monotonic()
+        # Все получатели отправляются сразу; темп задают лимитер бота и DeliveryEngine
+        tasks = []
+        for time_zone, user_ids in recipients_by_zone.items():
+            message_text = render(time_zone)
+            tasks.extend(notify(user_id, message_text) for user_id in user_ids)
+        results = await asyncio.gather(*tasks)
+        logger.info(f"Уведомления об очереди {queue_id}: отправлено {sum(results)} из {len(results)} "
+                    f"({len(recipients_by_zone)} час. поясов) за {time.monotonic() - started:.1f} с")
+
+    # Рассылка по большой группе занимает минуты, обработчик ее не ждет
+    context.application.create_task(notify_all(), update=update)
 
 async def finish_queue_creation(update:Update, context:CallbackContext):
     """Завершающая часть создания очереди"""
 
     #Получаем нужные данные
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     queue_id = context.user_data.get('queue_id')
     queue_name = context.user_data.get('queue_name')
     date_str = context.user_data['queue_date']
@@ -356,13 +439,11 @@ async def finish_queue_creation(update:Update, context:CallbackContext):
     context.user_data['queue_message_id'] = queue_message.message_id #Сохраняем ID сообщения
 
     #Удаляем через 5 часов
-    user_timezone_str = get_user_timezone(conn, user_id)
+    user_timezone_str = await repo.get_user_timezone(user_id)
     user_timezone = pytz.timezone(user_timezone_str)
     start_time_localized = user_timezone.localize(start_time)
     start_time_utc = start_time_localized.astimezone(pytz.UTC)
-    time_until_deletion = (start_time_utc + timedelta(hours=5)) - datetime.now(pytz.UTC)
-    seconds_until_deletion = max(time_until_deletion.total_seconds(), 0)
-    context.job_queue.run_once(delete_queue_job, seconds_until_deletion, data=queue_id) # Используем функцию из utils
+    await context.bot_data['scheduler'].schedule(JOB_DELETE_QUEUE, queue_id, to_epoch(start_time_utc) + QUEUE_LIFETIME)
 
     #Чистим данные
     context.user_data.pop('queue_name', None)
@@ -388,33 +469,36 @@ async def handle_deeplink(update: Update, context: CallbackContext) -> None:
 
     try:
         # Декодируем параметры очереди
-        encrypted_id = payload[len(JOIN_QUEUE_PAYLOAD):]
-        queue_id, creator_id = decrypt_data(encrypted_id)
+        token = payload[len(JOIN_QUEUE_PAYLOAD):]
+        queue_id, creator_id, invite_id = decode_invite(JOIN_QUEUE_PAYLOAD, token)
         
         if not queue_id or not creator_id:
             raise ValueError("Invalid queue data")
             
+    except TokenExpired:
+        await update.message.reply_text("⌛ Срок действия приглашения истек.")
+        return
     except ValueError:
         await update.message.reply_text("❌ Неверный формат приглашения.")
         return
 
     # Проверяем существование очереди и создателя
-    conn = context.bot_data['conn']
-    queue = await get_queue_by_id(conn, queue_id)
+    repo = context.bot_data['repo']
+    queue = await repo.get_queue_by_id(queue_id)
     if not queue or queue['creator_id'] != creator_id:
         await update.message.reply_text("❌ Очередь не найдена или приглашение недействительно.")
         return
 
     # Проверяем регистрацию пользователя
     user_id = update.effective_user.id
-    if not get_user_data(conn, user_id):
+    if not await repo.get_user_data(user_id):
         await update.message.reply_text("✍ Для начала введите ваше *имя* с помощью команды /start.")
         return
 
     # Создаем искусственный callback_query для обработки
     class FakeCallbackQuery:
         def __init__(self, message):
-            self.data = f"join_queue_{queue_id}"
+            self.data = pack(CB_JOIN_QUEUE, queue_id)
             self.message = message
             self.from_user = update.effective_user
             
@@ -430,180 +514,160 @@ async def handle_deeplink(update: Update, context: CallbackContext) -> None:
     fake_query = FakeCallbackQuery(update.message)
     fake_update = Update(update.update_id, callback_query=fake_query)
     
-    # Обрабатываем как обычный callback
-    await handle_join_queue(fake_update, context)
+    # Обрабатываем как обычный callback; использование приглашения засчитывается только при записи
+    await handle_join_queue(fake_update, context, queue_id, invite_id)
 
-async def delete_queue_job(context: CallbackContext) -> None:
-    """Автоматически удаляет очередь."""
-    queue_id = context.job.data
-    conn = context.bot_data['conn']
-    queue_name = get_queue_name_by_id(conn, queue_id)
+async def delete_queue_job(context: CallbackContext, queue_id: int) -> None:
+    """Автоматически удаляет очередь (обработчик отложенной задачи JOB_DELETE_QUEUE)."""
+    repo = context.bot_data['repo']
+    queue_name = await repo.get_queue_name_by_id(queue_id)
 
     if not queue_name:
         logger.error(f"Не удалось получить имя очереди с ID {queue_id}")
         return
 
-    delete_queue(conn, queue_id)
+    await context.bot_data['queues'].delete(queue_id)
     await context.bot.send_message(ADMIN_ID, f"✅ Очередь {queue_name} (ID {queue_id}) была автоматически удалена.")
     logger.info(f"Очередь {queue_name} (ID {queue_id}) была автоматически удалена.")
 
-async def delete_queue_button(update: Update, context: CallbackContext) -> None:
+async def delete_queue_button(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Обрабатывает нажатие кнопки удаления очереди."""
     query = update.callback_query
     await query.answer()
-    queue_id = int(query.data.split("_")[2])
 
     # Создаем кнопки подтверждения
     keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data=f"confirm_delete_queue_{queue_id}")],
-        [InlineKeyboardButton("❌ Нет", callback_data=f"cancel_delete_queue_{queue_id}")]
+        [InlineKeyboardButton("✅ Да", callback_data=pack(CB_CONFIRM_DELETE_QUEUE, queue_id))],
+        [InlineKeyboardButton("❌ Нет", callback_data=pack(CB_CANCEL_DELETE_QUEUE, queue_id))]
     ]
-    print(queue_id)
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text("Подтвердите удаление очереди:", reply_markup=reply_markup)
 
-async def confirm_delete_queue(update: Update, context: CallbackContext) -> None:
+async def confirm_delete_queue(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Подтверждает удаление очереди."""
     query = update.callback_query
     await query.answer()
-    queue_id = int(query.data.split("_")[3])
 
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
-    queue_name = get_queue_name_by_id(conn, queue_id)
+    queue_name = await repo.get_queue_name_by_id(queue_id)
 
     if not queue_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя очереди.")
         return
 
-    delete_queue(conn, queue_id)
+    await context.bot_data['queues'].delete(queue_id)
+    await context.bot_data['scheduler'].cancel(JOB_DELETE_QUEUE, queue_id)
     await query.edit_message_text(f"✅ Очередь *{queue_name}* успешно удалена.")
 
     context.user_data['chat_id'] = query.message.chat_id
     context.user_data['edit_message'] = False
     await show_queues(update, context)
 
-async def cancel_delete_queue(update: Update, context: CallbackContext) -> None:
+async def cancel_delete_queue(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Отменяет удаление очереди."""
     query = update.callback_query
     await query.answer()
-    queue_id = None
-    # Извлекаем queue_id из query.data
-    try:
-        queue_id = int(query.data.split("_")[3])  # Извлекаем queue_id из "cancel_delete_queue_{queue_id}"
-    except (IndexError, ValueError):
-        await query.edit_message_text("❌ Ошибка: Неверный формат данных.")
-        return
 
-    conn = context.bot_data['conn']
-    queue_name = get_queue_name_by_id(conn, queue_id)
+    repo = context.bot_data['repo']
+    queue_name = await repo.get_queue_name_by_id(queue_id)
 
     if not queue_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя очереди.")
         return
 
     # Возвращаем пользователя к информации об очереди
-    await queue_info_button(update, context)
+    await queue_info_button(update, context, queue_id)
 
-async def leave_button(update: Update, context: CallbackContext) -> None:
+async def leave_button(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Обрабатывает нажатие кнопки выхода из очереди."""
     query = update.callback_query
     await query.answer()
-    queue_id = int(query.data.split("_")[2])
 
     # Создаем кнопки подтверждения
     keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data=f"confirm_leave_queue_{queue_id}")],
-        [InlineKeyboardButton("❌ Нет", callback_data=f"cancel_leave_queue_{queue_id}")]
+        [InlineKeyboardButton("✅ Да", callback_data=pack(CB_CONFIRM_LEAVE_QUEUE, queue_id))],
+        [InlineKeyboardButton("❌ Нет", callback_data=pack(CB_CANCEL_LEAVE_QUEUE, queue_id))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text("Подтвердите выход из очереди:", reply_markup=reply_markup)
 
-async def confirm_leave_queue(update: Update, context: CallbackContext) -> None:
+async def confirm_leave_queue(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Подтверждает выход из очереди."""
     query = update.callback_query
     await query.answer()
-    queue_id = int(query.data.split("_")[3])
 
-    conn = context.bot_data['conn']
+    engine = context.bot_data['queues']
     user_id = update.effective_user.id
-    queue_name = get_queue_name_by_id(conn, queue_id)
+    queue = await engine.get(queue_id)
 
-    if not queue_name:
+    if not queue:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя очереди.")
         return
 
-    remove_user_from_queue(conn, queue_id, user_id)
-    await query.edit_message_text(f"✅ Вы вышли из очереди: *{queue_name}*.")
+    await engine.leave(queue_id, user_id)
+    await query.edit_message_text(f"✅ Вы вышли из очереди: *{queue.queue_name}*.")
 
     context.user_data['chat_id'] = query.message.chat_id
     context.user_data['edit_message'] = False
     await show_queues(update, context)
 
-async def cancel_leave_queue(update: Update, context: CallbackContext) -> None:
+async def cancel_leave_queue(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Отменяет выход из очереди."""
     query = update.callback_query
     await query.answer()
 
-    try:
-        queue_id = int(query.data.split("_")[3])  # Извлекаем queue_id из "cancel_leave_queue_{queue_id}"
-    except (IndexError, ValueError):
-        await query.edit_message_text("❌ Ошибка: Неверный формат данных.")
-        return
-
-    conn = context.bot_data['conn']
-    queue_name = get_queue_name_by_id(conn, queue_id)
+    repo = context.bot_data['repo']
+    queue_name = await repo.get_queue_name_by_id(queue_id)
 
     if not queue_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя очереди.")
         return
 
-    await queue_info_button(update, context)
+    await queue_info_button(update, context, queue_id)
 
-async def skip_button(update: Update, context: CallbackContext) -> None:
+async def skip_button(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Обрабатывает нажатие кнопки пропуска хода."""
     query = update.callback_query
     await query.answer()
-    queue_id = int(query.data.split("_")[1])
 
     # Создаем кнопки подтверждения
     keyboard = [
-        [InlineKeyboardButton("✅ Да", callback_data=f"confirm_skip_{queue_id}")],
-        [InlineKeyboardButton("❌ Нет", callback_data=f"cancel_skip_{queue_id}")]
+        [InlineKeyboardButton("✅ Да", callback_data=pack(CB_CONFIRM_SKIP, queue_id))],
+        [InlineKeyboardButton("❌ Нет", callback_data=pack(CB_CANCEL_SKIP, queue_id))]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     await query.edit_message_text("Подтвердите пропуск хода:", reply_markup=reply_markup)
 
-async def confirm_skip(update: Update, context: CallbackContext) -> None:
+async def confirm_skip(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Подтверждает пропуск хода."""
     query = update.callback_query
     await query.answer()
-    queue_id = int(query.data.split("_")[2])
 
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
+    engine = context.bot_data['queues']
     user_id = update.effective_user.id
-    queue_name = get_queue_name_by_id(conn, queue_id)
+    queue = await engine.get(queue_id)
 
-    if not queue_name:
+    if not queue:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя очереди.")
         return
+    queue_name = queue.queue_name
 
-    queue_users_ids = get_queue_users_ids(conn, queue_id)
-    if not queue_users_ids:
-        await query.edit_message_text("🔍 В очереди пока нет участников.")
+    if user_id not in queue:
+        await query.edit_message_text("❌ Вы не состоите в этой очереди.")
         return
 
-    current_index = queue_users_ids.index(user_id)
+    next_user_id = await engine.skip(queue_id, user_id)
 
-    if current_index + 1 < len(queue_users_ids):
-        user1_id = queue_users_ids[current_index]
-        user2_id = queue_users_ids[current_index + 1]
-        swap_queue_users(conn, queue_id, user1_id, user2_id)
-        user_name = get_user_name(conn, user1_id)
-        user2_name = get_user_name(conn, user2_id)
+    if next_user_id:
+        user1_id = user_id
+        user2_id = next_user_id
+        user_name = await repo.get_user_name(user1_id)
+        user2_name = await repo.get_user_name(user2_id)
 
         if user2_name:
             await query.edit_message_text(f"✅ Вы пропустили ход. Теперь после *{user2_name}*.")
@@ -614,88 +678,70 @@ async def confirm_skip(update: Update, context: CallbackContext) -> None:
         context.user_data['queue_id'] = queue_id
         context.user_data['chat_id'] = query.message.chat_id
         context.user_data['edit_message'] = False 
-        await queue_info_button(update, context)
+        await queue_info_button(update, context, queue_id)
 
     else:
         await query.edit_message_text("❌ Вы в конце очереди, нельзя пропустить.")
 
-async def cancel_skip(update: Update, context: CallbackContext) -> None:
+async def cancel_skip(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Отменяет пропуск хода."""
     query = update.callback_query
     await query.answer()
 
-    try:
-        queue_id = int(query.data.split("_")[2])  # Извлекаем queue_id из "cancel_skip_{queue_id}"
-    except (IndexError, ValueError):
-        await query.edit_message_text("❌ Ошибка: Неверный формат данных.")
-        return
-
-    conn = context.bot_data['conn']
-    queue_name = get_queue_name_by_id(conn, queue_id)
+    repo = context.bot_data['repo']
+    queue_name = await repo.get_queue_name_by_id(queue_id)
 
     if not queue_name:
         await query.edit_message_text("❌ Ошибка: Не удалось получить имя очереди.")
         return
 
-    await queue_info_button(update, context)
+    await queue_info_button(update, context, queue_id)
 
-async def queue_info_button(update: Update, context: CallbackContext) -> None:
+async def queue_info_button(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Обрабатывает нажатие кнопки просмотра информации об очереди."""
     query = update.callback_query
     await query.answer()
-    conn = context.bot_data['conn']
-
-    queue_id = None
-    if queue_id is None:
-        if query and (query.data.startswith("queue_info_") or query.data.startswith("cancel_skip_") 
-                      or query.data.startswith("cancel_delete_queue_") or query.data.startswith("cancel_leave_queue_")):
-            if query.data.startswith("cancel_delete_queue_") or query.data.startswith("cancel_leave_queue_"):
-                queue_id = int(query.data.split("_")[3])
-                print(queue_id)
-            else:
-                queue_id = int(query.data.split("_")[2])
-        else:
-            if query:
-                await query.edit_message_text("❌ Ошибка: ID очереди не найден.")
-            return
+    repo = context.bot_data['repo']
 
     user_id = update.effective_user.id
-    queue = await get_queue_by_id(conn, queue_id)
+    queue = await context.bot_data['queues'].get(queue_id)
     if not queue:
         await query.edit_message_text("❌ Ошибка: Очередь не найдена.")
         return
 
-    users_list = get_queue_users_names(conn, queue_id)
-    users_text = "\n".join([f"{i+1}. {user}" for i, user in enumerate(users_list)]) if users_list else "🔍 В очереди пока нет участников."
+    member_ids = queue.members()
+    names = await repo.get_user_names(member_ids)
+    members = [(member_id, names.get(member_id)) for member_id in member_ids]
+    users_text = format_members(members) if members else "🔍 В очереди пока нет участников."
 
     keyboard = []
-    if is_user_in_queue(conn, queue_id, user_id):
+    if user_id in queue:
         keyboard.append([
-            InlineKeyboardButton("⏭ Пропустить ход", callback_data=f"skip_{queue_id}"),
-            InlineKeyboardButton("🚪 Выйти из очереди", callback_data=f"leave_queue_{queue_id}")
+            InlineKeyboardButton("⏭ Пропустить ход", callback_data=pack(CB_SKIP, queue_id)),
+            InlineKeyboardButton("🚪 Выйти из очереди", callback_data=pack(CB_LEAVE_QUEUE, queue_id))
         ])
     else:
-        keyboard.append([InlineKeyboardButton("➕ Присоединиться", callback_data=f"{JOIN_QUEUE_PAYLOAD}{queue_id}")])
+        keyboard.append([InlineKeyboardButton("➕ Присоединиться", callback_data=pack(CB_JOIN_QUEUE, queue_id))])
 
-    if queue['creator_id'] == user_id or user_id == ADMIN_ID:
+    if queue.creator_id == user_id or user_id == ADMIN_ID:
         keyboard.append([
-            InlineKeyboardButton("❌ Удалить очередь", callback_data=f"delete_queue_{queue_id}"),
-            InlineKeyboardButton("🔗 Пригласить", callback_data=f"invite_queue_{queue_id}")
+            InlineKeyboardButton("❌ Удалить очередь", callback_data=pack(CB_DELETE_QUEUE, queue_id)),
+            InlineKeyboardButton("🔗 Пригласить", callback_data=pack(CB_INVITE_QUEUE, queue_id))
         ])
 
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="show_queues")])
+    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=pack(CB_SHOW_QUEUES))])
 
     reply_markup = InlineKeyboardMarkup(keyboard) 
 
     await query.edit_message_text(
-        f"📋 Информация об очереди {queue['queue_name']}:\n\n"
+        f"📋 Информация об очереди {queue.queue_name}:\n\n"
         f"👥 Участники:\n{users_text}",
         reply_markup=reply_markup
     )
 
 async def show_queues(update: Update, context: CallbackContext) -> None:
     """Отображает список доступных очередей."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = update.effective_user.id
     query = update.callback_query  # Получаем query
 
@@ -710,16 +756,16 @@ async def show_queues(update: Update, context: CallbackContext) -> None:
             return
 
     # Получаем очереди
-    queues_list = get_user_queues(conn, user_id)
+    queues_list = await repo.get_user_queues(user_id)
     if user_id == ADMIN_ID:
-        queues_list = get_all_queues(conn)
+        queues_list = await repo.get_all_queues()
 
-    buttons = [InlineKeyboardButton("➕ Создать очередь", callback_data="create_queue")]
-    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data="main_menu"))
+    buttons = [InlineKeyboardButton("➕ Создать очередь", callback_data=pack(CB_CREATE_QUEUE))]
+    buttons.append(InlineKeyboardButton("🔙 Назад", callback_data=pack(CB_MAIN_MENU)))
 
     if queues_list:
         for queue in reversed(queues_list):
-            buttons.insert(0, InlineKeyboardButton(queue['queue_name'], callback_data=f"queue_info_{queue['queue_id']}"))
+            buttons.insert(0, InlineKeyboardButton(queue['queue_name'], callback_data=pack(CB_QUEUE_INFO, queue['queue_id'])))
         menu = build_menu(buttons, n_cols=1)
         reply_markup = InlineKeyboardMarkup(menu)
     else:
@@ -735,14 +781,14 @@ async def show_queues(update: Update, context: CallbackContext) -> None:
 
 async def get_web_app_loc(update: Update, context: CallbackContext) -> None:
     """Обрабатывает данные Web App (геолокацию)."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     user_id = context.user_data.get("user_id")
-    user_timezone_str = get_user_timezone(conn, user_id)
+    user_timezone_str = await repo.get_user_timezone(user_id)
     user_timezone = pytz.timezone(user_timezone_str)
 
     queue_id = context.user_data.get("queue_id")
-    queue = await get_queue_by_id(conn, queue_id)
-    queue_start_time = queue["start_time"].astimezone(user_timezone)
+    queue = await repo.get_queue_by_id(queue_id)
+    queue_start_time = from_epoch(queue["start_ts"]).astimezone(user_timezone)
 
     if queue_start_time > datetime.now(user_timezone):
         await update.message.reply_text(f"⚠️ Запись начнется *{queue_start_time.strftime('%d.%m.%Y %H:%M')}* ⏰")
@@ -766,9 +812,57 @@ async def get_web_app_loc(update: Update, context: CallbackContext) -> None:
         logger.error(f"Ошибка в обработке Web App данных: {e}")
         await update.message.reply_text("❌ Произошла ошибка.", reply_markup=ReplyKeyboardRemove())
 
+async def nearby_command(update: Update, context: CallbackContext) -> None:
+    """Команда /nearby: просит геолокацию, чтобы показать очереди рядом."""
+    reply_markup = build_web_app_location_button(rec_source="nearby")
+    await update.message.reply_text("📍 Отправьте геолокацию, чтобы найти очереди рядом:", reply_markup=reply_markup)
+
+async def show_nearby_queues(update: Update, context: CallbackContext) -> None:
+    """Показывает очереди, в которые можно записаться из присланной точки."""
+    try:
+        data = json.loads(update.message.web_app_data.data)
+        lat, lon = float(data["lat"]), float(data["lon"])
+    except (json.JSONDecodeError, ValueError, TypeError, KeyError, AttributeError):
+        await update.message.reply_text("❌ Ошибка: не удалось получить координаты.", reply_markup=ReplyKeyboardRemove())
+        return
+
+    # Кандидаты берутся из пространственного индекса, а не перебором всех очередей
+    now = datetime.now(pytz.UTC)
+    nearby = [(distance, queue) for distance, queue in context.bot_data['queues'].nearby(lat, lon)
+              if queue.start_time is None or queue.start_time <= now]
+    if not nearby:
+        await update.message.reply_text("🔍 Рядом нет очередей, открытых для записи.", reply_markup=ReplyKeyboardRemove())
+        return
+
+    user_id = update.effective_user.id
+    buttons = [
+        InlineKeyboardButton(
+            f"{'✅ ' if user_id in queue else ''}{queue.queue_name} · {distance:.0f} м · {len(queue)} чел.",
+            callback_data=pack(CB_JOIN_QUEUE, queue.queue_id)
+        )
+        for distance, queue in nearby
+    ]
+    await update.message.reply_text("🔍 Очереди рядом:", reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text("Выберите очередь для записи:", reply_markup=InlineKeyboardMarkup(build_menu(buttons)))
+
+async def add_location_command(update: Update, context: CallbackContext) -> None:
+    """Команда администратора /add_location <широта> <долгота> <название>: добавляет место в справочник."""
+    if update.effective_user.id != ADMIN_ID:
+        return
+    try:
+        lat, lon, name = update.message.text.split(maxsplit=3)[1:]
+        lat, lon = float(lat), float(lon)
+    except ValueError:
+        await update.message.reply_text("❌ Формат: /add_location <широта> <долгота> <название>", parse_mode=None)
+        return
+    location_id = await context.bot_data['repo'].insert_location(name, lat, lon)
+    if location_id:
+        await update.message.reply_text(f"✅ Место *{name}* сохранено.")
+    else:
+        await update.message.reply_text("❌ Не удалось сохранить место.")
+
 async def ask_location(update: Update, context: CallbackContext) -> None:
     """Обрабатывает данные геолокации из WebApp."""
-    conn = context.bot_data['conn']
     user_id = context.user_data.get("user_id")
     queue_id = context.user_data.get("queue_id")
     
@@ -790,19 +884,13 @@ async def ask_location(update: Update, context: CallbackContext) -> None:
         logger.error(f"Ошибка в обработке Web App данных: {e}")
         await update.message.reply_text("❌ Произошла ошибка.", reply_markup=ReplyKeyboardRemove())
 
-async def generate_queue_invite_button(update: Update, context: CallbackContext) -> None:
+async def generate_queue_invite_button(update: Update, context: CallbackContext, queue_id: int) -> None:
     """Генерирует пригласительную кнопку для очереди."""
     query = update.callback_query
     await query.answer()
-    conn = context.bot_data['conn']
-    print(query.data.split("_")[2])
-    try:
-        queue_id = int(query.data.split("_")[2])
-    except (IndexError, ValueError):
-        await query.edit_message_text("❌ Ошибка: Неверный формат данных.")
-        return
+    repo = context.bot_data['repo']
 
-    queue = await get_queue_by_id(conn, queue_id)
+    queue = await repo.get_queue_by_id(queue_id)
     if not queue:
         await query.edit_message_text("❌ Ошибка: Очередь не найдена.")
         return
@@ -813,12 +901,19 @@ async def generate_queue_invite_button(update: Update, context: CallbackContext)
         return
 
     # Получаем информацию о времени начала в часовом поясе пользователя
-    user_timezone_str = get_user_timezone(conn, user_id)
-    start_time = convert_time_to_user_timezone(queue['start_time'], user_timezone_str)
+    user_timezone_str = await repo.get_user_timezone(user_id)
+    start_time = convert_time_to_user_timezone(queue['start_ts'], user_timezone_str)
     time_info = f"📅 Дата: *{start_time.strftime('%d.%m.%y')}*\n⏰ Время: *{start_time.strftime('%H:%M')}*"
 
+    invite = await context.bot_data['invites'].create(INVITE_QUEUE, queue_id, user_id)
+    if not invite:
+        await query.edit_message_text("❌ Ошибка: не удалось создать приглашение.")
+        return
+    invite_id, max_uses, expires_ts = invite
+
     message_text, reply_markup = await generate_invite_button_message(
-        context, "queue", queue_id, queue['creator_id'], queue['queue_name'], time_info
+        context, "queue", queue_id, queue['creator_id'], queue['queue_name'],
+        time_info + format_invite_limits(max_uses, expires_ts, user_timezone_str), invite_id
     )
 
     await context.bot.send_message(
@@ -828,18 +923,13 @@ async def generate_queue_invite_button(update: Update, context: CallbackContext)
         link_preview_options=LinkPreviewOptions(is_disabled=True)
     )
 
-async def generate_group_invite_button(update: Update, context: CallbackContext) -> None:
+async def generate_group_invite_button(update: Update, context: CallbackContext, group_id: int) -> None:
     """Генерирует пригласительную кнопку для группы."""
     query = update.callback_query
     await query.answer()
-    conn = context.bot_data['conn']
-    try:
-        group_id = int(query.data.split("_")[2])
-    except (IndexError, ValueError):
-        await query.edit_message_text("❌ Ошибка: Неверный формат данных.")
-        return
+    repo = context.bot_data['repo']
 
-    group = get_group_by_id(conn, group_id)
+    group = await repo.get_group_by_id(group_id)
     if not group:
         await query.edit_message_text("❌ Ошибка: Группа не найдена.")
         return
@@ -850,12 +940,20 @@ async def generate_group_invite_button(update: Update, context: CallbackContext)
         return
 
     # Получаем список участников для дополнительной информации
-    users_list = get_group_users(conn, group_id)
+    users_list = await repo.get_group_users(group_id)
     members_count = len(users_list) if users_list else 0
     members_info = f"👥 Участников: *{members_count}*"
 
+    invite = await context.bot_data['invites'].create(INVITE_GROUP, group_id, user_id)
+    if not invite:
+        await query.edit_message_text("❌ Ошибка: не удалось создать приглашение.")
+        return
+    invite_id, max_uses, expires_ts = invite
+    user_timezone_str = await repo.get_user_timezone(user_id)
+
     message_text, reply_markup = await generate_invite_button_message(
-        context, "group", group_id, group['creator_id'], group['group_name'], members_info
+        context, "group", group_id, group['creator_id'], group['group_name'],
+        members_info + format_invite_limits(max_uses, expires_ts, user_timezone_str), invite_id
     )
 
     await context.bot.send_message(
@@ -865,60 +963,55 @@ async def generate_group_invite_button(update: Update, context: CallbackContext)
         link_preview_options=LinkPreviewOptions(is_disabled=True)
     )
 
-async def handle_join_queue(update: Update, context: CallbackContext) -> None:
-    """Централизованный обработчик присоединения к очереди."""
+async def handle_join_queue(update: Update, context: CallbackContext, queue_id: int, invite_id: int | None = None) -> None:
+    """Централизованный обработчик присоединения к очереди.
+
+    invite_id — приглашение с лимитом из deeplink; его использование засчитывается
+    в момент записи, а не при переходе по ссылке.
+    """
     query = update.callback_query
     await query.answer()
-    conn = context.bot_data['conn']
-    
-    # Получаем queue_id из callback_data
-    try:
-        queue_id = int(query.data.split("_")[2])
-    except (IndexError, ValueError):
-        await query.edit_message_text("❌ Ошибка: Неверный формат данных.")
-        return
+    repo = context.bot_data['repo']
 
     user_id = update.effective_user.id
-    queue = await get_queue_by_id(conn, queue_id)
+    engine = context.bot_data['queues']
+    queue = await engine.get(queue_id)
     if not queue:
         await query.edit_message_text("❌ Ошибка: Очередь не найдена.")
         return
 
     # Проверяем, не записан ли уже пользователь
-    if is_user_in_queue(conn, queue_id, user_id):
+    if user_id in queue:
         await query.edit_message_text("✅ Вы уже записаны в эту очередь.")
         return
 
     # Проверяем время начала очереди
-    user_timezone_str = get_user_timezone(conn, user_id)
+    user_timezone_str = await repo.get_user_timezone(user_id)
     user_timezone = pytz.timezone(user_timezone_str)
-    queue_start_time = queue["start_time"].astimezone(user_timezone)
+    queue_start_time = queue.start_time.astimezone(user_timezone)
     
     if datetime.now(user_timezone) < queue_start_time:
         await query.edit_message_text(f"⚠️ Запись начнется *{queue_start_time.strftime('%d.%m.%Y %H:%M')}* ⏰")
         return
 
     # Проверяем время без локации
-    time_without_location = queue.get('time_without_location')
+    time_without_location = queue.time_without_location
     if time_without_location:
         time_without_location = time_without_location.astimezone(user_timezone)
         if datetime.now(user_timezone).time() >= time_without_location.time():
             # Записываем без проверки локации
-            join_time = datetime.now(user_timezone).isoformat()
-            add_user_to_queue(conn, queue_id, user_id, join_time)
-            await query.edit_message_text(
-                f"✅ Вы записаны в очередь {queue['queue_name']}"
-            )
+            await query.edit_message_text(await join_queue_with_invite(context, queue, user_id, invite_id))
             return
 
     # Если требуется проверка локации
     context.user_data['queue_id'] = queue_id
     context.user_data['user_id'] = user_id
+    context.user_data['invite'] = (queue_id, invite_id)  # засчитывается в check_distance_and_join
     
     # Запрашиваем локацию
     reply_markup = build_web_app_location_button(rec_source="get_location")
     sent_message = await query.message.reply_text(
-        f"📌 Для записи в '{queue['queue_name']}', отправьте геолокацию 📍:",
+        f"📌 Для записи в '{queue.queue_name}', отправьте геолокацию 📍:",
         reply_markup=reply_markup,
     )
     context.user_data["location_message_id"] = sent_message.message_id
\ No newline at end of file
@@ -0,0 +1,287 @@
+import asyncio
+import functools
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+import config
+import db
+from cache import LRUCache, MISSING
+from db import BatchingConnection, UserProfile, create_connection, get_pragmas
+from varibles import SQLITE_PRAGMAS, SQLITE_READERS, SQLITE_WRITE_BATCH_WINDOW, SQLITE_WRITE_BATCH_SIZE, USER_CACHE_SIZE, USER_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+# Функции db.py с такими префиксами только читают данные и идут в пул чтения
+READ_PREFIXES = ("get_", "is_")
+
+class WriteBatcher(threading.Thread):
+    """Поток записи с групповой фиксацией.
+
+    Операции, пришедшие от разных обработчиков в течение window секунд,
+    выполняются в одной транзакции: каждая в своей SAVEPOINT, так что ошибка
+    одной не отменяет остальные, а на всю группу приходится один commit.
+    Future каждой операции завершается только после этого commit.
+    """
+
+    def __init__(self, connect, window: float, max_batch: int):
+        super().__init__(name="db-writer", daemon=True)
+        self._connect = connect
+        self._window = window
+        self._max_batch = max(1, max_batch)
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self.conn = None
+        self.batches = 0
+        self.operations = 0
+
+    def submit(self, func, args, kwargs, exclusive: bool = False) -> Future:
+        """Ставит func(conn, *args, **kwargs) в очередь записи."""
+        future = Future()
+        self._queue.put((func, args, kwargs, exclusive, future))
+        return future
+
+    def start(self):
+        super().start()
+        self._ready.wait()
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        self.conn = self._connect()
+        self._ready.set()
+        if self.conn is None:
+            return
+
+        carry = None
+        while True:
+            item = carry or self._queue.get()
+            carry = None
+            if item is None:
+                break
+            if item[3]:
+                self._execute_exclusive(item)
+                continue
+
+            batch = [item]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None or item[3]:
+                    carry = item
+                    break
+                batch.append(item)
+            self._execute_batch(batch)
+
+        self.conn.close()
+        logger.info("Соединение с базой данных закрыто")
+
+    def _execute_exclusive(self, item):
+        func, args, kwargs, _, future = item
+        try:
+            future.set_result(func(self.conn, *args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _execute_batch(self, batch):
+        conn = self.conn
+        outcomes = []
+        conn.deferred = True
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for func, args, kwargs, _, future in batch:
+                conn.execute("SAVEPOINT operation")
+                try:
+                    result = func(conn, *args, **kwargs)
+                    conn.execute("RELEASE operation")
+                    outcomes.append((future, result, None))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO operation")
+                    conn.execute("RELEASE operation")
+                    outcomes.append((future, None, e))
+            conn.deferred = False
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка при групповой записи ({len(batch)} операций): {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            outcomes = [(future, None, e) for *_, future in batch]
+        finally:
+            conn.deferred = False
+
+        self.batches += 1
+        self.operations += len(batch)
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+class Repository:
+    """Асинхронный слой доступа к данным.
+
+    Все запросы к SQLite выполняются вне цикла событий. Запись идет через
+    единственное подключение в отдельном потоке (SQLite допускает одного
+    писателя) с групповой фиксацией, чтение — через пул подключений в режиме
+    WAL, поэтому SELECT не ждет завершения чужого commit. Любая функция из
+    db.py вида func(conn, ...) доступна как awaitable-метод: await repo.func(...).
+
+    Профили пользователей (имя, состояние, часовой пояс) читаются через кэш
+    profiles; методы, изменяющие users, сбрасывают запись после фиксации.
+    """
+
+    def __init__(self, database: str | None = None, pragmas: dict | None = None, readers: int | None = None,
+                 write_batch_window: float | None = None, write_batch_size: int | None = None):
+        self._database = database or config.DATABASE_NAME
+        self._pragmas = pragmas if pragmas is not None else getattr(config, "SQLITE_PRAGMAS", SQLITE_PRAGMAS)
+        self._readers = readers or getattr(config, "SQLITE_READERS", SQLITE_READERS)
+        if write_batch_window is None:
+            write_batch_window = getattr(config, "SQLITE_WRITE_BATCH_WINDOW", SQLITE_WRITE_BATCH_WINDOW)
+        if write_batch_size is None:
+            write_batch_size = getattr(config, "SQLITE_WRITE_BATCH_SIZE", SQLITE_WRITE_BATCH_SIZE)
+        self._writer = WriteBatcher(
+            functools.partial(create_connection, self._database, self._pragmas, factory=BatchingConnection),
+            write_batch_window, write_batch_size
+        )
+        self._reader = ThreadPoolExecutor(max_workers=self._readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+        self.profiles = LRUCache(getattr(config, "USER_CACHE_SIZE", USER_CACHE_SIZE),
+                                 getattr(config, "USER_CACHE_TTL", USER_CACHE_TTL))
+
+    def _read_call(self, func, args, kwargs):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = create_connection(self._database, self._pragmas, read_only=True)
+            if conn is None:
+                raise sqlite3.OperationalError("Не удалось открыть подключение на чтение")
+            self._local.conn = conn
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return func(conn, *args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет func(conn, *args, **kwargs) на подключении для записи в составе групповой транзакции.
+
+        Возвращает результат после того, как транзакция зафиксирована.
+        """
+        return await asyncio.wrap_future(self._writer.submit(func, args, kwargs))
+
+    async def run_exclusive(self, func, *args, **kwargs):
+        """Выполняет func на подключении для записи вне групповой транзакции (миграции, PRAGMA)."""
+        return await asyncio.wrap_future(self._writer.submit(func, args, kwargs, exclusive=True))
+
+    async def read(self, func, *args, **kwargs):
+        """Выполняет func(conn, *args, **kwargs) на одном из подключений для чтения."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, self._read_call, func, args, kwargs)
+
+    async def open(self) -> bool:
+        """Запускает поток записи, открывает его подключение и применяет профиль PRAGMA."""
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.start)
+        return self._writer.conn is not None
+
+    async def pragma_report(self) -> dict:
+        """Возвращает действующие PRAGMA подключений на запись и на чтение."""
+        return {"writer": await self.run_exclusive(get_pragmas), "reader": await self.read(get_pragmas)}
+
+    async def get_user_profile(self, user_id: int) -> UserProfile | None:
+        """Возвращает профиль пользователя из кэша, при промахе читает его из БД."""
+        profile = self.profiles.get(user_id)
+        if profile is not MISSING:
+            return profile
+        generation = self.profiles.generation
+        try:
+            profile = await self.read(db.get_user_profile, user_id)
+        except sqlite3.Error:
+            return None  # Ошибка уже записана в лог, в кэш ее не сохраняем
+        self.profiles.put(user_id, profile, generation)
+        return profile
+
+    async def get_user_names(self, user_ids: list[int]) -> dict[int, str | None]:
+        """Возвращает имена пользователей; промахи кэша дочитываются одним запросом."""
+        names = {}
+        missing = []
+        for user_id in user_ids:
+            profile = self.profiles.get(user_id)
+            if profile is MISSING:
+                missing.append(user_id)
+            else:
+                names[user_id] = profile.name if profile else None
+        if missing:
+            generation = self.profiles.generation
+            try:
+                found = {profile.user_id: profile for profile in await self.read(db.get_user_profiles, missing)}
+            except sqlite3.Error:
+                return {**names, **{user_id: None for user_id in missing}}
+            for user_id in missing:
+                profile = found.get(user_id)
+                self.profiles.put(user_id, profile, generation)
+                names[user_id] = profile.name if profile else None
+        return names
+
+    async def get_user_data(self, user_id: int) -> tuple | None:
+        profile = await self.get_user_profile(user_id)
+        return (profile.name, profile.state) if profile else None
+
+    async def get_user_name(self, user_id: int) -> str | None:
+        profile = await self.get_user_profile(user_id)
+        return profile.name if profile else None
+
+    async def get_user_timezone(self, user_id: int) -> str | None:
+        profile = await self.get_user_profile(user_id)
+        return profile.time_zone if profile else None
+
+    async def _write_user(self, func, user_id: int, *args, **kwargs):
+        try:
+            return await self.run(func, user_id, *args, **kwargs)
+        finally:
+            self.profiles.invalidate(user_id)
+
+    async def set_user_name(self, user_id: int, *args, **kwargs):
+        return await self._write_user(db.set_user_name, user_id, *args, **kwargs)
+
+    async def update_user_name(self, user_id: int, *args, **kwargs):
+        return await self._write_user(db.update_user_name, user_id, *args, **kwargs)
+
+    async def update_user_timezone(self, user_id: int, *args, **kwargs):
+        return await self._write_user(db.update_user_timezone, user_id, *args, **kwargs)
+
+    async def update_user_state(self, user_id: int, *args, **kwargs):
+        return await self._write_user(db.update_user_state, user_id, *args, **kwargs)
+
+    def cache_stats(self) -> dict:
+        """Возвращает счетчики кэша профилей."""
+        return self.profiles.stats()
+
+    def write_stats(self) -> dict:
+        """Возвращает число зафиксированных групп и операций записи."""
+        return {"batches": self._writer.batches, "operations": self._writer.operations}
+
+    def close(self):
+        """Закрывает все подключения и останавливает потоки БД."""
+        self._reader.shutdown(wait=True)
+        with self._reader_lock:
+            for conn in self._reader_conns:
+                conn.close()
+            self._reader_conns.clear()
+        if self._writer.is_alive():
+            self._writer.stop()
+
+    def __getattr__(self, name):
+        func = getattr(db, name, None)
+        if name.startswith("_") or not isinstance(func, types.FunctionType) or getattr(func, "__module__", None) != db.__name__:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        runner = self.read if name.startswith(READ_PREFIXES) else self.run
+        method = functools.partial(runner, func)
+        setattr(self, name, method)
+        return method
@@ -0,0 +1,96 @@
+import functools
+import logging
+import time
+from telegram import Update
+from telegram.ext import CallbackContext, CallbackQueryHandler
+from callbacks import CallbackCodec, callbacks
+
+logger = logging.getLogger(__name__)
+
+class _Route:
+    __slots__ = ("name", "handler", "bound", "calls", "total", "slowest")
+
+    def __init__(self, name: str, handler, bound: tuple):
+        self.name = name
+        self.handler = handler
+        self.bound = bound
+        self.calls = 0
+        self.total = 0.0
+        self.slowest = 0.0
+
+    async def __call__(self, update: Update, context: CallbackContext, args: tuple):
+        started = time.perf_counter()
+        try:
+            return await self.handler(update, context, *self.bound, *args)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.calls += 1
+            self.total += elapsed
+            self.slowest = max(self.slowest, elapsed)
+
+class CallbackRouter:
+    """Диспетчер нажатий inline-кнопок вместо цепочки CallbackQueryHandler с регулярными выражениями.
+
+    callback_data разбирается один раз кодеком (см. callbacks.py) в код
+    действия и типизированные аргументы; обработчик действия вызывается как
+    handler(update, context, *bound, *args), где bound — значения, заданные
+    при регистрации. Кнопки внутри диалогов (ConversationHandler) проверяются
+    фильтром pattern() и вызываются через bind() с тем же разбором. Для
+    каждого действия считаются число вызовов, среднее и наибольшее время
+    обработки.
+    """
+
+    def __init__(self, codec: CallbackCodec | None = None, fallback=None):
+        self.codec = codec or callbacks
+        self._routes: dict[int, _Route] = {}
+        self._bound: list[_Route] = []  # маршруты кнопок диалогов, только для статистики
+        self._fallback = fallback
+        self.unmatched = 0
+
+    def add(self, action: int, handler, *bound):
+        """Регистрирует обработчик действия; bound передаются перед аргументами кнопки."""
+        if action in self._routes:
+            raise ValueError(f"Маршрут {self.codec.name(action)} уже зарегистрирован")
+        self._routes[action] = _Route(self.codec.name(action), handler, bound)
+
+    def pattern(self, *actions: int):
+        """Фильтр для CallbackQueryHandler: кнопка с одним из действий actions."""
+        def matches(data) -> bool:
+            decoded = self.codec.unpack(data) if isinstance(data, str) else None
+            return decoded is not None and decoded[0] in actions
+        return matches
+
+    def bind(self, handler, *bound):
+        """Оборачивает обработчик кнопки диалога: он получает аргументы кнопки и возвращает состояние."""
+        routes = {}
+
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: CallbackContext):
+            action, args = self.codec.unpack(update.callback_query.data)
+            route = routes.get(action)
+            if route is None:
+                route = routes[action] = _Route(self.codec.name(action), handler, bound)
+                self._bound.append(route)
+            return await route(update, context, args)
+        return wrapper
+
+    async def dispatch(self, update: Update, context: CallbackContext):
+        decoded = self.codec.unpack(update.callback_query.data)
+        route = self._routes.get(decoded[0]) if decoded is not None else None
+        if route is None:
+            self.unmatched += 1
+            if self._fallback is not None:
+                await self._fallback(update, context)
+            return
+        await route(update, context, decoded[1])
+
+    def handler(self) -> CallbackQueryHandler:
+        """Один CallbackQueryHandler для всех зарегистрированных действий."""
+        return CallbackQueryHandler(self.dispatch)
+
+    def stats(self) -> dict:
+        """Возвращает по маршрутам с вызовами: число вызовов, среднее и наибольшее время в мс."""
+        return {
+            route.name: {"calls": route.calls, "avg_ms": route.total / route.calls * 1000, "max_ms": route.slowest * 1000}
+            for route in sorted([*self._routes.values(), *self._bound], key=lambda route: -route.total) if route.calls
+        }
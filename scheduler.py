@@ -0,0 +1,94 @@
+import logging
+import time
+from telegram.ext import CallbackContext, JobQueue
+import config
+from varibles import SCHEDULER_HORIZON, SCHEDULER_TICK
+
+logger = logging.getLogger(__name__)
+
+class Scheduler:
+    """Отложенные задачи, которые переживают перезапуск бота.
+
+    Задачи хранятся в таблице scheduled_jobs. В JobQueue попадают только те,
+    срок которых наступает в ближайшие SCHEDULER_HORIZON секунд: их раз в
+    SCHEDULER_TICK секунд дочитывает один повторяющийся тик, поэтому память
+    JobQueue и время запуска не зависят от числа будущих рассылок и очередей.
+    Первый тик сразу после запуска подхватывает просроченные задачи. Задача
+    удаляется из таблицы после успешного выполнения; если обработчик упал,
+    она повторится на следующем тике.
+    """
+
+    def __init__(self, repo, horizon: int | None = None, tick: int | None = None):
+        self._repo = repo
+        self._horizon = horizon or getattr(config, "SCHEDULER_HORIZON", SCHEDULER_HORIZON)
+        self._tick_interval = min(tick or getattr(config, "SCHEDULER_TICK", SCHEDULER_TICK), self._horizon)
+        self._handlers = {}
+        self._armed = {}  # id задачи -> Job в JobQueue
+        self._running = set()  # id выполняющихся задач: долгая рассылка не должна стартовать повторно
+        self._window_end = 0
+        self._job_queue = None
+
+    def register(self, kind: str, handler):
+        """Назначает обработчик вида задач: async handler(context, target_id)."""
+        self._handlers[kind] = handler
+
+    def start(self, job_queue: JobQueue):
+        """Запускает тик, сдвигающий окно загрузки задач."""
+        self._job_queue = job_queue
+        job_queue.run_repeating(self._tick, interval=self._tick_interval, first=0, name="scheduler_tick")
+
+    def _arm(self, job_id: int, kind: str, target_id: int, due_ts: int):
+        if job_id in self._armed or job_id in self._running:
+            return
+        delay = max(due_ts - time.time(), 0)
+        self._armed[job_id] = self._job_queue.run_once(
+            self._fire, delay, data=(job_id, kind, target_id, due_ts), name=f"{kind}_{target_id}"
+        )
+
+    def _disarm(self, job_id: int | None):
+        job = self._armed.pop(job_id, None)
+        if job is not None:
+            job.schedule_removal()
+
+    async def _tick(self, context: CallbackContext):
+        window_end = int(time.time()) + self._horizon
+        jobs = await self._repo.get_due_jobs(window_end)
+        for job_id, kind, target_id, due_ts in jobs:
+            self._arm(job_id, kind, target_id, due_ts)
+        self._window_end = window_end
+        if jobs:
+            logger.info(f"Отложенных задач в ближайшие {self._horizon // 60} мин: {len(jobs)}")
+
+    async def _fire(self, context: CallbackContext):
+        job_id, kind, target_id, due_ts = context.job.data
+        self._armed.pop(job_id, None)
+        handler = self._handlers.get(kind)
+        if handler is None:
+            logger.error(f"Нет обработчика для отложенной задачи {kind} (ID {job_id})")
+            return
+        self._running.add(job_id)
+        try:
+            await handler(context, target_id)
+            await self._repo.complete_job(job_id, due_ts)
+        except Exception as e:
+            logger.error(f"Ошибка при выполнении отложенной задачи {kind} для {target_id}: {e}")
+        finally:
+            self._running.discard(job_id)
+
+    async def schedule(self, kind: str, target_id: int, due_ts: int) -> int | None:
+        """Сохраняет задачу (или переносит существующую) и ставит ее в JobQueue, если срок в текущем окне."""
+        job_id = await self._repo.schedule_job(kind, target_id, due_ts)
+        if job_id is None:
+            return None
+        self._disarm(job_id)
+        if due_ts < self._window_end and self._job_queue is not None:
+            self._arm(job_id, kind, target_id, due_ts)
+        return job_id
+
+    async def cancel(self, kind: str, target_id: int):
+        """Удаляет задачу из таблицы и из JobQueue."""
+        self._disarm(await self._repo.cancel_job(kind, target_id))
+
+    def stats(self) -> dict:
+        """Возвращает число задач в JobQueue и выполняющихся, конец окна загрузки."""
+        return {"armed": len(self._armed), "running": len(self._running), "window_end": self._window_end}
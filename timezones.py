@@ -0,0 +1,64 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import config
+from cache import LRUCache, MISSING
+from varibles import TZ_CACHE_SIZE, TZ_CACHE_PRECISION
+
+logger = logging.getLogger(__name__)
+
+class TimezoneLookup:
+    """Определение часового пояса по координатам, общее на весь процесс.
+
+    TimezoneFinder загружает данные полигонов при создании, поэтому создается
+    один раз, лениво, в собственном потоке: цикл событий не ждет ни загрузки,
+    ни поиска. Результаты кэшируются в LRU по координатам, округленным до
+    TZ_CACHE_PRECISION знаков (2 знака — около километра; ошибиться так можно
+    только у самой границы пояса). Одновременные запросы одной клетки ждут
+    один поиск.
+    """
+
+    def __init__(self, cache_size: int | None = None, precision: int | None = None):
+        self._precision = precision if precision is not None else getattr(config, "TZ_CACHE_PRECISION", TZ_CACHE_PRECISION)
+        self.cache = LRUCache(cache_size if cache_size is not None else getattr(config, "TZ_CACHE_SIZE", TZ_CACHE_SIZE))
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="timezone")
+        self._finder = None
+        self._pending = {}  # ключ -> future выполняющегося поиска
+
+    def _lookup(self, lat: float, lon: float) -> str | None:
+        # Выполняется только в потоке self._executor
+        if self._finder is None:
+            from timezonefinder import TimezoneFinder
+            self._finder = TimezoneFinder()
+        return self._finder.timezone_at(lng=lon, lat=lat)
+
+    async def timezone_at(self, lat: float, lon: float) -> str | None:
+        """Возвращает имя часового пояса (например, "Asia/Krasnoyarsk") или None."""
+        key = (round(lat, self._precision), round(lon, self._precision))
+        timezone = self.cache.get(key)
+        if timezone is not MISSING:
+            return timezone
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = asyncio.get_running_loop().run_in_executor(self._executor, self._lookup, *key)
+            self._pending[key] = pending
+            try:
+                timezone = await pending
+            finally:
+                self._pending.pop(key, None)
+            self.cache.put(key, timezone)
+            return timezone
+        return await asyncio.shield(pending)
+
+    async def warm_up(self):
+        """Загружает данные TimezoneFinder заранее, чтобы первый пользователь не ждал."""
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._lookup, 0.0, 0.0)
+        logger.info("Данные часовых поясов загружены")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+timezone_lookup = TimezoneLookup()
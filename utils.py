@@ -3,12 +3,13 @@ import logging
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, WebAppInfo, ReplyKeyboardRemove, LinkPreviewOptions, Update
 from telegram.ext import CallbackContext
 from datetime import datetime
-from geopy.distance import geodesic
-from db import get_queue_by_id, get_queue_name_by_id, add_user_to_queue, get_queue_users_names, get_queue_users_ids, get_user_name, get_user_timezone
 from config import GET_LOCATION_URL
-from varibles import MAX_DISTANCE, JOIN_GROUP_PAYLOAD, JOIN_QUEUE_PAYLOAD, RUSSIAN_TIMEZONES
-from crypto import encrypt_data
-from timezonefinder import TimezoneFinder
+from varibles import JOIN_GROUP_PAYLOAD, JOIN_QUEUE_PAYLOAD, RUSSIAN_TIMEZONES
+from crypto import encode_invite
+from invites import INVITE_QUEUE, REJECTION_MESSAGES
+from callbacks import *
+from db import from_epoch
+from timezones import timezone_lookup
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +18,8 @@ async def send_notification(user_id: int, message: str, context: CallbackContext
     try:
         await context.bot.send_message(user_id, message)
     except Exception as e:
-        logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+        reason = await context.bot_data['reachability'].report_error(user_id, e)
+        logger.error(f"Не удалось отправить сообщение пользователю {user_id} ({reason}): {e}")
 
 def build_menu(buttons, n_cols=1, header_buttons=None, footer_buttons=None):
     """Создает меню из кнопок."""
@@ -28,13 +30,11 @@ def build_menu(buttons, n_cols=1, header_buttons=None, footer_buttons=None):
         menu.append(footer_buttons)
     return menu
 
-def build_location_menu():
-    """Создает клавиатуру выбора местоположения."""
-    buttons = [
-        InlineKeyboardButton("🏛 МатФак", callback_data="location_mathfac"),
-        InlineKeyboardButton("📍 Указать геолокацию", callback_data="location_custom")
-    ]
-    return InlineKeyboardMarkup(build_menu(buttons)) 
+def build_location_menu(locations: list[dict]):
+    """Создает клавиатуру выбора местоположения: места из справочника и своя геолокация."""
+    buttons = [InlineKeyboardButton(location['name'], callback_data=pack(CB_LOCATION, location['location_id'])) for location in locations]
+    buttons.append(InlineKeyboardButton("📍 Указать геолокацию", callback_data=pack(CB_LOCATION_CUSTOM)))
+    return InlineKeyboardMarkup(build_menu(buttons))
 
 def validate_date(date_str: str) -> bool:
     """Проверяет корректность формата даты."""
@@ -52,17 +52,35 @@ def validate_time(time_str: str) -> bool:
     except ValueError:
         return False
 
+async def join_queue_with_invite(context, queue, user_id: int, invite_id: int | None = None) -> str:
+    """Записывает пользователя в очередь и возвращает текст ответа.
+
+    Использование приглашения invite_id засчитывается только после того, как
+    запись действительно добавлена: повторная геолокация или параллельное
+    нажатие его не тратят. Если приглашение отклонено, запись отменяется.
+    """
+    engine = context.bot_data['queues']
+    if not await engine.join(queue.queue_id, user_id):
+        state = await engine.get(queue.queue_id)
+        if state is not None and user_id in state:
+            return "✅ Вы уже записаны в эту очередь."
+        return "❌ Ошибка: не удалось записаться в очередь."
+    if invite_id is not None:
+        reason = await context.bot_data['invites'].redeem(invite_id, INVITE_QUEUE, queue.queue_id)
+        if reason:
+            await engine.leave(queue.queue_id, user_id)
+            return REJECTION_MESSAGES[reason]
+    return f"✅ Вы записаны в очередь {queue.queue_name}."
+
 async def check_distance_and_join(update, context, queue_id, user_id, lat, lon):
     """Проверяет расстояние и записывает пользователя в очередь."""
-    conn = context.bot_data['conn']
-    queue = await get_queue_by_id(context.bot_data['conn'], queue_id)
+    queue = await context.bot_data['queues'].get(queue_id)
     if not queue:
         await update.message.reply_text("❌ Ошибка: очередь не найдена.", reply_markup=ReplyKeyboardRemove())
         return
 
-    target_coordinates = (queue["latitude"], queue["longitude"])
-    user_coord = (lat, lon)
-    distance = geodesic(user_coord, target_coordinates).meters
+    # Радиус очереди или ее геозона; границы и масштабы посчитаны при загрузке (см. geo.py)
+    in_range = queue.covers(lat, lon)
     location_message = await update.effective_message.reply_location(
         latitude=lat,
         longitude=lon,
@@ -70,37 +88,37 @@ async def check_distance_and_join(update, context, queue_id, user_id, lat, lon):
         )
     context.user_data['location_message_id'] = location_message.message_id
 
-    if distance <= MAX_DISTANCE:
-        user_timezone_str = get_user_timezone(conn, user_id)
-        user_timezone = pytz.timezone(user_timezone_str)
-        join_time = datetime.now(user_timezone).isoformat()
-        add_user_to_queue(context.bot_data['conn'], queue_id, user_id, join_time)  # Corrected
-        await update.message.reply_text(f"✅ Вы записаны в очередь {queue['queue_name']}.", reply_markup=ReplyKeyboardRemove())
+    if in_range:
+        invite_queue_id, invite_id = context.user_data.pop('invite', (None, None))
+        if invite_queue_id != queue_id:
+            invite_id = None
+        text = await join_queue_with_invite(context, queue, user_id, invite_id)
+        await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
     else:
         await update.message.reply_text("❌ Слишком далеко для записи в очередь.", reply_markup=ReplyKeyboardRemove())
 
-async def create_join_queue_button(context, queue_id, creator_id):
-    """Создает кнопку 'Присоединиться к очереди' с зашифрованным ID."""
-    encrypted_id = encrypt_data(queue_id, creator_id)
-    deeplink = f"https://t.me/{context.bot.username}?start={JOIN_QUEUE_PAYLOAD}{encrypted_id}"
+async def create_join_queue_button(context, queue_id, creator_id, invite_id=None):
+    """Создает кнопку 'Присоединиться к очереди' с подписанным токеном."""
+    token = encode_invite(JOIN_QUEUE_PAYLOAD, queue_id, creator_id, invite_id)
+    deeplink = f"https://t.me/{context.bot.username}?start={JOIN_QUEUE_PAYLOAD}{token}"
     return InlineKeyboardMarkup([[InlineKeyboardButton("➕ Присоединиться к очереди", url=deeplink)]])
 
-async def create_join_group_button(context, group_id, creator_id):
-    encrypted_id = encrypt_data(group_id, creator_id)
-    deeplink = f"https://t.me/{context.bot.username}?start={JOIN_GROUP_PAYLOAD}{encrypted_id}"
+async def create_join_group_button(context, group_id, creator_id, invite_id=None):
+    token = encode_invite(JOIN_GROUP_PAYLOAD, group_id, creator_id, invite_id)
+    deeplink = f"https://t.me/{context.bot.username}?start={JOIN_GROUP_PAYLOAD}{token}"
     return InlineKeyboardMarkup([[InlineKeyboardButton("➕ Присоединиться к группе", url=deeplink)]])
 
 async def send_queue_created_message(update, context, queue_name, start_time, reply_markup):
     """Отправляет сообщение об успешном создании очереди."""
-    conn = context.bot_data['conn']
+    repo = context.bot_data['repo']
     queue_id = context.user_data.get('queue_id')
     
     # Получаем данные очереди
-    queue = await get_queue_by_id(conn, queue_id)
-    time_without_location = queue.get('time_without_location') if queue else None
+    queue = await repo.get_queue_by_id(queue_id)
+    time_without_location = from_epoch(queue['time_without_location_ts']) if queue else None
     
     # Получаем часовой пояс пользователя
-    user_timezone_str = get_user_timezone(conn, update.effective_user.id)
+    user_timezone_str = await repo.get_user_timezone(update.effective_user.id)
     user_timezone = pytz.timezone(user_timezone_str)
     
     # Формируем основное сообщение
@@ -129,48 +147,40 @@ async def send_queue_created_message(update, context, queue_name, start_time, re
 
 def build_queues_menu(queues_list):
     """Создает меню со списком очередей."""
-    buttons = [InlineKeyboardButton(queue['queue_name'], callback_data=f"{JOIN_QUEUE_PAYLOAD}{queue['queue_id']}") for queue in queues_list]
+    buttons = [InlineKeyboardButton(queue['queue_name'], callback_data=pack(CB_JOIN_QUEUE, queue['queue_id'])) for queue in queues_list]
     return InlineKeyboardMarkup(build_menu(buttons))
 
 def build_skip_turn_menu(user_queues):
     """Создает меню для пропуска хода."""
-    buttons = [InlineKeyboardButton(queue['queue_name'], callback_data=f"skip_{queue['queue_id']}") for queue in user_queues]
+    buttons = [InlineKeyboardButton(queue['queue_name'], callback_data=pack(CB_SKIP, queue['queue_id'])) for queue in user_queues]
     return InlineKeyboardMarkup(build_menu(buttons))
 
 def build_queue_info_menu(user_queues):
     """Создает меню для просмотра информации об очередях."""
-    buttons = [InlineKeyboardButton(queue['queue_name'], callback_data=f"info_{queue['queue_id']}") for queue in user_queues]
+    buttons = [InlineKeyboardButton(queue['queue_name'], callback_data=pack(CB_QUEUE_INFO, queue['queue_id'])) for queue in user_queues]
     return InlineKeyboardMarkup(build_menu(buttons))
 
-async def generate_queue_info_message(conn, queue_id: int, user_timezone_str: str) -> str:
-    """Генерирует сообщение со списком участников очереди с учетом часового пояса пользователя."""
-    queue_name = get_queue_name_by_id(conn, queue_id)
-    if not queue_name:
-        return "❌ Ошибка: Не удалось получить имя очереди."
+def format_members(members: list[tuple[int, str | None]]) -> str:
+    """Форматирует нумерованный список участников (user_id, имя)."""
+    return "\n".join(f"{i+1}. {name if name else '(Пользователь не найден)'}" for i, (_, name) in enumerate(members))
 
-    queue = await get_queue_by_id(conn, queue_id)
+async def generate_queue_info_message(repo, queue_id: int, user_timezone_str: str) -> str:
+    """Генерирует сообщение со списком участников очереди с учетом часового пояса пользователя."""
+    queue = await repo.get_queue_snapshot(queue_id)
     if not queue:
         return "❌ Ошибка: очередь не найдена."
 
-    start_time = queue['start_time']
+    start_time = queue.start_time
     if start_time:
         start_time = convert_time_to_user_timezone(start_time, user_timezone_str)
         start_time_str = start_time.strftime("%d.%m.%y %H:%M")
     else:
         start_time_str = "Не указано"
 
-    users_list = get_queue_users_names(conn, queue_id)
-    if not users_list:
-        return f"🔍 В очереди {queue_name} пока нет участников. Время начала: {start_time_str}"
-
-    users_text = ""
-    queue_users_ids = get_queue_users_ids(conn, queue_id)
+    if not queue.members:
+        return f"🔍 В очереди {queue.queue_name} пока нет участников. Время начала: {start_time_str}"
 
-    for i, user_id in enumerate(queue_users_ids):
-        user_name = get_user_name(conn, user_id)
-        users_text += f"{i+1}. {user_name if user_name else '(Пользователь не найден)'}\n"
-
-    return f"📋 Список участников очереди {queue_name} (время начала: {start_time_str}):\n{users_text}"
+    return f"📋 Список участников очереди {queue.queue_name} (время начала: {start_time_str}):\n{format_members(queue.members)}\n"
 
 def build_web_app_location_button(rec_source):
     """Создает кнопку для отправки геолокации через Web App."""
@@ -180,31 +190,34 @@ def build_web_app_location_button(rec_source):
 
 def build_group_menu(groups: list[dict]) -> InlineKeyboardMarkup:
     """Создает меню со списком групп."""
-    buttons = [InlineKeyboardButton(group['group_name'], callback_data=f"{JOIN_GROUP_PAYLOAD}{group['group_id']}") for group in groups]
+    buttons = [InlineKeyboardButton(group['group_name'], callback_data=pack(CB_JOIN_GROUP, group['group_id'])) for group in groups]
     return InlineKeyboardMarkup(build_menu(buttons))
 
 def build_select_group_menu(groups: list[dict], with_no_group: bool = True) -> InlineKeyboardMarkup:
     """Создает меню выбора группы при создании очереди."""
     buttons = []
     if with_no_group:
-        buttons.append(InlineKeyboardButton("Без группы", callback_data="select_group_none"))
-    buttons.extend([InlineKeyboardButton(group['group_name'], callback_data=f"select_group_{group['group_id']}") for group in groups])
+        buttons.append(InlineKeyboardButton("Без группы", callback_data=pack(CB_SELECT_GROUP_NONE)))
+    buttons.extend([InlineKeyboardButton(group['group_name'], callback_data=pack(CB_SELECT_GROUP, group['group_id'])) for group in groups])
     return InlineKeyboardMarkup(build_menu(buttons))
 
 def build_leave_group_menu(user_groups: list[dict])-> InlineKeyboardMarkup:
     """Создает меню для выхода из групп."""
-    buttons = [InlineKeyboardButton(group['group_name'], callback_data=f"leave_group_{group['group_id']}") for group in user_groups]
+    buttons = [InlineKeyboardButton(group['group_name'], callback_data=pack(CB_LEAVE_GROUP, group['group_id'])) for group in user_groups]
     return InlineKeyboardMarkup(build_menu(buttons))
 
 def build_delete_group_menu(groups: list[dict]) -> InlineKeyboardMarkup:
     """Создает меню для удаления групп."""
-    buttons = [InlineKeyboardButton(group['group_name'], callback_data=f"delete_group_{group['group_id']}") for group in groups]
+    buttons = [InlineKeyboardButton(group['group_name'], callback_data=pack(CB_DELETE_GROUP, group['group_id'])) for group in groups]
     return InlineKeyboardMarkup(build_menu(buttons))
 
-def convert_time_to_user_timezone(server_time: datetime, user_timezone_str: str) -> datetime:
-    """Конвертирует время из UTC в часовой пояс пользователя."""
+def convert_time_to_user_timezone(server_time: datetime | int, user_timezone_str: str) -> datetime:
+    """Конвертирует время из UTC (datetime или секунды из БД) в часовой пояс пользователя."""
     user_timezone = pytz.timezone(user_timezone_str)
 
+    if isinstance(server_time, int):
+        return from_epoch(server_time).astimezone(user_timezone)
+
     # Проверяем, есть ли уже таймзона у server_time
     if server_time.tzinfo is None:
         server_time = pytz.UTC.localize(server_time)  # Присваиваем UTC
@@ -216,12 +229,12 @@ def convert_time_to_user_timezone(server_time: datetime, user_timezone_str: str)
 def build_main_menu():
     """Создает клавиатуру главного меню."""
     buttons = [
-        InlineKeyboardButton("📋 Очереди", callback_data="show_queues"),
-        InlineKeyboardButton("👥 Группы", callback_data="show_groups"),
-        InlineKeyboardButton("📨 Рассылка", callback_data="show_broadcasts"),
-        InlineKeyboardButton("🔄 Сменить имя", callback_data="change_name"),
-        InlineKeyboardButton("🕒 Часовой пояс", callback_data="select_timezone"),
-        InlineKeyboardButton("❓ Помощь", callback_data="help")
+        InlineKeyboardButton("📋 Очереди", callback_data=pack(CB_SHOW_QUEUES)),
+        InlineKeyboardButton("👥 Группы", callback_data=pack(CB_SHOW_GROUPS)),
+        InlineKeyboardButton("📨 Рассылка", callback_data=pack(CB_SHOW_BROADCASTS)),
+        InlineKeyboardButton("🔄 Сменить имя", callback_data=pack(CB_CHANGE_NAME)),
+        InlineKeyboardButton("🕒 Часовой пояс", callback_data=pack(CB_SELECT_TIMEZONE)),
+        InlineKeyboardButton("❓ Помощь", callback_data=pack(CB_HELP))
     ]
     return InlineKeyboardMarkup(build_menu(buttons, n_cols=2))
 
@@ -233,29 +246,38 @@ def get_all_timezones():
     """Возвращает список всех доступных часовых поясов."""
     return pytz.all_timezones
 
-def get_timezone_by_location(lat, lon):
+async def get_timezone_by_location(lat, lon):
     """Определяет часовой пояс по координатам."""
-    tf = TimezoneFinder()
-    return tf.timezone_at(lng=lon, lat=lat)
+    return await timezone_lookup.timezone_at(lat, lon)
 
 def build_russian_timezone_menu():
     """Создает меню выбора часового пояса для России."""
-    buttons = [InlineKeyboardButton(tz_name, callback_data=f"select_tz_{tz_code}") for tz_name, tz_code in RUSSIAN_TIMEZONES.items()]
-    buttons.append(InlineKeyboardButton("📍 Определить по геолокации", callback_data="select_location_tz"))
+    buttons = [InlineKeyboardButton(tz_name, callback_data=pack(CB_SELECT_TZ, tz_code)) for tz_name, tz_code in RUSSIAN_TIMEZONES.items()]
+    buttons.append(InlineKeyboardButton("📍 Определить по геолокации", callback_data=pack(CB_SELECT_LOCATION_TZ)))
     return InlineKeyboardMarkup(build_menu(buttons, n_cols=2))
 
-async def generate_invite_button_message(context, entity_type: str, entity_id: int, creator_id: int, entity_name: str, additional_info: str = "") -> tuple:
+def format_invite_limits(max_uses: int | None, expires_ts: int | None, timezone_str: str | None) -> str:
+    """Строки сообщения приглашения о лимите использований и сроке действия ссылки."""
+    text = ""
+    if max_uses:
+        text += f"\n🎟 Использований: до *{max_uses}*"
+    if expires_ts:
+        expires = convert_time_to_user_timezone(expires_ts, timezone_str or "UTC")
+        text += f"\n⌛ Действует до *{expires.strftime('%d.%m.%y %H:%M')}*"
+    return text
+
+async def generate_invite_button_message(context, entity_type: str, entity_id: int, creator_id: int, entity_name: str, additional_info: str = "", invite_id: int | None = None) -> tuple:
     """Генерирует сообщение с информацией о сущности (очереди/группе) и кнопкой присоединиться.
     Возвращает кортеж: (текст сообщения, reply_markup)"""
     
     if entity_type == "queue":
         payload = JOIN_QUEUE_PAYLOAD
         entity_type_name = "очереди"
-        reply_markup = await create_join_queue_button(context, entity_id, creator_id)
+        reply_markup = await create_join_queue_button(context, entity_id, creator_id, invite_id)
     elif entity_type == "group":
         payload = JOIN_GROUP_PAYLOAD
         entity_type_name = "группы"
-        reply_markup = await create_join_group_button(context, entity_id, creator_id)
+        reply_markup = await create_join_group_button(context, entity_id, creator_id, invite_id)
     else:
         raise ValueError("Неверный тип сущности")
 
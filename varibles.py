@@ -3,6 +3,60 @@ JOIN_QUEUE_PAYLOAD = "join_queue_"
 JOIN_GROUP_PAYLOAD = "join_group_"
 GMT_PLUS_5 = pytz.timezone("Etc/GMT-5")
 MAX_DISTANCE = 150
+# Свой радиус очереди (метры) и число вершин геозоны-многоугольника
+MIN_QUEUE_RADIUS = 20
+MAX_QUEUE_RADIUS = 2000
+MAX_GEOFENCE_VERTICES = 50
+# Размер ячейки пространственного индекса очередей, метры
+QUEUE_INDEX_CELL = 500
+
+# Профиль SQLite по умолчанию (переопределяется SQLITE_PRAGMAS в config.py)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": -16000,      # в КиБ, около 16 МБ на подключение
+    "mmap_size": 134217728,    # 128 МБ
+    "temp_store": "MEMORY",
+}
+# Количество подключений на чтение (переопределяется SQLITE_READERS в config.py)
+SQLITE_READERS = 4
+# Групповая фиксация записи: окно ожидания в секундах и максимум операций в транзакции
+SQLITE_WRITE_BATCH_WINDOW = 0.005
+SQLITE_WRITE_BATCH_SIZE = 200
+# Кэш профилей пользователей: число записей (с запасом на 20 тыс. пользователей) и срок жизни в секундах
+USER_CACHE_SIZE = 25000
+USER_CACHE_TTL = 600
+# Кэш часовых поясов по координатам: размер, знаков после запятой в ключе, загрузка данных при запуске
+TZ_CACHE_SIZE = 4096
+TZ_CACHE_PRECISION = 2
+TZ_WARMUP = True
+# Токены приглашений: байт подписи HMAC, размер кэша проверенных токенов, срок действия в секундах (None — бессрочно)
+TOKEN_TAG_SIZE = 9
+TOKEN_CACHE_SIZE = 4096
+INVITE_TOKEN_TTL = None
+# Приглашения кнопкой «Пригласить»: максимум использований и срок действия в секундах
+# (None — без ограничения), как часто записывать счетчики использований в БД
+INVITE_MAX_USES = 300
+INVITE_LIFETIME = 7 * 24 * 60 * 60
+INVITE_FLUSH_INTERVAL = 10
+# Сколько длинных аргументов кнопок, не поместившихся в callback_data, хранить в памяти
+CALLBACK_STORE_SIZE = 10000
+# Как часто писать в лог счетчики кэша и исходящих сообщений, секунды
+STATS_LOG_INTERVAL = 3600
+# Сколько получателей рассылки читать из БД за один раз
+BROADCAST_PAGE_SIZE = 500
+# Отправка сообщений: сообщений в секунду на бота, интервал между сообщениями
+# в один чат (с), сколько получателей обслуживать одновременно, повторы сетевых ошибок
+DELIVERY_RATE = 30
+DELIVERY_CHAT_INTERVAL = 1.0
+DELIVERY_CONCURRENCY = 16
+DELIVERY_MAX_RETRIES = 3
+# Через сколько секунд после начала очередь удаляется
+QUEUE_LIFETIME = 5 * 60 * 60
+# Отложенные задачи: на сколько секунд вперед они загружаются в JobQueue и как часто окно сдвигается
+SCHEDULER_HORIZON = 15 * 60
+SCHEDULER_TICK = 5 * 60
 
 # States для ConversationHandler (create_queue)
 QUEUE_NAME, QUEUE_DATE, QUEUE_TIME, CHOOSE_LOCATION, CHOOSE_GROUP, SEND_NOTIFICATION, TIME_WITHOUT_LOCATION = range(7)
@@ -0,0 +1,35 @@
+"""Целые числа переменной длины (LEB128): по 7 бит в байте, старший бит — «дальше есть еще байт».
+
+Используются в токенах приглашений (crypto.py) и в callback_data кнопок
+(callbacks.py). Отрицательные числа кодируются через zigzag().
+"""
+
+def encode_varint(value: int, out: bytearray):
+    """Дописывает в out неотрицательное число value."""
+    if value < 0:
+        raise ValueError("Отрицательные значения не кодируются")
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(data: bytes, offset: int) -> tuple[int, int]:
+    """Читает число с позиции offset. Возвращает (число, позиция после него) или бросает ValueError."""
+    value = shift = 0
+    while True:
+        if offset >= len(data) or shift > 63:
+            raise ValueError("Поврежденное число varint")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+def zigzag(value: int) -> int:
+    """Переводит число со знаком в неотрицательное: 0, -1, 1, -2 … -> 0, 1, 2, 3 …"""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+def unzigzag(value: int) -> int:
+    """Обратное к zigzag()."""
+    return value >> 1 if not value & 1 else -(value >> 1) - 1